@@ -1,5 +1,4 @@
 from collections import defaultdict
-import json
 import scipy.stats as stats
 import numpy as np
 import pandas as pd
@@ -14,50 +13,45 @@ import statistics
 from nltk.corpus import wordnet as wn
 
 from utils import get_image_id_to_root_synsets,\
-    verify_synset_in_image,\
+    get_image_metadata,\
+    get_mention_in_image_masks,\
     is_hyponym_of,\
     langs,\
     east_asian_langs,\
     low_resource_langs,\
-    child2parent,\
-    all_synsets,\
-    get_synset_to_image_prob
-from config import xm3600_json_path, use_low_resource_langs
+    get_ontology
+from config import use_low_resource_langs
+from saliency_cube import get_saliency_cube
 from get_dataset import get_processed_dataset
     
 def get_object_num_by_location(synset):
-    iid2root_synset = get_image_id_to_root_synsets()
-    with open(xm3600_json_path, 'r') as fp:
-        jl = list(fp)
-    data = [json.loads(x) for x in jl]
+    iid2l = get_image_metadata().get_image_id_to_locale()
     if not use_low_resource_langs:
-        data = [x for x in data if x['image/locale'] not in low_resource_langs]
-    iid2l = {int(x['image/key'], 16): x['image/locale'] for x in data}
+        iid2l = {x[0]: x[1] for x in iid2l.items() if x[1] not in low_resource_langs}
     l2iid2count = {lang: defaultdict(list) for lang in langs}
     
     for lang in langs:
-        data = get_processed_dataset(f'xm3600_{lang}')
-        for sample in data:
+        data = get_processed_dataset(f'xm3600_{lang}', ['image_id', 'synsets'], cached=True)
+        for sample, in_image in zip(data, get_mention_in_image_masks(data)):
             if sample['image_id'] not in iid2l:
                 continue
             if synset is None:
-                l2iid2count[iid2l[sample['image_id']]][sample['image_id']].append(len([x for x in sample['synsets'] if verify_synset_in_image(x[3], sample['image_id'], iid2root_synset)]))
+                l2iid2count[iid2l[sample['image_id']]][sample['image_id']].append(int(in_image.sum()))
             else:
-                l2iid2count[iid2l[sample['image_id']]][sample['image_id']].append(len([x for x in sample['synsets'] if is_hyponym_of(x[3], synset) and verify_synset_in_image(x[3], sample['image_id'], iid2root_synset)]))
+                l2iid2count[iid2l[sample['image_id']]][sample['image_id']].append(len([x for x, cur_in_image in zip(sample['synsets'], in_image) if cur_in_image and is_hyponym_of(x[3], synset)]))
     
     return l2iid2count
 
 def get_object_num_by_language(synset):
-    iid2root_synset = get_image_id_to_root_synsets()
     l2iid2count = {lang: defaultdict(list) for lang in langs}
     
     for lang in langs:
-        data = get_processed_dataset(f'xm3600_{lang}')
-        for sample in data:
+        data = get_processed_dataset(f'xm3600_{lang}', ['image_id', 'synsets'], cached=True)
+        for sample, in_image in zip(data, get_mention_in_image_masks(data)):
             if synset is None:
-                l2iid2count[lang][sample['image_id']].append(len([x for x in sample['synsets'] if verify_synset_in_image(x[3], sample['image_id'], iid2root_synset)]))
+                l2iid2count[lang][sample['image_id']].append(int(in_image.sum()))
             else:
-                l2iid2count[lang][sample['image_id']].append(len([x for x in sample['synsets'] if is_hyponym_of(x[3], synset) and verify_synset_in_image(x[3], sample['image_id'], iid2root_synset)]))
+                l2iid2count[lang][sample['image_id']].append(len([x for x, cur_in_image in zip(sample['synsets'], in_image) if cur_in_image and is_hyponym_of(x[3], synset)]))
     
     return l2iid2count
 
@@ -81,7 +75,7 @@ def run_object_num_by_language_analysis():
     l2iid2count = get_object_num_by_language(None)
     l2iid2mean = {x[0]: {y[0]: sum(y[1])/len(y[1]) for y in x[1].items()} for x in l2iid2count.items()}
 
-    en_data = get_processed_dataset('xm3600_en')
+    en_data = get_processed_dataset('xm3600_en', ['image_id'], cached=True)
     iids = list(set([x['image_id'] for x in en_data]))
 
     ea_iid2mean = {iid: sum([l2iid2mean[lang][iid] for lang in east_asian_langs])/len(east_asian_langs) for iid in iids}
@@ -118,22 +112,15 @@ def plot_object_num(by_location):
     plt.savefig(f'object_num_by_{by_str}.png', dpi=200)
 
 def get_lang_synset_image_matrix(root_only):
+    # The (language, synset, image) saliency, read from the saliency cube
+    saliency_cube = get_saliency_cube()
     if root_only:
-        concepts = [x for x in all_synsets if x not in child2parent]
+        concepts = [x for x in saliency_cube.synsets if x not in get_ontology().child2parent]
     else:
-        concepts = list(all_synsets)
-    X = np.zeros((len(langs), len(concepts), 3600))
+        concepts = list(saliency_cube.synsets)
+    X = saliency_cube.get_matrix(langs, concepts)
 
-    data = get_processed_dataset('xm3600_en')
-    all_images = list(set([x['image_id'] for x in data]))
-    for i, lang in tqdm(enumerate(langs)):
-        synset2prob = get_synset_to_image_prob(f'xm3600_{lang}')[0]
-        for j, synset in enumerate(concepts):
-            for k, image_id in enumerate(all_images):
-                if image_id in synset2prob[synset]:
-                    X[i, j, k] = synset2prob[synset][image_id]
-
-    return langs, concepts, X
+    return list(langs), concepts, X
 
 def plot_saliency_heatmap(sort_by_mean):
     sns.set_style('whitegrid')
@@ -218,17 +205,15 @@ def get_vertical_depth(synset):
 	return min([get_vertical_depth(x) for x in hypernyms]) + 1
 
 def get_lang_to_gran_list(root_synset=None):
-    iid2root_synset = get_image_id_to_root_synsets()
-
     l2gran = {}
     for lang in tqdm(langs):
-        data = get_processed_dataset(f'xm3600_{lang}')
+        data = get_processed_dataset(f'xm3600_{lang}', ['image_id', 'synsets'], cached=True)
         l2gran[lang] = []
-        for sample in data:
-            for synset in sample['synsets']:
+        for sample, in_image in zip(data, get_mention_in_image_masks(data)):
+            for synset, cur_in_image in zip(sample['synsets'], in_image):
                 if (root_synset is not None) and (not is_hyponym_of(synset[3], root_synset)):
                     continue
-                if not verify_synset_in_image(synset[3], sample['image_id'], iid2root_synset):
+                if not cur_in_image:
                     continue
                 l2gran[lang].append(get_vertical_depth(wn.synset(synset[3])) + synset[4])
 	
@@ -262,30 +247,29 @@ def granularity_analysis():
 
 def synset_agreement_analysis():
     # Analyze on which synsets annotators from different languages tend to agree how salient they are
-    root_synsets = set([x for x in all_synsets if x not in child2parent])
+    ontology = get_ontology()
+    root_synsets = set([x for x in ontology.all_synsets if x not in ontology.child2parent])
     iid2root_synset = get_image_id_to_root_synsets()
+    saliency_cube = get_saliency_cube()
+    root_synset_list = sorted(root_synsets)
 
     # First, for each synset, compute the standard deviation of saliency across langauges in each image, and average over all images
     iid2probs = {}
     for lang in langs:
-        synset2prob, _, image_count = get_synset_to_image_prob(f'xm3600_{lang}')
-        image_ids = image_count.keys()
-        for image_id in image_ids:
-            for synset, synset_data in synset2prob.items():
-                if synset not in root_synsets:
-                    continue
-                if image_id not in iid2root_synset:
-                    continue
+        lang_saliency = saliency_cube.get_matrix([lang], root_synset_list)[0]
+        image_inds = np.nonzero(saliency_cube.image_counts[saliency_cube.language_to_ind[lang]])[0].tolist()
+        for k in image_inds:
+            image_id = saliency_cube.image_ids[k]
+            if image_id not in iid2root_synset:
+                continue
+            for j, synset in enumerate(root_synset_list):
                 if synset not in iid2root_synset[image_id]:
                     continue
                 if not image_id in iid2probs:
                     iid2probs[image_id] = {}
                 if not synset in iid2probs[image_id]:
                     iid2probs[image_id][synset] = []
-                if image_id in synset_data:
-                    iid2probs[image_id][synset].append(synset_data[image_id])
-                else:
-                    iid2probs[image_id][synset].append(0)
+                iid2probs[image_id][synset].append(float(lang_saliency[j, k]))
     iid2std = {}
     for image_id, synset2probs in iid2probs.items():
         iid2std[image_id] = {}
@@ -306,10 +290,12 @@ def synset_agreement_analysis():
     for synset_list in iid2root_synset.values():
         for synset in synset_list:
             synset2count[synset] += 1
+    # For each root synset, the images (of the saliency cube) it's annotated in
+    synset2image_mask = {synset: np.array([image_id in iid2root_synset and synset in iid2root_synset[image_id] for image_id in saliency_cube.image_ids], dtype=bool) for synset in root_synset_list}
     lang2probs = {}
     for lang in tqdm(langs):
-        synset2prob, _, _ = get_synset_to_image_prob(f'xm3600_{lang}')
-        lang2probs[lang] = {synset: sum([x[1] for x in synset2prob[synset].items() if x[0] in iid2root_synset and synset in iid2root_synset[x[0]]])/synset2count[synset] for synset in root_synsets}
+        lang_saliency = saliency_cube.get_matrix([lang], root_synset_list)[0]
+        lang2probs[lang] = {synset: float(lang_saliency[j][synset2image_mask[synset]].sum())/synset2count[synset] for j, synset in enumerate(root_synset_list)}
     synset2means = defaultdict(list)
     for lang, synsets_data in lang2probs.items():
         for synset, mean_prob in synsets_data.items():
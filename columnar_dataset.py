@@ -0,0 +1,184 @@
+import json
+import os
+import numpy as np
+from config import datasets_dir
+
+''' A columnar, memory-mappable layout of the processed datasets (datasets/<dataset name>.json). The json files remain
+the interchange format; the columnar copy is written by export_dataset into datasets/columnar/<dataset name>/ as .npy
+files and a meta.json:
+    Captions table (one row per sample):
+        image_id.npy: uint64
+        has_synsets.npy: bool, False for samples whose synsets are None
+        mention_offsets.npy: int64, the mentions of caption i are rows mention_offsets[i]:mention_offsets[i+1] of the
+            mentions table
+        String columns (caption, orig, source, ...): <column>.blob.npy holds the texts of all the rows concatenated
+            (utf-8, uint8) and <column>.offsets.npy (int64) their byte boundaries. Columns that only some samples have
+            also have <column>.present.npy (bool)
+    Mentions table (one row per identified synset):
+        mention_caption.npy: uint32, the caption's row
+        mention_start.npy, mention_end.npy, mention_dist.npy: int32
+        mention_synset.npy: int32, index into meta['synsets']
+        mention_phrase: a string column, as above
+meta.json records the size and modification time of the json it was exported from, so an outdated copy is ignored.
+'''
+
+columnar_dir = os.path.join(datasets_dir, 'columnar')
+format_version = 1
+# Columns that aren't string columns
+special_columns = ['image_id', 'synsets']
+
+def get_json_path(dataset_name):
+    return os.path.join(datasets_dir, f'{dataset_name}.json')
+
+def get_columnar_path(dataset_name):
+    return os.path.join(columnar_dir, dataset_name)
+
+def get_json_stamp(dataset_name):
+    stat = os.stat(get_json_path(dataset_name))
+    return {'json_size': stat.st_size, 'json_mtime_ns': stat.st_mtime_ns}
+
+def save_string_column(dir_path, name, texts):
+    encoded = [text.encode('utf-8') for text in texts]
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(x) for x in encoded])
+    np.save(os.path.join(dir_path, f'{name}.blob.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+    np.save(os.path.join(dir_path, f'{name}.offsets.npy'), offsets)
+
+def load_string_column(dir_path, name):
+    # Returns the texts as a list of strings
+    blob = np.load(os.path.join(dir_path, f'{name}.blob.npy'), mmap_mode='r').tobytes()
+    offsets = np.load(os.path.join(dir_path, f'{name}.offsets.npy')).tolist()
+    return [blob[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+def export_dataset(dataset_name):
+    with open(get_json_path(dataset_name), 'r') as fp:
+        data = json.load(fp)
+    meta = get_json_stamp(dataset_name)
+    dir_path = get_columnar_path(dataset_name)
+    os.makedirs(dir_path, exist_ok=True)
+
+    # The key order of the samples, so the samples can be rebuilt as they are in the json
+    key_order = []
+    for sample in data:
+        for key in sample:
+            if key not in key_order:
+                key_order.append(key)
+    string_columns = [key for key in key_order if key not in special_columns]
+    partial_columns = [key for key in key_order if any([key not in sample for sample in data])]
+    assert 'image_id' not in partial_columns, f'Samples without an image id in {dataset_name}'
+
+    np.save(os.path.join(dir_path, 'image_id.npy'), np.array([sample['image_id'] for sample in data], dtype=np.uint64))
+    for column in string_columns:
+        for sample in data:
+            assert column not in sample or isinstance(sample[column], str), f'Column {column} of {dataset_name} is not a string column'
+        save_string_column(dir_path, column, [sample.get(column, '') for sample in data])
+    for column in partial_columns:
+        np.save(os.path.join(dir_path, f'{column}.present.npy'), np.array([column in sample for sample in data], dtype=bool))
+
+    synsets = sorted(set([mention[3] for sample in data if sample.get('synsets') is not None for mention in sample['synsets']]))
+    synset_to_id = {synset: i for i, synset in enumerate(synsets)}
+    mentions = [(i, mention) for i, sample in enumerate(data) if sample.get('synsets') is not None for mention in sample['synsets']]
+    mention_counts = [0 if sample.get('synsets') is None else len(sample['synsets']) for sample in data]
+    mention_offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    mention_offsets[1:] = np.cumsum(mention_counts)
+    np.save(os.path.join(dir_path, 'has_synsets.npy'), np.array([sample.get('synsets') is not None for sample in data], dtype=bool))
+    np.save(os.path.join(dir_path, 'mention_offsets.npy'), mention_offsets)
+    np.save(os.path.join(dir_path, 'mention_caption.npy'), np.array([i for i, _ in mentions], dtype=np.uint32))
+    np.save(os.path.join(dir_path, 'mention_start.npy'), np.array([mention[0] for _, mention in mentions], dtype=np.int32))
+    np.save(os.path.join(dir_path, 'mention_end.npy'), np.array([mention[1] for _, mention in mentions], dtype=np.int32))
+    np.save(os.path.join(dir_path, 'mention_synset.npy'), np.array([synset_to_id[mention[3]] for _, mention in mentions], dtype=np.int32))
+    np.save(os.path.join(dir_path, 'mention_dist.npy'), np.array([mention[4] for _, mention in mentions], dtype=np.int32))
+    save_string_column(dir_path, 'mention_phrase', [mention[2] for _, mention in mentions])
+
+    meta.update({
+        'version': format_version,
+        'caption_num': len(data),
+        'mention_num': len(mentions),
+        'key_order': key_order,
+        'string_columns': string_columns,
+        'partial_columns': partial_columns,
+        'synsets': synsets
+    })
+    # The meta file is written last, so a partial export is never used
+    with open(os.path.join(dir_path, 'meta.json'), 'w') as fp:
+        fp.write(json.dumps(meta))
+
+def load_meta(dataset_name):
+    # Returns None if there's no up to date columnar copy of the dataset
+    meta_path = os.path.join(get_columnar_path(dataset_name), 'meta.json')
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path, 'r') as fp:
+        meta = json.load(fp)
+    if meta['version'] != format_version:
+        return None
+    if os.path.isfile(get_json_path(dataset_name)):
+        stamp = get_json_stamp(dataset_name)
+        if stamp['json_size'] != meta['json_size'] or stamp['json_mtime_ns'] != meta['json_mtime_ns']:
+            return None
+    return meta
+
+def has_columnar(dataset_name):
+    return load_meta(dataset_name) is not None
+
+def load_array(dataset_name, name):
+    # Memory mapped, only the pages that are read are loaded
+    return np.load(os.path.join(get_columnar_path(dataset_name), f'{name}.npy'), mmap_mode='r')
+
+def load_samples(dataset_name, columns=None):
+    ''' The samples as in the json file, with only the given columns (sample keys) if columns isn't None. Only the
+    files of these columns are read. '''
+    meta = load_meta(dataset_name)
+    assert meta is not None, f'No up to date columnar copy of {dataset_name}'
+    dir_path = get_columnar_path(dataset_name)
+    if columns is None:
+        columns = meta['key_order']
+    columns = [key for key in meta['key_order'] if key in columns]
+    caption_num = meta['caption_num']
+
+    column_values = {}
+    if 'image_id' in columns:
+        column_values['image_id'] = load_array(dataset_name, 'image_id').tolist()
+    for column in meta['string_columns']:
+        if column in columns:
+            column_values[column] = load_string_column(dir_path, column)
+    if 'synsets' in columns:
+        mention_offsets = load_array(dataset_name, 'mention_offsets').tolist()
+        has_synsets = load_array(dataset_name, 'has_synsets').tolist()
+        mentions = list(map(list, zip(
+            load_array(dataset_name, 'mention_start').tolist(),
+            load_array(dataset_name, 'mention_end').tolist(),
+            load_string_column(dir_path, 'mention_phrase'),
+            np.array(meta['synsets'], dtype=object)[load_array(dataset_name, 'mention_synset')].tolist(),
+            load_array(dataset_name, 'mention_dist').tolist()
+        )))
+        column_values['synsets'] = [
+            mentions[mention_offsets[i]:mention_offsets[i+1]] if has_synsets[i] else None for i in range(caption_num)
+        ]
+    present = {column: load_array(dataset_name, f'{column}.present').tolist() for column in meta['partial_columns'] if column in columns}
+
+    if len(columns) == 0:
+        # As in the json path: an empty sample for each caption
+        return [{} for _ in range(caption_num)]
+    if len(present) == 0:
+        return [dict(zip(columns, values)) for values in zip(*[column_values[column] for column in columns])]
+    samples = []
+    for i in range(caption_num):
+        sample = {}
+        for column in columns:
+            if column not in present or present[column][i]:
+                sample[column] = column_values[column][i]
+        samples.append(sample)
+    return samples
+
+if __name__ == '__main__':
+    import argparse
+    from get_dataset import datasets
+    parser = argparse.ArgumentParser()
+    parser.add_argument('datasets', nargs='*', help='Datasets to export (by default, all the processed datasets)')
+    args = parser.parse_args()
+
+    dataset_list = args.datasets if len(args.datasets) > 0 else [x for x in datasets if os.path.isfile(get_json_path(x))]
+    for dataset_name in dataset_list:
+        export_dataset(dataset_name)
+        print(f'Exported {dataset_name}', flush=True)
@@ -1,5 +1,40 @@
+import os
+
+# Paths of the files the package owns are resolved relative to it, not to the working directory
+package_dir = os.path.dirname(os.path.abspath(__file__))
+datasets_dir = os.path.join(package_dir, 'datasets')
+# The xm3600 captions and their translations to English
+xm3600_dir = os.path.join(package_dir, 'xm3600')
+
 use_low_resource_langs = False
 xm3600_json_path = '/cs/labs/oabend/uriber/datasets/crossmodal3600/captions.jsonl'
 coco_json_path = '../CLIP_prefix_caption/dataset_coco.json'
 stair_json_path = '../playground/STAIR_captions.json'
 stair_translated_json_path = '../playground/STAIR_translated.json'
+# Stanza processors needed for find_synsets (we only use the POS tags and the dependency parse)
+stanza_processors = 'tokenize,mwt,pos,lemma,depparse'
+parse_batch_size = 256
+lm_batch_size = 64
+# Masked LM used for disambiguation. lm_device: 'cuda' or 'cpu'. lm_precision: 'fp32', 'bf16' (autocast) or 'int8'
+#  (dynamic quantization, CPU only). lm_num_threads: torch intra-op threads, None keeps the torch default
+lm_name = 'bert-large-uncased'
+lm_device = 'cuda'
+lm_precision = 'fp32'
+lm_num_threads = None
+# Persistent cache of masked LM scores (None to disable). When the cache is full the least recently used entries are
+#  evicted
+lm_cache_path = os.path.join(package_dir, 'data', 'lm_cache.sqlite3')
+lm_cache_max_entries = 5000000
+# Persistent cache of find_synsets results (None to disable). Entries are keyed by a fingerprint of the data files and
+#  the code, so editing them invalidates the cache
+result_cache_path = os.path.join(package_dir, 'data', 'result_cache.sqlite3')
+result_cache_max_entries = 2000000
+# How ambiguous mentions are resolved: 'masked_lm' (the lm_name masked LM) or 'prior' (the most frequent synset by
+#  WordNet counts, no model needed). See src/lm_scorer_benchmark.py for a comparison
+lm_scorer = 'masked_lm'
+# Memory budget (in MB) of the in-process cache of processed datasets (get_processed_dataset with cached=True). When
+#  it's exceeded the least recently used datasets are evicted
+dataset_cache_max_mb = 2048
+# Budget (in ms) for importing utils in a fresh interpreter, checked by src/check_import_time.py. The ontology and the
+#  data files are loaded on first use, so this is mostly the time of importing numpy
+utils_import_budget_ms = 300
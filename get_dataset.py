@@ -1,5 +1,12 @@
+import itertools
 import json
-from config import coco_json_path, stair_json_path, stair_translated_json_path
+import os
+import sys
+from collections import OrderedDict
+from types import MappingProxyType
+from columnar_dataset import has_columnar, load_samples, get_columnar_path, get_json_path
+from config import coco_json_path, stair_json_path, stair_translated_json_path, dataset_cache_max_mb, \
+    xm3600_dir
 
 datasets = ['COCO', 'xm3600_ar', 'xm3600_bn', 'xm3600_cs', 'xm3600_da', 'xm3600_de', 'xm3600_el', 'xm3600_en',
             'xm3600_es', 'xm3600_fa', 'xm3600_fi', 'xm3600_fil', 'xm3600_fr', 'xm3600_he', 'xm3600_hi', 'xm3600_hr',
@@ -7,57 +14,211 @@ datasets = ['COCO', 'xm3600_ar', 'xm3600_bn', 'xm3600_cs', 'xm3600_da', 'xm3600_
             'xm3600_pl', 'xm3600_pt', 'xm3600_quz', 'xm3600_ro', 'xm3600_ru', 'xm3600_sv', 'xm3600_sw', 'xm3600_te',
             'xm3600_th', 'xm3600_tr', 'xm3600_uk', 'xm3600_vi', 'xm3600_zh', 'STAIR-captions']
 
-def get_processed_dataset(dataset_name):
-    with open(f'datasets/{dataset_name}.json', 'r') as fp:
+class DatasetCache:
+    ''' An in-process LRU cache of loaded datasets, bounded by an (estimated) memory budget in bytes. Entries are keyed
+    by the dataset name and the requested columns, and are reloaded when the dataset's file changes. Cached datasets
+    are read-only: a tuple of read-only mappings, with the synsets as tuples.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, stamp, load_func):
+        if key in self.entries and self.entries[key][0] == stamp:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][1]
+        self.misses += 1
+        self.remove(key)
+        data = freeze_dataset(load_func())
+        size = estimate_dataset_size(data)
+        if size <= self.max_bytes:
+            self.entries[key] = (stamp, data, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+        return data
+
+    def remove(self, key):
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)[2]
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+
+def freeze_dataset(data):
+    return tuple([
+        MappingProxyType({
+            key: (None if value is None else tuple([tuple(x) for x in value])) if key == 'synsets' else value
+            for key, value in sample.items()
+        })
+        for sample in data
+    ])
+
+def estimate_dataset_size(data, sample_num=100):
+    # Extrapolated from the deep size of the first samples
+    if len(data) == 0:
+        return sys.getsizeof(data)
+    def deep_size(obj):
+        size = sys.getsizeof(obj)
+        if isinstance(obj, (tuple, list)):
+            size += sum([deep_size(x) for x in obj])
+        elif isinstance(obj, MappingProxyType):
+            size += sys.getsizeof(dict(obj)) + sum([deep_size(x) for x in obj.values()])
+        return size
+    samples = data[:sample_num]
+    return sys.getsizeof(data) + sum([deep_size(x) for x in samples])*len(data)//len(samples)
+
+dataset_cache = DatasetCache(dataset_cache_max_mb*2**20)
+
+def get_dataset_stamp(dataset_name):
+    # Changes whenever the dataset is rewritten
+    json_path = get_json_path(dataset_name)
+    if os.path.isfile(json_path):
+        path = json_path
+    else:
+        path = os.path.join(get_columnar_path(dataset_name), 'meta.json')
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+def get_processed_dataset(dataset_name, columns=None, cached=False):
+    # With columns, the samples only have these keys (e.g., ['image_id', 'synsets']). If there's an up to date columnar
+    #  copy of the dataset (see columnar_dataset.py) only these columns are read from it, otherwise the json is parsed.
+    #  With cached, the dataset is read-only (see DatasetCache) and is kept in memory for later calls
+    if cached:
+        key = (dataset_name, None if columns is None else tuple(sorted(columns)))
+        return dataset_cache.get(key, get_dataset_stamp(dataset_name), lambda: get_processed_dataset(dataset_name, columns))
+
+    if has_columnar(dataset_name):
+        return load_samples(dataset_name, columns)
+
+    with open(get_json_path(dataset_name), 'r') as fp:
         data = json.load(fp)
+    if columns is not None:
+        data = [{key: value for key, value in sample.items() if key in columns} for sample in data]
 
     return data
 
 def get_orig_dataset(dataset_name):
+    return list(iter_orig_dataset(dataset_name))
+
+class JSONArrayReader:
+    ''' Reads the elements of a json array from a file one by one, in chunks of chunk_size characters, so only the
+    current element (and one chunk) is in memory. If key is given the file holds an object, and we read the array
+    stored under key in this object (the values of the preceding keys are read whole and dropped).
+    '''
+    def __init__(self, path, key=None, chunk_size=1 << 20):
+        self.path = path
+        self.key = key
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+
+    def __iter__(self):
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        with open(self.path, 'r') as self.fp:
+            if self.key is not None:
+                self.skip_to_key()
+            self.expect('[')
+            if self.peek() == ']':
+                return
+            while True:
+                yield self.read_value()
+                if self.expect(',]') == ']':
+                    return
+
+    def read_chunk(self):
+        chunk = self.fp.read(self.chunk_size)
+        if len(chunk) == 0:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        # The next non whitespace character, or '' at the end of the file
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self.read_chunk()
+
+    def expect(self, chars):
+        char = self.peek()
+        assert len(char) == 1 and char in chars, f'Expected one of "{chars}" in {self.path}, got "{char}"'
+        self.pos += 1
+        return char
+
+    def read_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A value that reaches the end of the buffer may be cut in the middle (e.g., a number)
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.read_chunk()
+
+    def skip_to_key(self):
+        self.expect('{')
+        while self.peek() != '}':
+            key = self.read_value()
+            self.expect(':')
+            if key == self.key:
+                return
+            self.read_value()
+            if self.expect(',}') == '}':
+                break
+        assert False, f'Key {self.key} not found in {self.path}'
+
+def zip_same_length(*iterables):
+    # Like zip, but asserts that all the iterables have the same length
+    missing = object()
+    for values in itertools.zip_longest(*iterables, fillvalue=missing):
+        assert missing not in values, 'Iterables of different lengths'
+        yield values
+
+def iter_orig_dataset(dataset_name):
+    # Yields the samples one by one, reading the source files lazily (see JSONArrayReader)
     if dataset_name == 'COCO':
-        with open(coco_json_path, 'r') as fp:
-            coco_data = json.load(fp)['images']
-        data = []
-        for x in coco_data:
+        for x in JSONArrayReader(coco_json_path, key='images'):
             for y in x['sentences']:
-                data.append({
+                yield {
                     'image_id': x['cocoid'],
-                    'caption': y['raw']
-                    })
+                    'caption': y['raw'],
+                    'source': dataset_name
+                    }
     elif dataset_name.startswith('xm3600'):
         lang = dataset_name.split('xm3600_')[1]
         if lang == 'en':
-            with open('xm3600/xm3600_en.json', 'r') as fp:
-                data = json.load(fp)
+            for sample in JSONArrayReader(os.path.join(xm3600_dir, 'xm3600_en.json')):
+                sample['source'] = dataset_name
+                yield sample
         else:
-            with open(f'xm3600/xm3600_{lang}_to_en.json', 'r') as fp:
-                data = json.load(fp)
-            with open(f'xm3600/xm3600_{lang}.json', 'r') as fp:
-                orig_data = json.load(fp)
-            assert len(data) == len(orig_data)
-            for i in range(len(data)):
-                data[i]['orig'] = orig_data[i]['caption']
+            data = JSONArrayReader(os.path.join(xm3600_dir, f'xm3600_{lang}_to_en.json'))
+            orig_data = JSONArrayReader(os.path.join(xm3600_dir, f'xm3600_{lang}.json'))
+            for sample, orig_sample in zip_same_length(data, orig_data):
+                sample['orig'] = orig_sample['caption']
+                sample['source'] = dataset_name
+                yield sample
     elif dataset_name == 'STAIR-captions':
-        with open(coco_json_path, 'r') as fp:
-            coco_data = json.load(fp)['images']
-        iid_to_split = {x['cocoid']: 'train' if x['split'] == 'train' else 'val' for x in coco_data}
-        with open(stair_json_path, 'r') as fp:
-            orig_data = json.load(fp)
-        with open(stair_translated_json_path, 'r') as fp:
-            tran_data = json.load(fp)
-        data = []
-        for i in range(len(orig_data)):
-            image_id = orig_data[i]['image_id']
-            split = iid_to_split[image_id]
-            data.append({
-                'image_id': image_id,
-                'caption': tran_data[i]['translatedText'],
-                'orig': orig_data[i]['caption'],
-            })
+        orig_data = JSONArrayReader(stair_json_path)
+        tran_data = JSONArrayReader(stair_translated_json_path)
+        for orig_sample, tran_sample in zip_same_length(orig_data, tran_data):
+            yield {
+                'image_id': orig_sample['image_id'],
+                'caption': tran_sample['translatedText'],
+                'orig': orig_sample['caption'],
+                'source': dataset_name
+            }
     else:
         assert False, f'Unknown dataset {dataset_name}'
-
-    for i in range(len(data)):
-        data[i]['source'] = dataset_name
-
-    return data
@@ -0,0 +1,112 @@
+import csv
+import json
+import os
+import numpy as np
+from config import package_dir
+
+''' Per-image metadata of the CrossModal3600 images, built once from the root synset annotation
+(data/xm3600_annotation.csv) and the CrossModal3600 captions file (for the locales, if it's available) and cached on
+disk. Image ids are interned to rows:
+    image_ids: uint64, in the annotation file's order
+    filenames: the hex file names (without the extension)
+    locales: the locale of each image, or '' if unknown
+    annotation: a dense (image, root synset) bool matrix, True where the root synset is in the image
+With an OntologyIndex, hyponym_matrix is a dense (synset id, root synset) bool matrix, True where the synset is a
+hyponym of the root synset, so checking whether synsets are in their images is a mask lookup.
+'''
+
+annotation_csv_path = os.path.join(package_dir, 'data', 'xm3600_annotation.csv')
+image_metadata_cache_path = os.path.join(package_dir, 'data', 'image_metadata.npz')
+
+def get_file_stamp(path):
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+def read_locales(captions_jsonl_path):
+    iid_to_locale = {}
+    if captions_jsonl_path is None or not os.path.isfile(captions_jsonl_path):
+        return iid_to_locale
+    with open(captions_jsonl_path, 'r') as fp:
+        for line in fp:
+            sample = json.loads(line)
+            iid_to_locale[int(sample['image/key'], 16)] = sample['image/locale']
+    return iid_to_locale
+
+class ImageMetadata:
+    def __init__(self, image_ids, filenames, locales, root_synsets, annotation, ontology_index=None):
+        self.image_ids = image_ids
+        self.filenames = filenames
+        self.locales = locales
+        self.root_synsets = root_synsets
+        self.annotation = annotation
+        self.image_id_to_ind = {image_id: i for i, image_id in enumerate(image_ids.tolist())}
+        self.hyponym_matrix = None
+        if ontology_index is not None:
+            self.set_ontology(ontology_index)
+
+    @staticmethod
+    def build(csv_path=annotation_csv_path, captions_jsonl_path=None):
+        with open(csv_path, 'r') as fp:
+            rows = list(csv.reader(fp))
+        root_synsets = rows[0][1:]
+        filenames = [row[0] for row in rows[1:]]
+        image_ids = np.array([int(filename, 16) for filename in filenames], dtype=np.uint64)
+        assert len(set(image_ids.tolist())) == len(image_ids), 'Duplicate images in the annotation file'
+        annotation = np.array([[x == '1' for x in row[1:]] for row in rows[1:]], dtype=bool).reshape(len(filenames), len(root_synsets))
+        iid_to_locale = read_locales(captions_jsonl_path)
+        locales = [iid_to_locale.get(image_id, '') for image_id in image_ids.tolist()]
+        return ImageMetadata(image_ids, filenames, locales, root_synsets, annotation)
+
+    @staticmethod
+    def load(csv_path=annotation_csv_path, captions_jsonl_path=None, cache_path=image_metadata_cache_path):
+        # Use the cached table if it was built from the same files, otherwise build it and cache it
+        stamp = json.dumps([get_file_stamp(csv_path), get_file_stamp(captions_jsonl_path) if captions_jsonl_path is not None else None])
+        if cache_path is not None and os.path.isfile(cache_path):
+            with np.load(cache_path) as cached:
+                if str(cached['stamp']) == stamp:
+                    return ImageMetadata(
+                        cached['image_ids'], cached['filenames'].tolist(), cached['locales'].tolist(),
+                        cached['root_synsets'].tolist(), cached['annotation']
+                    )
+        res = ImageMetadata.build(csv_path, captions_jsonl_path)
+        if cache_path is not None:
+            np.savez(
+                cache_path, stamp=np.array(stamp), image_ids=res.image_ids, filenames=np.array(res.filenames),
+                locales=np.array(res.locales), root_synsets=np.array(res.root_synsets), annotation=res.annotation
+            )
+        return res
+
+    def set_ontology(self, ontology_index):
+        ids = np.arange(len(ontology_index), dtype=np.int32)
+        root_ids = ontology_index.to_ids(self.root_synsets)
+        self.synset_to_id = ontology_index.synset_to_id
+        self.hyponym_matrix = ontology_index.is_hyponym_of_ids(ids[:, np.newaxis], root_ids[np.newaxis, :])
+
+    def get_image_inds(self, image_ids):
+        return np.array([self.image_id_to_ind.get(image_id, -1) for image_id in image_ids], dtype=np.int64)
+
+    def get_image_id_to_root_synsets(self):
+        return {
+            image_id: [self.root_synsets[j] for j in np.nonzero(row)[0]]
+            for image_id, row in zip(self.image_ids.tolist(), self.annotation)
+        }
+
+    def get_image_id_to_locale(self):
+        return {image_id: locale for image_id, locale in zip(self.image_ids.tolist(), self.locales) if locale != ''}
+
+    def verify_synsets_in_images(self, synset_ids, image_inds):
+        # For each (synset id, image row) pair, whether the synset is a hyponym of one of the image's root synsets.
+        #  Images that aren't annotated (row -1) accept any synset, and synsets not in the ontology (id -1) aren't in
+        #  any annotated image
+        synset_ids = np.asarray(synset_ids, dtype=np.int64)
+        image_inds = np.asarray(image_inds, dtype=np.int64)
+        in_image = (self.hyponym_matrix[np.maximum(synset_ids, 0)] & self.annotation[np.maximum(image_inds, 0)]).any(axis=1)
+        in_image &= synset_ids >= 0
+        return in_image | (image_inds < 0)
+
+    def verify_synset_in_image(self, synset, image_id):
+        synset_id = self.synset_to_id.get(synset, -1)
+        image_ind = self.image_id_to_ind.get(image_id, -1)
+        return bool(self.verify_synsets_in_images([synset_id], [image_ind])[0])
@@ -0,0 +1,207 @@
+import json
+import os
+import numpy as np
+from utils import langs, get_ontology
+from get_dataset import get_processed_dataset
+from columnar_dataset import save_string_column, get_json_path
+from config import datasets_dir
+from saliency_cube import get_file_stamp, get_available_languages, get_language_ind
+
+''' An inverted index of the synset mentions in the xm3600 datasets, persisted as .npy files in datasets/mention_index/
+and memory mapped when opened:
+    Captions table, sorted by (language, image, row in the dataset), so the captions of each (language, image) pair are
+    the contiguous range pair_offsets[language*image_num + image]:pair_offsets[language*image_num + image + 1]:
+        caption_language.npy, caption_image.npy (index into image_ids), caption_row.npy (the sample's index in its
+            dataset): int32
+        has_synsets.npy: bool, False for samples whose synsets are None
+        caption and orig: string columns (as in columnar_dataset.py), with orig.present.npy
+        mention_offsets.npy: int64, the mentions of caption i are mention_offsets[i]:mention_offsets[i+1]
+    Mentions table, in caption order: mention_start.npy, mention_end.npy, mention_dist.npy, mention_synset.npy (the
+        synset's OntologyIndex id): int32, and mention_phrase (a string column)
+    Postings: posting_caption.npy (int32) holds the captions mentioning each synset, sorted by synset id and then
+        caption, and synset_offsets.npy (int64) the range of each synset id. Since synset ids are in DFS order, the
+        postings of a synset's subtree are the contiguous range synset_offsets[id]:synset_offsets[synset_exit[id]]
+    synset_exit.npy: int32, the end of each synset's subtree in the ids of the index (OntologyIndex.exit when built), so
+        an opened index never depends on the current ontology
+index.json lists the languages, image ids and ontology synsets the ids refer to, and the stamps of the datasets, like
+the saliency cube. The index is rebuilt when any of these change.
+'''
+
+mention_index_dir = os.path.join(datasets_dir, 'mention_index')
+format_version = 2
+
+def get_input_paths(languages):
+    return [get_json_path(f'xm3600_{lang}') for lang in languages]
+
+def is_up_to_date(index, languages):
+    if index['version'] != format_version or index['languages'] != languages or index['synsets'] != get_ontology().ontology_index.synsets:
+        return False
+    input_paths = get_input_paths(languages)
+    if sorted(index['inputs']) != sorted(input_paths):
+        return False
+    for path in input_paths:
+        if not os.path.isfile(path):
+            return False
+        if get_file_stamp(path, index['inputs'][path])['sha256'] != index['inputs'][path]['sha256']:
+            return False
+    return True
+
+def build_mention_index(languages=langs):
+    ontology_index = get_ontology().ontology_index
+    os.makedirs(mention_index_dir, exist_ok=True)
+    # The index is written last, so a partial build is never used
+    index_path = os.path.join(mention_index_dir, 'index.json')
+    if os.path.isfile(index_path):
+        os.remove(index_path)
+    inputs = {path: get_file_stamp(path) for path in get_input_paths(languages)}
+
+    lang_data = [get_processed_dataset(f'xm3600_{lang}', ['image_id', 'caption', 'orig', 'synsets']) for lang in languages]
+    image_ids = sorted(set([sample['image_id'] for data in lang_data for sample in data]))
+    image_id_to_ind = {image_id: i for i, image_id in enumerate(image_ids)}
+    captions = sorted([
+        (lang_ind, image_id_to_ind[sample['image_id']], row, sample)
+        for lang_ind, data in enumerate(lang_data) for row, sample in enumerate(data)
+    ], key=lambda x: x[:3])
+    samples = [x[3] for x in captions]
+
+    def save(name, array):
+        np.save(os.path.join(mention_index_dir, f'{name}.npy'), array)
+
+    save('caption_language', np.array([x[0] for x in captions], dtype=np.int32))
+    caption_image = np.array([x[1] for x in captions], dtype=np.int32)
+    save('caption_image', caption_image)
+    save('caption_row', np.array([x[2] for x in captions], dtype=np.int32))
+    save('has_synsets', np.array([sample['synsets'] is not None for sample in samples], dtype=bool))
+    save_string_column(mention_index_dir, 'caption', [sample['caption'] for sample in samples])
+    save_string_column(mention_index_dir, 'orig', [sample.get('orig', '') for sample in samples])
+    save('orig.present', np.array(['orig' in sample for sample in samples], dtype=bool))
+    pair_keys = np.array([x[0] for x in captions], dtype=np.int64)*len(image_ids) + caption_image
+    save('pair_offsets', np.searchsorted(pair_keys, np.arange(len(languages)*len(image_ids) + 1)).astype(np.int64))
+
+    mentions = [mention for sample in samples if sample['synsets'] is not None for mention in sample['synsets']]
+    mention_counts = [0 if sample['synsets'] is None else len(sample['synsets']) for sample in samples]
+    mention_offsets = np.zeros(len(samples) + 1, dtype=np.int64)
+    mention_offsets[1:] = np.cumsum(mention_counts)
+    mention_synset = ontology_index.to_ids([mention[3] for mention in mentions])
+    assert (mention_synset >= 0).all(), 'Mentioned synsets are missing from the ontology'
+    save('mention_offsets', mention_offsets)
+    save('mention_start', np.array([mention[0] for mention in mentions], dtype=np.int32))
+    save('mention_end', np.array([mention[1] for mention in mentions], dtype=np.int32))
+    save('mention_dist', np.array([mention[4] for mention in mentions], dtype=np.int32))
+    save('mention_synset', mention_synset)
+    save_string_column(mention_index_dir, 'mention_phrase', [mention[2] for mention in mentions])
+
+    # Each (synset, caption) pair once, sorted by synset and then caption
+    mention_caption = np.repeat(np.arange(len(samples), dtype=np.int64), mention_counts)
+    postings = np.unique(mention_synset.astype(np.int64)*len(samples) + mention_caption)
+    posting_synset = postings // max(len(samples), 1)
+    save('posting_caption', (postings % max(len(samples), 1)).astype(np.int32))
+    save('synset_offsets', np.searchsorted(posting_synset, np.arange(len(ontology_index) + 1)).astype(np.int64))
+    save('synset_exit', ontology_index.exit.astype(np.int32))
+
+    index = {
+        'version': format_version,
+        'languages': list(languages),
+        'image_ids': image_ids,
+        'synsets': ontology_index.synsets,
+        'inputs': inputs
+    }
+    with open(index_path, 'w') as fp:
+        fp.write(json.dumps(index))
+
+class MentionIndex:
+    def __init__(self, dir_path=mention_index_dir):
+        with open(os.path.join(dir_path, 'index.json'), 'r') as fp:
+            index = json.load(fp)
+        self.dir_path = dir_path
+        self.languages = index['languages']
+        self.image_ids = index['image_ids']
+        self.synsets = index['synsets']
+        self.language_to_ind = {lang: i for i, lang in enumerate(self.languages)}
+        self.image_id_to_ind = {image_id: i for i, image_id in enumerate(self.image_ids)}
+        self.synset_to_id = {synset: i for i, synset in enumerate(self.synsets)}
+        # Memory mapped, only the pages that are read are loaded
+        for name in [
+            'caption_language', 'caption_image', 'caption_row', 'has_synsets', 'caption.blob', 'caption.offsets',
+            'orig.blob', 'orig.offsets', 'orig.present', 'pair_offsets', 'mention_offsets', 'mention_start',
+            'mention_end', 'mention_dist', 'mention_synset', 'mention_phrase.blob', 'mention_phrase.offsets',
+            'posting_caption', 'synset_offsets', 'synset_exit'
+        ]:
+            setattr(self, name.replace('.', '_'), np.load(os.path.join(dir_path, f'{name}.npy'), mmap_mode='r'))
+
+    def get_text(self, column, i):
+        blob = getattr(self, f'{column}_blob')
+        offsets = getattr(self, f'{column}_offsets')
+        return blob[offsets[i]:offsets[i+1]].tobytes().decode('utf-8')
+
+    def get_caption_range(self, language=None, image_id=None):
+        # The captions of the language (and image), as a range of caption rows
+        if language is None:
+            return 0, len(self.caption_row)
+        lang_ind = get_language_ind(self.language_to_ind, language)
+        if image_id is None:
+            return int(self.pair_offsets[lang_ind*len(self.image_ids)]), int(self.pair_offsets[(lang_ind + 1)*len(self.image_ids)])
+        if image_id not in self.image_id_to_ind:
+            return 0, 0
+        pair_ind = lang_ind*len(self.image_ids) + self.image_id_to_ind[image_id]
+        return int(self.pair_offsets[pair_ind]), int(self.pair_offsets[pair_ind + 1])
+
+    def get_image_captions(self, language, image_id):
+        start, end = self.get_caption_range(language, image_id)
+        return list(range(start, end))
+
+    def get_captions(self, synset, language=None, image_id=None, include_hyponyms=True):
+        ''' The sorted caption rows that mention the synset (or, by default, one of its hyponyms), optionally only of the
+        given language and image. '''
+        synset_id = self.synset_to_id.get(synset)
+        if synset_id is None:
+            return np.zeros(0, dtype=np.int32)
+        end_id = int(self.synset_exit[synset_id]) if include_hyponyms else synset_id + 1
+        postings = self.posting_caption[self.synset_offsets[synset_id]:self.synset_offsets[end_id]]
+        start, end = self.get_caption_range(language, image_id)
+        if end_id - synset_id == 1:
+            return np.asarray(postings[np.searchsorted(postings, start):np.searchsorted(postings, end)])
+        # The postings of the subtree are sorted per synset: filter them and merge
+        if start > 0 or end < len(self.caption_row):
+            postings = postings[(postings >= start) & (postings < end)]
+        return np.unique(postings)
+
+    def get_sample(self, caption_ind):
+        # The caption as a sample of its dataset (without the source)
+        sample = {'image_id': self.image_ids[self.caption_image[caption_ind]], 'caption': self.get_text('caption', caption_ind)}
+        if self.orig_present[caption_ind]:
+            sample['orig'] = self.get_text('orig', caption_ind)
+        if self.has_synsets[caption_ind]:
+            sample['synsets'] = [
+                [int(self.mention_start[i]), int(self.mention_end[i]), self.get_text('mention_phrase', i), self.synsets[self.mention_synset[i]], int(self.mention_dist[i])]
+                for i in range(self.mention_offsets[caption_ind], self.mention_offsets[caption_ind + 1])
+            ]
+        else:
+            sample['synsets'] = None
+        return sample
+
+    def get_caption_language(self, caption_ind):
+        return self.languages[self.caption_language[caption_ind]]
+
+mention_index = None
+
+def get_mention_index():
+    # Opened once per process, and built first if it's missing or outdated. Only languages with a processed dataset
+    #  are included
+    global mention_index
+    if mention_index is None:
+        languages = get_available_languages(langs)
+        index_path = os.path.join(mention_index_dir, 'index.json')
+        up_to_date = False
+        if os.path.isfile(index_path):
+            with open(index_path, 'r') as fp:
+                up_to_date = is_up_to_date(json.load(fp), languages)
+        if not up_to_date:
+            build_mention_index(languages)
+        mention_index = MentionIndex()
+    return mention_index
+
+if __name__ == '__main__':
+    build_mention_index(get_available_languages(langs))
+    index = MentionIndex()
+    print(f'Built the mention index: {len(index.caption_row)} captions in {len(index.languages)} languages, {len(index.mention_synset)} mentions', flush=True)
@@ -0,0 +1,127 @@
+from collections import defaultdict
+import numpy as np
+
+class OntologyIndex:
+    ''' Interval index over the project ontology (a forest given by a child -> parent mapping).
+    Synsets are interned to ints in DFS preorder, so the descendants of a synset (including itself) are exactly the
+    ids in [id, exit[id]). Hyponym checks are then two comparisons, and subtrees are contiguous id ranges.
+    Synsets not in the index are only hyponyms of themselves.
+    '''
+    def __init__(self, child2parent, extra_synsets=()):
+        parent2children = defaultdict(list)
+        for child, parent in child2parent.items():
+            parent2children[parent].append(child)
+        nodes = set(child2parent).union(child2parent.values()).union(extra_synsets)
+        roots = sorted([x for x in nodes if x not in child2parent])
+
+        self.synsets = []
+        self.synset_to_id = {}
+        parent = []
+        depth = []
+        exit = []
+        # Iterative DFS, a None entry on the stack marks that the subtree of the node below it was fully visited
+        stack = []
+        for root in reversed(roots):
+            stack.append((root, -1, 0))
+        while len(stack) > 0:
+            synset, parent_id, cur_depth = stack.pop()
+            if synset is None:
+                exit[parent_id] = len(self.synsets)
+                continue
+            cur_id = len(self.synsets)
+            self.synsets.append(synset)
+            self.synset_to_id[synset] = cur_id
+            parent.append(parent_id)
+            depth.append(cur_depth)
+            exit.append(None)
+            stack.append((None, cur_id, None))
+            for child in sorted(parent2children[synset], reverse=True):
+                stack.append((child, cur_id, cur_depth + 1))
+        assert len(self.synsets) == len(nodes), 'The child -> parent mapping contains a cycle'
+
+        self._parent = parent
+        self._exit = exit
+        self.parent = np.array(parent, dtype=np.int32)
+        self.exit = np.array(exit, dtype=np.int32)
+        self.depth = np.array(depth, dtype=np.int32)
+        self.root = np.empty(len(self.synsets), dtype=np.int32)
+        for i in range(len(self.synsets)):
+            self.root[i] = i if parent[i] == -1 else self.root[parent[i]]
+        self._ancestor_closure = None
+
+    def __len__(self):
+        return len(self.synsets)
+
+    def get_id(self, synset):
+        return self.synset_to_id.get(synset, -1)
+
+    def to_ids(self, synsets):
+        return np.array([self.synset_to_id.get(synset, -1) for synset in synsets], dtype=np.int32)
+
+    def is_hyponym_of(self, synset1, synset2):
+        if synset1 == synset2:
+            return True
+        id1 = self.synset_to_id.get(synset1)
+        id2 = self.synset_to_id.get(synset2)
+        if id1 is None or id2 is None:
+            return False
+        return id2 <= id1 < self._exit[id2]
+
+    def ancestors(self, synset, include_self=False):
+        # The ancestors of a synset ordered from its parent up to the root
+        res = [synset] if include_self else []
+        cur_id = self.synset_to_id.get(synset)
+        if cur_id is None:
+            return res
+        cur_id = self._parent[cur_id]
+        while cur_id != -1:
+            res.append(self.synsets[cur_id])
+            cur_id = self._parent[cur_id]
+        return res
+
+    def descendants(self, synset, include_self=True):
+        cur_id = self.synset_to_id.get(synset)
+        if cur_id is None:
+            return [synset] if include_self else []
+        start_id = cur_id if include_self else cur_id + 1
+        return self.synsets[start_id:self._exit[cur_id]]
+
+    # Vectorized versions, working on arrays of synset ids. Synsets not in the index have the id -1 and are never
+    #  considered hyponyms of anything
+
+    def is_hyponym_of_ids(self, ids1, ids2):
+        ids1 = np.asarray(ids1)
+        ids2 = np.asarray(ids2)
+        known = (ids1 >= 0) & (ids2 >= 0)
+        exit = self.exit[np.where(ids2 >= 0, ids2, 0)]
+        return known & (ids2 <= ids1) & (ids1 < exit)
+
+    def root_ids(self, ids):
+        ids = np.asarray(ids)
+        return np.where(ids >= 0, self.root[np.where(ids >= 0, ids, 0)], -1)
+
+    def ancestor_ids(self, ids):
+        # A (len(ids), max depth + 1) matrix: row i lists ids[i] and then its ancestors, padded with -1
+        ids = np.asarray(ids, dtype=np.int32)
+        max_depth = int(self.depth.max()) if len(self) > 0 else 0
+        res = np.full((len(ids), max_depth + 1), -1, dtype=np.int32)
+        cur_ids = ids
+        for level in range(max_depth + 1):
+            res[:, level] = cur_ids
+            cur_ids = np.where(cur_ids >= 0, self.parent[np.where(cur_ids >= 0, cur_ids, 0)], -1)
+        return res
+
+    def descendant_range(self, synset_id):
+        return synset_id, int(self.exit[synset_id])
+
+    def ancestor_closure(self):
+        # A sparse (synset id, synset id) matrix with 1 where the column is the row synset or one of its ancestors, so
+        #  multiplying a (row, synset id) count matrix by it adds each synset's counts to its ancestors. Built once
+        if self._ancestor_closure is None:
+            from scipy.sparse import csr_matrix
+            ancestors = self.ancestor_ids(np.arange(len(self), dtype=np.int32))
+            rows, levels = np.nonzero(ancestors >= 0)
+            self._ancestor_closure = csr_matrix(
+                (np.ones(len(rows), dtype=np.int64), (rows, ancestors[rows, levels])), shape=(len(self), len(self))
+            )
+        return self._ancestor_closure
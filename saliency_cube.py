@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import numpy as np
+from utils import langs, data_dir, get_ontology, get_synset_to_image_prob
+from columnar_dataset import get_json_path
+from config import datasets_dir
+
+''' The saliency of each synset in each image in each language, materialized once into memory-mapped .npy files in
+datasets/saliency_cube/ so the analyses and the app don't recompute get_synset_to_image_prob:
+    counts.npy: uint16 (language, synset, image), the number of the image's captions in the language that mention the
+        synset
+    image_counts.npy: uint16 (language, image), the number of captions of the image in the language (with synsets)
+The saliency (the probabilities of get_synset_to_image_prob, 0 where there's no entry) is counts/image_counts. It's
+computed from the counts when it's read, which gives exactly the same float64 values without storing 8 bytes per entry.
+index.json lists the languages, synsets (sorted) and image ids (sorted) of the axes, and the size, modification time
+and hash of each input file (the xm3600 datasets, the ontology files and the image annotation). The cube is rebuilt
+when the languages or synsets change, or when the content of an input file changes.
+'''
+
+saliency_cube_dir = os.path.join(datasets_dir, 'saliency_cube')
+format_version = 2
+ontology_files = [os.path.join(data_dir, file_name) for file_name in ['phrase2synsets.json', 'implicit_synsets.json', 'synsets_c2p.json', 'xm3600_annotation.csv']]
+
+def get_available_languages(languages=langs):
+    # The languages whose processed dataset exists. The others are left out (with a message), so a missing dataset
+    #  doesn't prevent using the rest
+    missing = [lang for lang in languages if not os.path.isfile(get_json_path(f'xm3600_{lang}'))]
+    if len(missing) > 0:
+        print(f'No processed datasets for {missing}, skipping them (expected {get_json_path("xm3600_<language>")})', flush=True)
+    return [lang for lang in languages if lang not in missing]
+
+def get_language_ind(language_to_ind, language):
+    assert language in language_to_ind, f'No data for language {language}, {get_json_path(f"xm3600_{language}")} was missing when it was built'
+    return language_to_ind[language]
+
+def get_input_paths(languages):
+    return [get_json_path(f'xm3600_{lang}') for lang in languages] + ontology_files
+
+def get_file_hash(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def get_file_stamp(path, old_stamp=None):
+    # The hash is only recomputed if the size or the modification time changed
+    stat = os.stat(path)
+    if old_stamp is not None and old_stamp['size'] == stat.st_size and old_stamp['mtime_ns'] == stat.st_mtime_ns:
+        return old_stamp
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': get_file_hash(path)}
+
+def is_up_to_date(index, languages, synsets):
+    if index['version'] != format_version or index['languages'] != languages or index['synsets'] != synsets:
+        return False
+    input_paths = get_input_paths(languages)
+    if sorted(index['inputs']) != sorted(input_paths):
+        return False
+    for path in input_paths:
+        if not os.path.isfile(path):
+            return False
+        if get_file_stamp(path, index['inputs'][path])['sha256'] != index['inputs'][path]['sha256']:
+            return False
+    return True
+
+def build_saliency_cube(languages=langs):
+    synsets = sorted(get_ontology().all_synsets)
+    os.makedirs(saliency_cube_dir, exist_ok=True)
+    # The index is written last, so a partial build is never used
+    index_path = os.path.join(saliency_cube_dir, 'index.json')
+    if os.path.isfile(index_path):
+        os.remove(index_path)
+    inputs = {path: get_file_stamp(path) for path in get_input_paths(languages)}
+
+    lang_results = {}
+    image_ids = set()
+    for lang in languages:
+        lang_results[lang] = get_synset_to_image_prob(f'xm3600_{lang}')
+        image_ids.update(lang_results[lang][2])
+    image_ids = sorted(image_ids)
+    image_id_to_ind = {image_id: i for i, image_id in enumerate(image_ids)}
+    synset_to_ind = {synset: i for i, synset in enumerate(synsets)}
+
+    # Cubes of older versions also stored the saliency itself
+    if os.path.isfile(os.path.join(saliency_cube_dir, 'saliency.npy')):
+        os.remove(os.path.join(saliency_cube_dir, 'saliency.npy'))
+    shape = (len(languages), len(synsets), len(image_ids))
+    # A new memory mapped file is all zeros, so only the nonzero counts are written
+    counts = np.lib.format.open_memmap(os.path.join(saliency_cube_dir, 'counts.npy'), mode='w+', dtype=np.uint16, shape=shape)
+    image_counts = np.zeros((len(languages), len(image_ids)), dtype=np.uint16)
+    for i, lang in enumerate(languages):
+        _, synset_to_image_count, image_count = lang_results[lang]
+        assert max(image_count.values(), default=0) <= np.iinfo(np.uint16).max, f'Too many captions per image in {lang}'
+        for image_id, count in image_count.items():
+            image_counts[i, image_id_to_ind[image_id]] = count
+        entries = [
+            (synset_to_ind[synset], image_id_to_ind[image_id], count)
+            for synset, image_to_count in synset_to_image_count.items() for image_id, count in image_to_count.items()
+        ]
+        if len(entries) > 0:
+            synset_inds, image_inds, entry_counts = zip(*entries)
+            counts[i, list(synset_inds), list(image_inds)] = entry_counts
+    counts.flush()
+    np.save(os.path.join(saliency_cube_dir, 'image_counts.npy'), image_counts)
+    del counts
+
+    index = {
+        'version': format_version,
+        'languages': list(languages),
+        'synsets': synsets,
+        'image_ids': image_ids,
+        'inputs': inputs
+    }
+    with open(index_path, 'w') as fp:
+        fp.write(json.dumps(index))
+
+class SaliencyCube:
+    def __init__(self, dir_path=saliency_cube_dir):
+        with open(os.path.join(dir_path, 'index.json'), 'r') as fp:
+            index = json.load(fp)
+        self.languages = index['languages']
+        self.synsets = index['synsets']
+        self.image_ids = index['image_ids']
+        self.language_to_ind = {lang: i for i, lang in enumerate(self.languages)}
+        self.synset_to_ind = {synset: i for i, synset in enumerate(self.synsets)}
+        self.image_id_to_ind = {image_id: i for i, image_id in enumerate(self.image_ids)}
+        # Memory mapped, only the pages that are read are loaded
+        self.counts = np.load(os.path.join(dir_path, 'counts.npy'), mmap_mode='r')
+        self.image_counts = np.load(os.path.join(dir_path, 'image_counts.npy'))
+
+    @staticmethod
+    def to_saliency(counts, image_counts):
+        # counts/image_counts, with image_counts broadcast over the synsets. Images without captions have saliency 0
+        #  (their counts are 0 as well)
+        return np.divide(counts, image_counts, out=np.zeros(counts.shape, dtype=np.float64), where=image_counts > 0)
+
+    def get_matrix(self, languages=None, synsets=None):
+        # A (language, synset, image) array of the saliency of the given languages and synsets (by default, all)
+        lang_inds = list(range(len(self.languages))) if languages is None else [get_language_ind(self.language_to_ind, lang) for lang in languages]
+        synset_inds = range(len(self.synsets)) if synsets is None else [self.synset_to_ind[synset] for synset in synsets]
+        return self.to_saliency(self.counts[np.ix_(lang_inds, synset_inds)], self.image_counts[lang_inds][:, None, :])
+
+    def get_saliency(self, language, synset):
+        # The saliency of the synset in each image, as an array over image_ids
+        lang_ind = get_language_ind(self.language_to_ind, language)
+        return self.to_saliency(self.counts[lang_ind, self.synset_to_ind[synset]], self.image_counts[lang_ind])
+
+    def get_image_to_prob(self, language, synset):
+        # As get_synset_to_image_prob(...)[0][synset]: only the images where some caption mentions the synset
+        lang_ind = get_language_ind(self.language_to_ind, language)
+        synset_ind = self.synset_to_ind[synset]
+        image_inds = np.nonzero(self.counts[lang_ind, synset_ind])[0]
+        saliency = self.to_saliency(self.counts[lang_ind, synset_ind, image_inds], self.image_counts[lang_ind, image_inds])
+        return dict(zip([self.image_ids[k] for k in image_inds.tolist()], saliency.tolist()))
+
+    def get_language_image_ids(self, language):
+        # The images that have captions (with synsets) in the language
+        return [self.image_ids[k] for k in np.nonzero(self.image_counts[get_language_ind(self.language_to_ind, language)])[0].tolist()]
+
+saliency_cube = None
+
+def get_saliency_cube():
+    # Loaded once per process, and built first if it's missing or outdated. Only languages with a processed dataset
+    #  are included
+    global saliency_cube
+    if saliency_cube is None:
+        languages = get_available_languages(langs)
+        index_path = os.path.join(saliency_cube_dir, 'index.json')
+        up_to_date = False
+        if os.path.isfile(index_path):
+            with open(index_path, 'r') as fp:
+                up_to_date = is_up_to_date(json.load(fp), languages, sorted(get_ontology().all_synsets))
+        if not up_to_date:
+            build_saliency_cube(languages)
+        saliency_cube = SaliencyCube()
+    return saliency_cube
+
+if __name__ == '__main__':
+    build_saliency_cube(get_available_languages(langs))
+    cube = SaliencyCube()
+    print(f'Built the saliency cube: {len(cube.languages)} languages, {len(cube.synsets)} synsets, {len(cube.image_ids)} images', flush=True)
@@ -0,0 +1,245 @@
+import sys
+sys.path.append('.')
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import tempfile
+import time
+import find_synsets_in_captions
+from find_synsets_in_captions import SynsetExtractor, load_scorer, load_stanza_pipeline
+from lm_scorers import MaskedLMScorer
+from metrics import Metrics, stages
+from run_regression import get_percentile
+from utils import get_ontology
+from config import parse_batch_size, stanza_processors, package_dir, datasets_dir
+
+''' Stage-level benchmark of the extraction pipeline. Prefixes of several sizes of a fixed caption corpus, sampled from
+the xm3600 datasets, are run through the pipeline and the time of each stage is measured separately:
+    preprocess: the phrase rewrites
+    parse: Stanza
+    rules: the noun and word sense rules
+    wordnet: WordNet lookups (find_phrase_synsets)
+    lm: building and scoring the LM queries
+    postprocessing: complete_synsets
+    other: everything else (mostly the phrase identification loop)
+The stage times and the counters are those of the pipeline's instrumentation (see metrics.py).
+Each corpus is run three times: in batches (throughput and stage times), caption by caption (latency) and in batches
+under tracemalloc (peak Python memory, measured separately since tracing slows everything down). The report is saved
+as json, and --compare prints the differences between two reports (e.g., of two commits).
+The benchmark runs offline: Stanza models are loaded from a local directory (--stanza_dir), and the LM is either a
+local model directory, the prior scorer, or a tiny randomly initialized BERT built on the spot (the default).
+'''
+
+corpus_path = os.path.join(package_dir, 'benchmarks', 'corpora', 'xm3600.json')
+results_dir = os.path.join(package_dir, 'benchmarks', 'results')
+corpus_size = 5000
+corpus_sizes = [100, 1000, 5000]
+corpus_seed = 0
+warmup_caption_num = 10
+tiny_scorer_name = 'tiny'
+prior_scorer_name = 'prior'
+
+def sample_corpus(size=corpus_size, seed=corpus_seed):
+    # A seeded shuffle of all the xm3600 captions
+    captions = []
+    for file_path in sorted(glob.glob(os.path.join(datasets_dir, 'xm3600_*.json'))):
+        with open(file_path, 'r') as fp:
+            captions += [sample['caption'] for sample in json.load(fp)]
+    random.Random(seed).shuffle(captions)
+    return captions[:size]
+
+def load_corpora(sizes):
+    # The corpus is sampled once and saved, so later runs (and other commits) use the exact same captions. Each size is
+    #  a prefix of the corpus
+    if not os.path.isfile(corpus_path):
+        os.makedirs(os.path.dirname(corpus_path), exist_ok=True)
+        with open(corpus_path, 'w') as fp:
+            fp.write(json.dumps(sample_corpus(), indent=0))
+    with open(corpus_path, 'r') as fp:
+        captions = [caption.lower() for caption in json.load(fp)]
+    assert max(sizes) <= len(captions), f'The corpus has only {len(captions)} captions'
+    return {size: captions[:size] for size in sizes}
+
+def run_with_metrics(func, *args, trace_memory=False):
+    # Returns the metrics of func(*args)
+    find_synsets_in_captions.metrics = Metrics(trace_memory=trace_memory)
+    try:
+        func(*args)
+        return find_synsets_in_captions.metrics
+    finally:
+        find_synsets_in_captions.metrics = None
+
+def build_tiny_scorer(captions, seed=0):
+    # A randomly initialized small BERT with a word level vocabulary of the captions' words and the synsets'
+    #  representative phrases. Its choices are meaningless, but it runs the same code as a real masked LM
+    import torch
+    from transformers import BertConfig, BertForMaskedLM, BertTokenizerFast
+    from nltk.corpus import wordnet as wn
+    words = set()
+    for caption in captions:
+        words.update(re.findall(r'\w+|[^\w\s]', caption.lower()))
+    ontology = get_ontology()
+    words.update([wn.synset(synset).lemmas()[0].name() for synset in ontology.all_synsets])
+    for synset_to_repr_phrase in ontology.phrase2replace_str.values():
+        words.update(synset_to_repr_phrase.values())
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + sorted(words)
+    vocab_path = os.path.join(tempfile.mkdtemp(), 'vocab.txt')
+    with open(vocab_path, 'w') as fp:
+        fp.write('\n'.join(vocab))
+    tokenizer = BertTokenizerFast(vocab_path, do_lower_case=True)
+    torch.manual_seed(seed)
+    config = BertConfig(vocab_size=len(vocab), hidden_size=64, num_hidden_layers=2, num_attention_heads=2, intermediate_size=128)
+    lm = BertForMaskedLM(config).eval()
+    return MaskedLMScorer(tiny_scorer_name, lm=lm, tokenizer=tokenizer)
+
+def get_stage_report(metrics, caption_num):
+    return {stage: {'seconds': seconds, 'ms_per_caption': 1000*seconds/caption_num} for stage, seconds in metrics.stage_seconds.items()}
+
+def benchmark_corpus(extractor, captions, batch_size=parse_batch_size, trace_memory=True):
+    # The result cache would skip the pipeline, and the LM cache the LM stage
+    extractor.result_cache = None
+    extractor.lm_cache = None
+    report = {'caption_num': len(captions)}
+
+    # Throughput
+    t = time.perf_counter()
+    metrics = run_with_metrics(extractor.compute_synsets_batch, captions, batch_size)
+    elapsed = time.perf_counter() - t
+    report['batch'] = {
+        'seconds': elapsed,
+        'captions_per_sec': len(captions)/elapsed,
+        'stages': get_stage_report(metrics, len(captions)),
+        'counters': dict(metrics.counters)
+    }
+
+    # Latency
+    latencies = []
+    def run_one_by_one():
+        for caption in captions:
+            t = time.perf_counter()
+            extractor.compute_synsets(caption)
+            latencies.append(time.perf_counter() - t)
+    metrics = run_with_metrics(run_one_by_one)
+    latencies.sort()
+    report['single'] = {
+        'seconds': sum(latencies),
+        'captions_per_sec': len(captions)/sum(latencies),
+        'latency_mean': sum(latencies)/len(latencies),
+        'latency_p50': get_percentile(latencies, 50),
+        'latency_p99': get_percentile(latencies, 99),
+        'stages': get_stage_report(metrics, len(captions))
+    }
+
+    # Memory
+    if trace_memory:
+        metrics = run_with_metrics(extractor.compute_synsets_batch, captions, batch_size, trace_memory=True)
+        report['peak_python_mb'] = metrics.peak_memory/2**20
+    # ru_maxrss is in kilobytes on Linux. It's the peak of the whole process so far, so it can only grow with the corpora
+    report['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    return report
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark_pipeline(corpora, batch_size=parse_batch_size, trace_memory=True, **extractor_args):
+    ''' corpora maps a corpus name to its (lowercased) captions. extractor_args are passed to the SynsetExtractor, so
+    stand-in models may be given as nlp, lm, tokenizer or scorer. '''
+    extractor = SynsetExtractor(**extractor_args)
+    first_corpus = list(corpora.values())[0]
+    # Load the models before starting the timers
+    extractor.compute_synsets_batch(first_corpus[:warmup_caption_num], batch_size)
+    reports = {}
+    for corpus_name, captions in corpora.items():
+        print(f'Running corpus {corpus_name} ({len(captions)} captions)', flush=True)
+        reports[str(corpus_name)] = benchmark_corpus(extractor, captions, batch_size, trace_memory)
+    return {
+        'commit': get_commit(),
+        'scorer': extractor.scorer.name,
+        'stanza_processors': extractor.stanza_processors,
+        'batch_size': batch_size,
+        'corpora': reports
+    }
+
+def print_report(report):
+    for corpus_name, corpus_report in report['corpora'].items():
+        batch = corpus_report['batch']
+        single = corpus_report['single']
+        print(f'Corpus {corpus_name}: {batch["captions_per_sec"]:.1f} captions/sec in batches, {single["captions_per_sec"]:.1f} one by one, ' +
+              f'latency p50 {1000*single["latency_p50"]:.2f}ms, p99 {1000*single["latency_p99"]:.2f}ms, peak RSS {corpus_report["peak_rss_mb"]:.0f} MB' +
+              (f', peak Python memory {corpus_report["peak_python_mb"]:.0f} MB' if 'peak_python_mb' in corpus_report else ''))
+        for stage in stages:
+            print(f'\t{stage}: {batch["stages"][stage]["ms_per_caption"]:.3f} ms/caption in batches, {single["stages"][stage]["ms_per_caption"]:.3f} one by one')
+
+def get_ratio(old_val, new_val):
+    return f'{old_val/new_val:.2f}x' if new_val > 0 else '-'
+
+def compare_reports(old_report, new_report):
+    # Speedups are old time / new time, so values above 1 are improvements
+    print(f'Comparing {old_report["commit"]} (old) to {new_report["commit"]} (new)')
+    for corpus_name in old_report['corpora']:
+        if corpus_name not in new_report['corpora']:
+            continue
+        old = old_report['corpora'][corpus_name]
+        new = new_report['corpora'][corpus_name]
+        print(f'Corpus {corpus_name}:')
+        print(f'\tthroughput in batches: {old["batch"]["captions_per_sec"]:.1f} -> {new["batch"]["captions_per_sec"]:.1f} captions/sec ' +
+              f'({get_ratio(new["batch"]["captions_per_sec"], old["batch"]["captions_per_sec"])})')
+        for key in ['latency_p50', 'latency_p99']:
+            print(f'\t{key}: {1000*old["single"][key]:.2f} -> {1000*new["single"][key]:.2f} ms ({get_ratio(old["single"][key], new["single"][key])})')
+        for key in ['peak_rss_mb', 'peak_python_mb']:
+            if key in old and key in new:
+                print(f'\t{key}: {old[key]:.0f} -> {new[key]:.0f}')
+        for stage in stages:
+            old_ms = old['batch']['stages'][stage]['ms_per_caption']
+            new_ms = new['batch']['stages'][stage]['ms_per_caption']
+            print(f'\t{stage}: {old_ms:.3f} -> {new_ms:.3f} ms/caption ({get_ratio(old_ms, new_ms)})')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_captions', type=int, nargs='+', default=corpus_sizes, help=f'Run the first num_captions captions of the corpus, for each of these sizes (up to {corpus_size})')
+    parser.add_argument('--stanza_dir', default=None, help='Local directory of the Stanza models (by default, the Stanza default directory)')
+    parser.add_argument('--scorer', default=tiny_scorer_name,
+                        help=f'"{tiny_scorer_name}" for a tiny random BERT, "{prior_scorer_name}" for the prior scorer, or the path of a local masked LM')
+    parser.add_argument('--batch_size', type=int, default=parse_batch_size)
+    parser.add_argument('--no_memory', action='store_true', help='Skip the tracemalloc run')
+    parser.add_argument('--output', default=None, help=f'Path of the json report (by default, {results_dir}/<commit>.json)')
+    parser.add_argument('--compare', nargs=2, default=None, metavar=('OLD', 'NEW'), help='Compare two saved reports instead of running')
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        with open(args.compare[0], 'r') as fp:
+            old_report = json.load(fp)
+        with open(args.compare[1], 'r') as fp:
+            new_report = json.load(fp)
+        compare_reports(old_report, new_report)
+        sys.exit(0)
+
+    # Never reach for the network
+    os.environ['HF_HUB_OFFLINE'] = '1'
+    os.environ['TRANSFORMERS_OFFLINE'] = '1'
+    corpora = load_corpora(args.num_captions)
+    if args.scorer == tiny_scorer_name:
+        scorer = build_tiny_scorer(corpora[max(args.num_captions)])
+    elif args.scorer == prior_scorer_name:
+        scorer = load_scorer(prior_scorer_name)
+    else:
+        scorer = load_scorer('masked_lm', lm_name=args.scorer, device_name='cpu')
+    nlp = load_stanza_pipeline(stanza_processors, args.stanza_dir)
+
+    report = benchmark_pipeline(corpora, args.batch_size, not args.no_memory, nlp=nlp, scorer=scorer)
+    print_report(report)
+    output_path = args.output
+    if output_path is None:
+        os.makedirs(results_dir, exist_ok=True)
+        output_path = os.path.join(results_dir, f'{report["commit"] or "report"}.json')
+    with open(output_path, 'w') as fp:
+        fp.write(json.dumps(report, indent=4))
+    print(f'Saved the report to {output_path}')
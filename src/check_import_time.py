@@ -0,0 +1,55 @@
+import sys
+sys.path.append('.')
+import argparse
+import subprocess
+from config import utils_import_budget_ms
+
+''' Measure the time of importing a module (utils by default) in a fresh interpreter with python -X importtime, and
+check it against the budget in config.py. Also checks that importing utils, or the modules that read the ontology
+through it, doesn't load the ontology.
+'''
+
+def measure_import_time(module_name):
+    # Returns the cumulative import time of the module and the self time of each imported module, in ms
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module_name}'], capture_output=True, text=True, check=True)
+    total_ms = None
+    module_to_self_ms = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = [x.strip() for x in line[len('import time:'):].split('|')]
+        module_to_self_ms[name] = int(self_us)/1000
+        if name == module_name:
+            total_ms = int(cumulative_us)/1000
+    return total_ms, module_to_self_ms
+
+# Modules that read the ontology attributes where they're used, and so shouldn't load it on import
+ontology_user_modules = ['utils', 'find_synsets_in_captions', 'saliency_cube', 'mention_index']
+
+def ontology_loaded_on_import(module_name):
+    code = f"import sys; sys.path += ['.', 'src']; import {module_name}; import utils; " + \
+        'print(len(utils.ontologies) > 0 or any([x in vars(utils) for x in utils.ontology_attributes]))'
+    res = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    return res.stdout.strip() == 'True'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default='utils')
+    parser.add_argument('--repeats', type=int, default=5, help='The median of this many runs is reported')
+    parser.add_argument('--budget_ms', type=float, default=utils_import_budget_ms)
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest modules to list')
+    args = parser.parse_args()
+
+    runs = sorted([measure_import_time(args.module) for _ in range(args.repeats)], key=lambda x: x[0])
+    total_ms, module_to_self_ms = runs[len(runs)//2]
+    print(f'Importing {args.module}: {total_ms:.1f} ms (median of {args.repeats}), budget {args.budget_ms:.0f} ms')
+    print('Slowest modules (self time):')
+    for name, self_ms in sorted(module_to_self_ms.items(), key=lambda x: -x[1])[:args.top]:
+        print(f'\t{name}: {self_ms:.1f} ms')
+
+    failed = total_ms > args.budget_ms
+    for module_name in ontology_user_modules:
+        if ontology_loaded_on_import(module_name):
+            print(f'Importing {module_name} loaded the ontology')
+            failed = True
+    sys.exit(1 if failed else 0)
@@ -1,28 +1,123 @@
-import stanza
 from nltk.corpus import wordnet as wn
-import inflect
-from transformers import AutoModelForMaskedLM, AutoTokenizer
-import torch
-from torch import nn
+import functools
+import glob
+import hashlib
 import math
-from copy import deepcopy
-from utils import all_synsets,\
-    phrase2hypernym,\
-    phrase2synsets,\
-    is_hyponym_of,\
-    phrase2replace_str,\
-    non_synset_phrases,\
-    identical_synsets_mapping,\
-    non_inflect_strs
-
-nlp = stanza.Pipeline('en', tokenize_no_ssplit=True)
-inflect_engine = inflect.engine()
-bert_model = AutoModelForMaskedLM.from_pretrained('bert-large-uncased')
-device = torch.device('cuda')
-bert_model = bert_model.to(device)
-bert_model = bert_model.eval()
-tokenizer = AutoTokenizer.from_pretrained('bert-large-uncased')
-mask_str = '[MASK]'
+import os
+from contextlib import nullcontext
+from config import stanza_processors,\
+    parse_batch_size,\
+    lm_name,\
+    lm_batch_size,\
+    lm_device,\
+    lm_precision,\
+    lm_num_threads,\
+    lm_cache_path,\
+    lm_cache_max_entries,\
+    result_cache_path,\
+    result_cache_max_entries,\
+    lm_scorer,\
+    package_dir
+from sqlite_cache import SQLiteCache
+import utils
+# The ontology attributes are read as utils.<attribute> where they're used, so importing this module doesn't load the
+#  ontology
+from utils import is_hyponym_of, non_inflect_strs
+from phrase_rewriter import PhraseRewriter
+from rule_engine import RuleEngine
+from sentence import Sentence
+from lm_scorers import MaskedLMScorer, PriorScorer, mask_str
+
+# Stanza, torch and transformers are imported only when the models are first needed, so code that only uses the rules
+#  or the WordNet logic doesn't pay for them
+
+# Built from the ontology on first use
+phrase_rewriter = None
+rule_engine = None
+# When set to a DependencyRecorder, the (source, key) pairs of the data entries that the results depend on are recorded
+#  in it (used by src/incremental_regression.py). Lookups are recorded whether they find the key or not
+dependency_recorder = None
+# When set to a metrics.Metrics object, stage times and counters are recorded in it (opt-in instrumentation)
+metrics = None
+
+def get_phrase_rewriter():
+    global phrase_rewriter
+    if phrase_rewriter is None:
+        phrase_rewriter = PhraseRewriter(utils.phrase_rewrites)
+    return phrase_rewriter
+
+def get_rule_engine():
+    global rule_engine
+    if rule_engine is None:
+        rule_engine = RuleEngine(utils.token_rules)
+    return rule_engine
+
+class DependencyRecorder:
+    ''' Collects the dependencies of each caption. The pipeline sets the caption being computed before each of its
+    stages runs, so the dependencies of captions that are computed together in a batch are kept apart.
+    '''
+    def __init__(self):
+        self.caption_to_deps = {}
+        self.caption = None
+
+    def add(self, dep):
+        self.caption_to_deps.setdefault(self.caption, set()).add(dep)
+
+    def update(self, deps):
+        self.caption_to_deps.setdefault(self.caption, set()).update(deps)
+
+    def get_deps(self, caption):
+        return sorted(self.caption_to_deps.get(caption, []))
+
+def set_dependency_caption(caption):
+    if dependency_recorder is not None:
+        dependency_recorder.caption = caption
+
+def timed_stage(stage):
+    # The decorated function's time is counted in this stage of the metrics, if enabled
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if metrics is None:
+                return func(*args, **kwargs)
+            return metrics.timed(stage, func, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def capture_metrics():
+    return nullcontext() if metrics is None else metrics.capture()
+
+def load_stanza_pipeline(processors=stanza_processors, model_dir=None):
+    # With model_dir the models are loaded from this local directory, and nothing is downloaded
+    import stanza
+    if model_dir is None:
+        return stanza.Pipeline('en', processors=processors, tokenize_no_ssplit=True)
+    return stanza.Pipeline('en', dir=model_dir, processors=processors, tokenize_no_ssplit=True, download_method=None)
+
+# The code the results depend on, relative to the package (config.py includes the model settings)
+code_files = [
+    'config.py', 'utils.py', 'ontology.py', 'get_dataset.py', 'src/find_synsets_in_captions.py',
+    'src/phrase_rewriter.py', 'src/rule_engine.py', 'src/sentence.py', 'src/lm_scorers.py'
+]
+
+def get_fingerprint(settings):
+    # Hash of everything the results depend on: the data files, the code and the model settings
+    fingerprint = hashlib.sha256()
+    data_paths = sorted(glob.glob(os.path.join(utils.data_dir, '*.json')))
+    assert len(data_paths) > 0, f'No data files in {utils.data_dir}'
+    for file_path in data_paths + [os.path.join(package_dir, file_name) for file_name in code_files]:
+        fingerprint.update(os.path.relpath(file_path, package_dir).encode('utf-8'))
+        with open(file_path, 'rb') as fp:
+            fingerprint.update(fp.read())
+    for setting in settings:
+        fingerprint.update(str(setting).encode('utf-8'))
+    return fingerprint.hexdigest()[:16]
+
+def copy_result(res):
+    # Each caller gets its own copy, also when the result is shared by identical captions or comes from the cache
+    if res is None:
+        return None
+    return [tuple(x) for x in res]
 
 def get_synset_count(synset):
     count = 0
@@ -30,12 +125,28 @@ def get_synset_count(synset):
         count += lemma.count()
     return count
 
+def get_synset_name_count(synset_name):
+    return get_synset_count(wn.synset(synset_name))
+
+def load_scorer(scorer_name, lm_name=lm_name, device_name=lm_device, precision=lm_precision, num_threads=lm_num_threads):
+    # 'masked_lm': lm_name's masked LM, 'prior': the most frequent synset by WordNet counts (no model)
+    if scorer_name == 'prior':
+        return PriorScorer(get_synset_name_count)
+    elif scorer_name == 'masked_lm':
+        return MaskedLMScorer(lm_name, device_name, precision, num_threads)
+    else:
+        assert False, f'Unknown LM scorer {scorer_name}'
+
 def identify_synset(synset):
     # Identify whether the synset is in our subtree of the entire WordNet tree (or is a descendant of a node in our subtree)
-    if synset.name() in all_synsets:
+    if metrics is not None:
+        metrics.count('wordnet_synset_visits')
+    if synset.name() in utils.all_synsets:
         return [[synset.name(), 0]]
-    if synset.name() in identical_synsets_mapping:
-        return [[identical_synsets_mapping[synset.name()], 0]]
+    if dependency_recorder is not None:
+        dependency_recorder.add(('identical_synsets_mapping', synset.name()))
+    if synset.name() in utils.identical_synsets_mapping:
+        return [[utils.identical_synsets_mapping[synset.name()], 0]]
     identified_synsets = []
     hypernyms = synset.hypernyms()
     for hypernym in hypernyms:
@@ -45,26 +156,9 @@ def identify_synset(synset):
         identified_synsets += cur_identified_synsets
     return identified_synsets
 
-def find_phrase_synsets(phrase):
-    phrase = phrase.lower()
-
-    # First, preprocess: if in plural, convert to singular
-    if phrase not in non_inflect_strs and inflect_engine.singular_noun(phrase) != False and inflect_engine.singular_noun(phrase) != phrase:
-        singular_phrase = inflect_engine.singular_noun(phrase)
-        singular_phrase_synsets = find_preprocessed_phrase_synsets(singular_phrase)
-        if singular_phrase_synsets is not None and len(singular_phrase_synsets) > 0 and len([x for x in singular_phrase_synsets if x[0] is not None]) > 0:
-            return singular_phrase_synsets
-
-    # If ends with possessive s, remove and try
-    if phrase.endswith("'s"):
-        non_possessive_phrase = phrase[:-2]
-        non_possessive_phrase_synsets = find_preprocessed_phrase_synsets(non_possessive_phrase)
-        if non_possessive_phrase_synsets is not None and len(non_possessive_phrase_synsets) > 0 and len([x for x in non_possessive_phrase_synsets if x[0] is not None]) > 0:
-            return non_possessive_phrase_synsets
-
-    return find_preprocessed_phrase_synsets(phrase)
-
 def search_in_wordnet(phrase):
+    if metrics is not None:
+        metrics.count('wordnet_lookups')
     phrase_synsets = wn.synsets(phrase)
     phrase_synsets = [synset for synset in phrase_synsets if synset.pos() == 'n']
     identified_synsets = []
@@ -122,391 +216,79 @@ def find_preprocessed_phrase_synsets(phrase):
     3. WordNet: Search in the wordnet onthology
     '''
 
+    if dependency_recorder is not None:
+        dependency_recorder.update([('phrase2synsets', phrase), ('phrase2hypernym', phrase)])
     phrase_mappings = []
-    if phrase in phrase2synsets:
-        direct_synset_mapping = phrase2synsets[phrase]
+    if phrase in utils.phrase2synsets:
+        direct_synset_mapping = utils.phrase2synsets[phrase]
         phrase_mappings += [(x, 0) for x in direct_synset_mapping]
-    if phrase in phrase2hypernym:
-        hypernym_mapping = phrase2hypernym[phrase]
+    if phrase in utils.phrase2hypernym:
+        hypernym_mapping = utils.phrase2hypernym[phrase]
         phrase_mappings += hypernym_mapping
 
     if len(phrase_mappings) > 0:
         # 1. Known mappings
+        if metrics is not None:
+            metrics.count('handler.known_mapping')
         return phrase_mappings
-    elif phrase in non_synset_phrases:
+    if dependency_recorder is not None:
+        dependency_recorder.add(('non_synset_phrases', phrase))
+    if phrase in utils.non_synset_phrases:
         # Exact mismatch
+        if metrics is not None:
+            metrics.count('handler.non_synset_phrase')
         return [(None, 0)]
     else:
         # Wordnet
+        if dependency_recorder is not None:
+            dependency_recorder.add(('wordnet', phrase))
+        if metrics is not None:
+            metrics.count('handler.wordnet')
         return search_in_wordnet(phrase)
 
-def preprocess(token_list):
-    # Just solving some known issues
-    
-    # Replace phrases to make the parser's job easier
-    replace_dict = [
-        # 1. "olive green": olive is considered a noun
-        (['olive', 'green'], 'green'),
-        # 2. Lionfish: unite, otherwise we will identify a lion
-        (['lion', 'fish'], 'lionfish'),
-        # 3. Car park: replace, otherwise we will identify a car
-        (['car', 'park'], 'park')
-    ]
-
-    tokens = [x[0]['text'].lower() for x in token_list]
-    inds_in_orig_strs = [0]*len(replace_dict)
-    to_replace = []
-    for i in range(len(tokens)):
-        token = tokens[i]
-        for j in range(len(replace_dict)):
-            if token == replace_dict[j][0][inds_in_orig_strs[j]]:
-                inds_in_orig_strs[j] += 1
-                if inds_in_orig_strs[j] == len(replace_dict[j][0]):
-                    to_replace.append((i - len(replace_dict[j][0]) + 1, i + 1, replace_dict[j][1]))
-                    inds_in_orig_strs[j] = 0
-            else:
-                inds_in_orig_strs[j] = 0
-
-    if len(to_replace) > 0:
-        for start_ind, end_ind, new_str in to_replace:
-            tokens[start_ind] = new_str
-            tokens[start_ind+1:end_ind] = ['[BLANK]']*(end_ind-(start_ind+1))
-        tokens = [x for x in tokens if x != '[BLANK]']
-        preprocessed_sentence = ' '.join(tokens)
-        doc = nlp(preprocessed_sentence)
-        token_lists = [[x.to_dict() for x in y.tokens] for y in doc.sentences]
-        token_list = token_lists[0]
-
-    return token_list
-
-def get_probs_from_lm(text, returned_vals):
-    input = tokenizer(text, return_tensors='pt', truncation='longest_first').to(device)
-    mask_id = tokenizer.vocab[mask_str]
-    mask_ind = [i for i in range(input.input_ids.shape[1]) if input.input_ids[0, i] == mask_id][0]
-    output = bert_model(**input)
-    mask_logits = output.logits[0, mask_ind, :]
-    if returned_vals == 'logits':
-        return mask_logits
-    elif returned_vals == 'probs':
-        mask_probs = nn.functional.softmax(mask_logits, dim=0)
-        return mask_probs
-    else:
-        assert False
-
-def is_an_phrase(phrase):
-    inflected = inflect_engine.a(phrase)
-    return inflected.startswith('an')
-
-def choose_synset_with_lm(token_list, start_ind, end_ind, synset_list, selection_method='probs'):
-    synset_to_dist_from_match = {x[0]: x[1] for x in synset_list}
-    only_synset_list = [x[0] for x in synset_list]
-
-    before = [x[0]['text'].lower() for x in token_list[:start_ind]]
-    after = [x[0]['text'].lower() for x in token_list[end_ind:]]
-
-    orig_phrase = '_'.join([x[0]['text'] for x in token_list[start_ind:end_ind]])
-
-    if orig_phrase.endswith("'s"):
-        orig_phrase = orig_phrase[:-2]
-    
-    plural = False
-    if orig_phrase not in non_inflect_strs and inflect_engine.singular_noun(orig_phrase) != False and inflect_engine.singular_noun(orig_phrase) != orig_phrase:
-        orig_phrase = inflect_engine.singular_noun(orig_phrase)
-        plural = True
-    
-    if orig_phrase in phrase2replace_str:
-        synset_to_repr_phrase = deepcopy(phrase2replace_str[orig_phrase])
-    else:
-        synset_to_repr_phrase = {synset: wn.synset(synset).lemmas()[0].name() for synset in only_synset_list}
-    
-    # To prevent unwanted bias, check if we need to consider a/an
-    if len(before) > 0 and before[-1] in ['a', 'an']:
-        a_synsets = []
-        an_synsets = []
-        for synset in only_synset_list:
-            if is_an_phrase(synset_to_repr_phrase[synset]):
-                an_synsets.append(synset)
-            else:
-                a_synsets.append(synset)
-        a_text = ' '.join(before[:-1] + ['a', mask_str] + after)
-        a_probs = get_probs_from_lm(a_text, selection_method)
-        an_text = ' '.join(before[:-1] + ['an', mask_str] + after)
-        an_probs = get_probs_from_lm(an_text, selection_method)
-        prob_synset_list = [(a_probs, a_synsets), (an_probs, an_synsets)]
-    else:
-        text = ' '.join(before + [mask_str] + after)
-        probs = get_probs_from_lm(text, selection_method)
-        prob_synset_list = [(probs, only_synset_list)]
-
+def resolve_lm_query(lm_query):
+    # The candidate with the highest score. Exact ties go to the first candidate, so the choice is deterministic
     max_synset_prob = (-1)*math.inf
     synset_with_max_prob = None
-    for probs, synsets in prob_synset_list:
-        for synset in synsets:
-            repr_phrase = synset_to_repr_phrase[synset]
-            if repr_phrase not in tokenizer.vocab:
-                # For now, don't handle
-                continue
-            synset_id = tokenizer.vocab[repr_phrase]
-            synset_prob = probs[synset_id]
-            if synset_prob > max_synset_prob:
-                max_synset_prob = synset_prob
-                synset_with_max_prob = synset
+    for (_, synset, _), synset_prob in zip(lm_query['candidates'], lm_query['scores']):
+        if synset_prob > max_synset_prob:
+            max_synset_prob = synset_prob
+            synset_with_max_prob = synset
 
     if synset_with_max_prob is None:
         dist_from_match = 0
     else:
-        dist_from_match = synset_to_dist_from_match[synset_with_max_prob]
+        dist_from_match = lm_query['synset_to_dist_from_match'][synset_with_max_prob]
     return synset_with_max_prob, dist_from_match
 
-def is_subtree_first(token_list, ind):
+def is_subtree_first(sentence, ind):
     adjusted_ind = ind + 1
     subtree_first = True
     for cur_ind in range(ind):
         # Check if its an ancestor of ind
         inner_ind = cur_ind
         while True:
-            if token_list[inner_ind][0]['head'] == adjusted_ind:
+            if sentence.head[inner_ind] == adjusted_ind:
                 break
-            if token_list[inner_ind][0]['head'] > adjusted_ind or token_list[inner_ind][0]['head'] == 0:
+            if sentence.head[inner_ind] > adjusted_ind or sentence.head[inner_ind] == 0:
                 subtree_first = False
                 break
-            inner_ind = token_list[inner_ind][0]['head'] - 1
+            inner_ind = sentence.head[inner_ind] - 1
         if not subtree_first:
             break
     return subtree_first
 
-def has_determiner(token_list, ind):
-    return len([x for x in token_list if x[0]['head'] == ind+1 and x[0]['upos'] == 'DET']) > 0
-
-def top_handling(token_list, start_ind):
-    # Need to distinguish top as a preposition from the clothing
-    if len([
-            x for x in token_list if x[0]['head'] == start_ind+1 and
-            x[0]['upos'] == 'DET' and
-            x[0]['text'].lower() in ['a', 'an']
-        ]) > 0 and \
-        len([
-            x for x in token_list if x[0]['head'] == start_ind+1 and
-            x[0]['deprel'] == 'compound'
-        ]) == 0:
-        return [('top.n.10', 0)]
-    
-    return [(None, 0)]
-
-def water_handling(token_list, start_ind):
-    # If there's a "the" before (e.g., "A dolphin swimming in the water") it's the body of water meaning
-    if start_ind > 0 and token_list[start_ind - 1][0]['text'] == 'the':
-        return [('body_of_water.n.01', 0)]
-    
-    # If it's part of the phase "body of water" it's a body of water, otherwise let the llm handle it
-    if start_ind > 1 and token_list[start_ind - 2][0]['text'] == 'body' and token_list[start_ind - 1][0]['text'] == 'of':
-        return [('body_of_water.n.01', 0)]
-    
-    # Pool/pond is body of water
-    if start_ind > 1 and token_list[start_ind - 2][0]['text'] in ['pool', 'pools', 'pond', 'ponds'] and token_list[start_ind - 1][0]['text'] == 'of':
-        return [('body_of_water.n.01', 0)]
-    
-    # Bottle/glass is food
-    if start_ind > 1 and token_list[start_ind - 2][0]['text'] in ['bottle', 'bottles', 'glass', 'glasses'] and token_list[start_ind - 1][0]['text'] in ['of', 'with']:
-        return [('water.n.06', 0)]
-    
-     # Some post words is food
-    if start_ind < len(token_list) - 1 and token_list[start_ind + 1][0]['text'] in ['bottle', 'glass', 'bottles', 'glasses', 'cup', 'cups', 'dispenser']:
-        return [('water.n.06', 0)]
-    
-    # Some verbs is food
-    if start_ind > 0 and token_list[start_ind - 1][0]['text'] in ['steaming', 'drinking', 'drinks', 'mineral']:
-        return [('water.n.06', 0)]
-    
-    # Some post words is body of water
-    if start_ind < len(token_list) - 1 and token_list[start_ind + 1][0]['text'] in ['source', 'fountain', 'flowing', 'surface', 'channel', 'canal', 'channels', 'canals', 'stream']:
-        return [('body_of_water.n.01', 0)]
-    
-    # Some adjectives always mean the body of water meaning
-    if start_ind > 0 and token_list[start_ind - 1][0]['text'] in ['clear', 'shallow', 'greenish', 'bluish', 'blue', 'sea', 'open', 'lake', 'green', 'river', 'ocean']:
-        return [('body_of_water.n.01', 0)]
-    
-    # "on" before is body of water
-    if start_ind > 0 and token_list[start_ind - 1][0]['text'] == 'on':
-        return [('body_of_water.n.01', 0)]
-    
-    # Some post are actually nothing
-    if start_ind < len(token_list) - 1 and token_list[start_ind + 1][0]['text'] in ['slide']:
-        return [(None, 0)]
-    
-    return [('water.n.06', 0), ('body_of_water.n.01', 0)]
-
-def mount_handling(token_list, start_ind):
-    # Need to distinguish a name of a mountain from the object used to mount something to the wall
-    # If there's a determiner that is a direct child of the node, it is the object
-    if len([x for x in token_list if x[0]['head'] == start_ind + 1 and x[0]['upos'] == 'DET']) > 0:
-        return [(None, 0)]
-    
-    return [('mountain.n.01', 0)]
-
-def lemon_handling(token_list, start_ind):
-    if (start_ind < len(token_list) - 1 and token_list[start_ind + 1][0]['text'] == 'yellow') or \
-        (start_ind < len(token_list) - 2 and token_list[start_ind + 1][0]['text'] == '-' and token_list[start_ind + 2][0]['text'] == 'yellow'):
-        return [(None, 0)]
-    
-    return [('lemon.n.01', 0)]
-
-def knife_handling(token_list, start_ind):
-    if (start_ind > 1 and token_list[start_ind - 2][0]['text'] in ['fork', 'forks']) or \
-        (start_ind < len(token_list) - 2 and token_list[start_ind + 2][0]['text'] in ['fork', 'forks']):
-        return [('table_knife.n.01', 0)]
-    
-    return [('knife.n.02', 0), ('table_knife.n.01', 0)]
-
-def mixer_handling(token_list, start_ind):
-    if start_ind > 0 and token_list[start_ind - 1][0]['text'] in ['cement', 'concrete']:
-        return [(None, 0)]
-    
-    if start_ind < len(token_list) - 1 and token_list[start_ind + 1][0]['text'] in ['truck', 'trucks']:
-        return [(None, 0)]
-    
-    if start_ind > 0 and token_list[start_ind - 1][0]['text'] in ['music', 'sound', 'dj', 'audio']:
-        return [('electronic_equipment.n.01', 1)]
-    
-    return [('electronic_equipment.n.01', 1), ('kitchen_utensil.n.01', 1)]
-
-def preceding_word_handling_func(token_list, start_ind, preceding_words, synsets_if_applies, synsets_otherwise):
-    if start_ind > 0 and token_list[start_ind - 1][0]['text'] in preceding_words:
-        return synsets_if_applies
-    
-    return synsets_otherwise
-
-def succeeding_word_handling_func(token_list, start_ind, succeeding_words, synsets_if_applies, synsets_otherwise):
-    if start_ind < len(token_list) - 1 and token_list[start_ind + 1][0]['text'] in succeeding_words:
-        return synsets_if_applies
-    
-    return synsets_otherwise
-
-def preceding_succeeding_word_handling_func(token_list, start_ind, preceding_words, synsets_if_pro_applies, succeeding_words, synsets_if_succ_applies, synsets_otherwise):
-    if start_ind > 0 and token_list[start_ind - 1][0]['text'] in preceding_words:
-        return synsets_if_pro_applies
-    
-    if start_ind < len(token_list) - 1 and token_list[start_ind + 1][0]['text'] in succeeding_words:
-        return synsets_if_succ_applies
-    
-    return synsets_otherwise
-
-single_word_to_handling_func = {
-    'top': top_handling,
-    'tops': top_handling,
-    'mixer': mixer_handling,
-    'mixers': mixer_handling,
-    'couple': lambda token_list, start_ind: succeeding_word_handling_func(token_list, start_ind, ['of'], [(None, 0)], [('couple.n.01', 0)]),
-    'couples': lambda token_list, start_ind: succeeding_word_handling_func(token_list, start_ind, ['of'], [(None, 0)], [('couple.n.01', 0)]),
-    'pool': lambda token_list, start_ind: preceding_word_handling_func(token_list, start_ind, ['swimming'], [(None, 0)], [('pond.n.01', 0), ('pool.n.06', 0)]),
-    'water': water_handling,
-    'bed': lambda token_list, start_ind: preceding_word_handling_func(token_list, start_ind, ['flower', 'river'], [(None, 0)], [('bed.n.01', 0)]),
-    'beds': lambda token_list, start_ind: preceding_word_handling_func(token_list, start_ind, ['flower', 'river'], [(None, 0)], [('bed.n.01', 0)]),
-    'mount': mount_handling,
-    'wrap': lambda token_list, start_ind: preceding_word_handling_func(token_list, start_ind, ['plastic'], [(None, 0)], [('sandwich.n.01', 1)]),
-    'plate': lambda token_list, start_ind: preceding_word_handling_func(token_list, start_ind, ['number', 'license'], [(None, 0)], [('plate.n.04', 0), (None, 0)]),
-    'plates': lambda token_list, start_ind: preceding_word_handling_func(token_list, start_ind, ['number', 'license'], [(None, 0)], [('plate.n.04', 0)]),
-    'belt': lambda token_list, start_ind: preceding_word_handling_func(token_list, start_ind, ['conveyor'], [(None, 0)], [('belt.n.02', 0)]),
-    'lemon': lemon_handling,
-    'fighter': lambda token_list, start_ind: succeeding_word_handling_func(token_list, start_ind, ['jet', 'jets', 'plane', 'planes'], [('fighter.n.02', 0)], [('person.n.01', 1), ('fighter.n.02', 0)]),
-    'fighters': lambda token_list, start_ind: succeeding_word_handling_func(token_list, start_ind, ['jet', 'jets', 'plane', 'planes'], [('fighter.n.02', 0)], [('person.n.01', 1), ('fighter.n.02', 0)]),
-    'mouse': lambda token_list, start_ind: preceding_word_handling_func(token_list, start_ind, ['computer'], [(None, 0)], [('mouse.n.01', 0), (None, 0)]),
-    'processor': lambda token_list, start_ind: preceding_word_handling_func(token_list, start_ind, ['food'], [(None, 0)], [('electronic_equipment.n.01', 1)]),
-    'processors': lambda token_list, start_ind: preceding_word_handling_func(token_list, start_ind, ['food'], [(None, 0)], [('electronic_equipment.n.01', 1)]),
-    'player': lambda token_list, start_ind: preceding_word_handling_func(token_list, start_ind, ['audio', 'music', 'record', 'media', 'digital'], [(None, 0)], [('player.n.01', 0)]),
-    'willow': lambda token_list, start_ind: succeeding_word_handling_func(token_list, start_ind, ['house'], [(None, 0)], [('tree.n.01', 1)]),
-    'hand': lambda token_list, start_ind: preceding_word_handling_func(token_list, start_ind, ['second'], [(None, 0)], [('hand.n.01', 0)]),
-    'plant': lambda token_list, start_ind: preceding_word_handling_func(token_list, start_ind, ['power', 'industrial', 'treatment'], [('factory.n.01', 0)], [('plant.n.02', 0)]),
-    'plants': lambda token_list, start_ind: preceding_word_handling_func(token_list, start_ind, ['power', 'industrial'], [('factory.n.01', 0)], [('plant.n.02', 0)]),
-    'slide': lambda token_list, start_ind: preceding_succeeding_word_handling_func(token_list, start_ind, ['water'], [('plaything.n.01', 1)], ['projector'], [(None, 0)], [('plaything.n.01', 1), (None, 0)]),
-    'slides': lambda token_list, start_ind: preceding_succeeding_word_handling_func(token_list, start_ind, ['water'], [('plaything.n.01', 1)], ['projector'], [(None, 0)], [('plaything.n.01', 1), (None, 0)]),
-    'jam': lambda token_list, start_ind: preceding_word_handling_func(token_list, start_ind, ['traffic'], [(None, 0)], [('nutriment.n.01', 5)]),
-    'jams': lambda token_list, start_ind: preceding_word_handling_func(token_list, start_ind, ['traffic'], [(None, 0)], [('nutriment.n.01', 5)]),
-    'hip': lambda token_list, start_ind: succeeding_word_handling_func(token_list, start_ind, ['hop'], [(None, 0)], [('body_part.n.01', 1)]),
-    'knife': knife_handling,
-    'knives': knife_handling,
-    'leg': lambda token_list, start_ind: preceding_word_handling_func(token_list, start_ind, ['wooden', 'metal', 'iron'], [(None, 0)], [('leg.n.01', 0)]),
-    'legs': lambda token_list, start_ind: preceding_word_handling_func(token_list, start_ind, ['wooden', 'metal', 'iron'], [(None, 0)], [('leg.n.01', 0)]),
-    'palm': lambda token_list, start_ind: succeeding_word_handling_func(token_list, start_ind, ['tree', 'trees', 'leaf', 'leaves', 'fruit', 'fruits', 'branch', 'branches'], [('palm.n.03', 2)], [('body_part.n.01', 0)]),
-    'head': lambda token_list, start_ind: preceding_word_handling_func(token_list, start_ind, ['shower'], [(None, 0)], [('head.n.01', 0)]),
-}
-
-def phrase_location_to_synset(token_list, start_ind, end_ind):
-    phrase = ' '.join([token_list[i][0]['text'] for i in range(start_ind, end_ind)]).lower()
-
-    if end_ind - start_ind == 1 and token_list[start_ind][0]['text'] in single_word_to_handling_func:
-        synsets = single_word_to_handling_func[token_list[start_ind][0]['text']](token_list, start_ind)
-
-    else:
-        synsets = find_phrase_synsets(phrase)
-
-    if len(synsets) > 1:
-        synset, dist_from_match = choose_synset_with_lm(token_list, start_ind, end_ind, synsets)
-    else:
-        synset, dist_from_match = synsets[0]
+def has_determiner(sentence, ind):
+    return len([x for x in sentence.children[ind] if sentence.upos[x] == 'DET']) > 0
 
-    return synset, dist_from_match
+def is_noun(sentence, ind):
+    return get_rule_engine().analyze(sentence).is_noun(ind)
 
-def is_noun(token_list, ind):
-    head_ind = token_list[ind][0]['head'] - 1
-
-    if token_list[ind][0]['upos'] == 'NOUN':
-        # VBN edge cases: If we have a noun with a VBN parent (e.g., "flower-covered") the entire phrase is not a noun
-        if token_list[head_ind][0]['xpos'] == 'VBN' and token_list[ind][0]['deprel'] == 'compound':
-            return False
-        
-        # "mini" edge case: when used as an adjective parser may call it a noun compound
-        if token_list[ind][0]['text'] == 'mini' and token_list[ind][0]['deprel'] == 'compound':
-            return False
-        
-        # uniform edge case: if the word "uniform" follows (e.g., "nurse uniform") this is not a noun
-        if ind < len(token_list) - 1 and token_list[ind+1][0]['text'] == 'uniform':
-            return False
-        
-        # glass edge case: if the word "glass" is followed by a noun (e.g., "glass door") this is not a noun
-        if token_list[ind][0]['text'] == 'glass' and ind < len(token_list) - 1 and token_list[ind+1][0]['upos'] == 'NOUN':
-            return False
-        
-        # tooth/teeth edge case: if the word "teeth"/"tooth" follows (e.g., "animal teeth") this is not a noun
-        if ind < len(token_list) - 1 and token_list[ind+1][0]['text'] in ['teeth', 'tooth']:
-            return False
-        
-        return True
-    
-    # "remote" edge cases: in many cases, when people say "remote" they mean "remote controller", i.e., a noun. But the
-    #  parser treats it as an adjective. To identify these cases, we'll find "remote" with non-noun heads
-    if token_list[ind][0]['text'].lower() == 'remote' and token_list[head_ind][0]['upos'] != 'NOUN':
-        return True
-    
-    # "baked goods" edge case: baked is considered adjective, but both should be considered a noun together
-    if token_list[ind][0]['text'] == 'baked' and ind < (len(token_list) - 1) and token_list[ind+1][0]['text'] == 'goods':
-        return True
-    
-    # "orange slices" edge case: orange is considered adjective, but both should be considered a noun together
-    if token_list[ind][0]['text'] == 'orange' and ind < (len(token_list) - 1) and token_list[ind+1][0]['text'] in ['slice', 'slices']:
-        return True
-    
-    # "german shepherd" edge case: german is considered adjective, but both should be considered a noun together
-    if token_list[ind][0]['text'] == 'german' and ind < (len(token_list) - 1) and token_list[ind+1][0]['text'] == 'shepherd':
-        return True
-    
-    # pad thai edge case: if the word "thai" follows pad it's not a verb
-    if token_list[ind][0]['text'] == 'pad' and ind < (len(token_list) - 1) and token_list[ind+1][0]['text'] == 'thai':
-        return True
-    
-    # hot dog: hot is not an adjective
-    if token_list[ind][0]['text'] == 'hot' and ind < (len(token_list) - 1) and token_list[ind+1][0]['text'] in ['dog', 'dogs']:
-        return True
-    
-    # rolling pin: rolling is a noun
-    if token_list[ind][0]['text'] == 'rolling' and ind < (len(token_list) - 1) and token_list[ind+1][0]['text'] in ['pin', 'pins']:
-        return True
-    
-    return False
-
-def post_traverse_handling(token_list, start_ind, end_ind, synsets):
-    if end_ind - start_ind == 1 and token_list[start_ind][0]['text'] == 'architecture':
+def post_traverse_handling(sentence, start_ind, end_ind, synsets):
+    if end_ind - start_ind == 1 and sentence.text[start_ind] == 'architecture':
         # The word 'architecture' will be considered a building only if no other building was mentioned in the sentence
+        if metrics is not None:
+            metrics.count('handler.architecture')
         if len([synset for synset in synsets if is_hyponym_of(synset[3], 'building.n.01')]) == 0:
             return 'architecture.n.01', 0
         else:
@@ -530,6 +312,8 @@ def postprocessing(synsets):
             else:
                 break
             found_subseqent = True
+            if metrics is not None:
+                metrics.count('handler.subsequent_hyponyms')
             final_synsets = final_synsets[:-1]
             final_synsets.append((prev_sample[0], sample[1], hyponym[2], hyponym[3], hyponym[4]))
             break
@@ -540,63 +324,493 @@ def postprocessing(synsets):
 
     return final_synsets
 
-def find_synsets(caption):
-    caption = caption.lower()
-    doc = nlp(caption)
-    token_lists = [[x.to_dict() for x in y.tokens] for y in doc.sentences]
-    if len(token_lists) > 1:
-        return None
-    token_list = token_lists[0]
-    token_list = preprocess(token_list)
-
-    synsets = []
-
-    identified_inds = set()
-    # Two word phrases
-    i = 0
-    while i < len(token_list)-1:
-        start_ind = i
-        end_ind = i+2
-        synset = None
-        if is_noun(token_list, i) and is_noun(token_list, i+1):
-            synset, dist_from_match = phrase_location_to_synset(token_list, start_ind, end_ind)
-        if synset is not None:
-            phrase = ' '.join([token_list[i][0]['text'] for i in range(start_ind, end_ind)]).lower()
-            synsets.append((start_ind, end_ind, phrase, synset, dist_from_match))
-            identified_inds.add(start_ind)
-            identified_inds.add(start_ind+1)
-            i += 2
-        else:
-            i += 1
-
-    # Single word phrases
-    for i in range(len(token_list)):
-        if i in identified_inds:
-            continue
-        start_ind = i
-        end_ind = i+1
-        synset = None
-        if is_noun(token_list, i):
-            synset, dist_from_match = phrase_location_to_synset(token_list, start_ind, end_ind)
-        if synset is not None:
-            phrase = ' '.join([token_list[i][0]['text'] for i in range(start_ind, end_ind)]).lower()
-            synsets.append((start_ind, end_ind, phrase, synset, dist_from_match))
-            identified_inds.add(start_ind)
+def complete_synsets(sentence, synsets, sentence_rules=None):
+    # Resolve deferred LM queries
+    synsets = [x[:3] + resolve_lm_query(x[3]) if isinstance(x[3], dict) else x for x in synsets]
+    identified_inds = set([i for x in synsets for i in range(x[0], x[1])])
+    if sentence_rules is None:
+        sentence_rules = get_rule_engine().analyze(sentence)
 
     # Phrases that require handling only once other synsets were identified
-    for i in range(len(token_list)):
+    for i in range(len(sentence)):
         if i in identified_inds:
             continue
         start_ind = i
         end_ind = i+1
         synset = None
-        if is_noun(token_list, i):
-            synset, dist_from_match = post_traverse_handling(token_list, start_ind, end_ind, synsets)
+        if sentence_rules.is_noun(i):
+            synset, dist_from_match = post_traverse_handling(sentence, start_ind, end_ind, synsets)
         if synset is not None:
-            phrase = ' '.join([token_list[i][0]['text'] for i in range(start_ind, end_ind)]).lower()
+            phrase = sentence.phrase(start_ind, end_ind)
             synsets.append((start_ind, end_ind, phrase, synset, dist_from_match))
             identified_inds.add(start_ind)
 
     synsets = postprocessing(synsets)
     
     return synsets
+
+class SynsetExtractor:
+    ''' Identifies the synsets mentioned in captions.
+    The Stanza pipeline, the masked LM with its tokenizer and the inflect engine are loaded on first use. Each of them
+    may also be passed to the constructor instead (e.g., small stand-in models in tests).
+    Ambiguous mentions are resolved by scorer (see lm_scorers.py). By default this is a MaskedLMScorer of lm_name, built
+    from lm, tokenizer, device_name, precision and num_threads.
+    lm_cache is an optional SQLiteCache of LM scores, so re-runs only score texts that weren't scored before.
+    result_cache is an optional SQLiteCache of find_synsets results, keyed by the lowercased caption and a fingerprint
+    of the rules, the data files and the models, so any change to these invalidates it.
+    '''
+    def __init__(self, nlp=None, lm=None, tokenizer=None, inflect_engine=None,
+                 lm_name=lm_name, device_name=lm_device, precision=lm_precision, num_threads=lm_num_threads,
+                 stanza_processors=stanza_processors, lm_cache=None, result_cache=None, scorer=None, lm_batch_size=lm_batch_size):
+        self.lm_cache = lm_cache
+        self.result_cache = result_cache
+        self.dedup_count = 0
+        self._fingerprint = None
+        self._nlp = nlp
+        self._inflect_engine = inflect_engine
+        if scorer is None:
+            scorer = MaskedLMScorer(lm_name, device_name, precision, num_threads, lm=lm, tokenizer=tokenizer)
+        self.scorer = scorer
+        self.stanza_processors = stanza_processors
+        # Texts per LM forward pass when scoring ambiguous mentions
+        self.lm_batch_size = lm_batch_size
+
+    @property
+    def nlp(self):
+        if self._nlp is None:
+            self._nlp = load_stanza_pipeline(self.stanza_processors)
+        return self._nlp
+
+    # The masked LM scorer's models
+
+    @property
+    def lm(self):
+        return self.scorer.lm
+
+    @property
+    def tokenizer(self):
+        return self.scorer.tokenizer
+
+    @property
+    def inflect_engine(self):
+        if self._inflect_engine is None:
+            import inflect
+            self._inflect_engine = inflect.engine()
+        return self._inflect_engine
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = get_fingerprint([self.scorer.name, self.scorer.cache_id, self.stanza_processors])
+        return self._fingerprint
+
+    def configure_lm(self, device_name=lm_device, precision=lm_precision, num_threads=lm_num_threads):
+        self.scorer.configure(device_name, precision, num_threads)
+        self._fingerprint = None
+
+    @timed_stage('wordnet')
+    def find_phrase_synsets(self, phrase):
+        phrase = phrase.lower()
+
+        # First, preprocess: if in plural, convert to singular
+        if phrase not in non_inflect_strs and self.inflect_engine.singular_noun(phrase) != False and self.inflect_engine.singular_noun(phrase) != phrase:
+            singular_phrase = self.inflect_engine.singular_noun(phrase)
+            singular_phrase_synsets = find_preprocessed_phrase_synsets(singular_phrase)
+            if singular_phrase_synsets is not None and len(singular_phrase_synsets) > 0 and len([x for x in singular_phrase_synsets if x[0] is not None]) > 0:
+                if metrics is not None:
+                    metrics.count('handler.singular')
+                return singular_phrase_synsets
+
+        # If ends with possessive s, remove and try
+        if phrase.endswith("'s"):
+            non_possessive_phrase = phrase[:-2]
+            non_possessive_phrase_synsets = find_preprocessed_phrase_synsets(non_possessive_phrase)
+            if non_possessive_phrase_synsets is not None and len(non_possessive_phrase_synsets) > 0 and len([x for x in non_possessive_phrase_synsets if x[0] is not None]) > 0:
+                if metrics is not None:
+                    metrics.count('handler.possessive')
+                return non_possessive_phrase_synsets
+
+        return find_preprocessed_phrase_synsets(phrase)
+
+    def doc_to_sentence(self, doc):
+        if len(doc.sentences) > 1:
+            return None
+        return Sentence.from_stanza(doc.sentences[0])
+
+    def identify_phrases(self, sentence, lm_queries=None, sentence_rules=None):
+        # A generator: yields LM queries whose result is needed to continue (see self.run_lm_rounds) and returns the synsets
+        if sentence_rules is None:
+            sentence_rules = get_rule_engine().analyze(sentence)
+        synsets = []
+
+        identified_inds = set()
+        # Two word phrases
+        i = 0
+        while i < len(sentence)-1:
+            start_ind = i
+            end_ind = i+2
+            synset = None
+            if sentence_rules.is_noun(i) and sentence_rules.is_noun(i+1):
+                synset, dist_from_match = yield from self.phrase_location_to_synset(sentence, start_ind, end_ind, lm_queries, sentence_rules)
+            if synset is not None:
+                phrase = sentence.phrase(start_ind, end_ind)
+                synsets.append((start_ind, end_ind, phrase, synset, dist_from_match))
+                identified_inds.add(start_ind)
+                identified_inds.add(start_ind+1)
+                i += 2
+            else:
+                i += 1
+
+        # Single word phrases
+        for i in range(len(sentence)):
+            if i in identified_inds:
+                continue
+            start_ind = i
+            end_ind = i+1
+            synset = None
+            if sentence_rules.is_noun(i):
+                synset, dist_from_match = yield from self.phrase_location_to_synset(sentence, start_ind, end_ind, lm_queries, sentence_rules)
+            if synset is not None:
+                phrase = sentence.phrase(start_ind, end_ind)
+                synsets.append((start_ind, end_ind, phrase, synset, dist_from_match))
+                identified_inds.add(start_ind)
+
+        return synsets
+
+    def get_probs_from_lm(self, text, returned_vals):
+        return self.scorer.get_mask_scores(text, returned_vals)
+
+    def is_an_phrase(self, phrase):
+        inflected = self.inflect_engine.a(phrase)
+        return inflected.startswith('an')
+
+    @timed_stage('lm')
+    def build_lm_query(self, sentence, start_ind, end_ind, synset_list):
+        # Build the masked texts for choosing between the synsets in synset_list, and the (text index, synset, candidate
+        #  key) candidates the scorer scores for each text
+        synset_to_dist_from_match = {x[0]: x[1] for x in synset_list}
+        only_synset_list = [x[0] for x in synset_list]
+
+        before = sentence.lower[:start_ind]
+        after = sentence.lower[end_ind:]
+
+        orig_phrase = '_'.join(sentence.text[start_ind:end_ind])
+
+        if orig_phrase.endswith("'s"):
+            orig_phrase = orig_phrase[:-2]
+        
+        if orig_phrase not in non_inflect_strs and self.inflect_engine.singular_noun(orig_phrase) != False and self.inflect_engine.singular_noun(orig_phrase) != orig_phrase:
+            orig_phrase = self.inflect_engine.singular_noun(orig_phrase)
+        
+        if dependency_recorder is not None:
+            dependency_recorder.add(('phrase2replace_str', orig_phrase))
+        if orig_phrase in utils.phrase2replace_str:
+            synset_to_repr_phrase = dict(utils.phrase2replace_str[orig_phrase])
+        else:
+            synset_to_repr_phrase = {synset: wn.synset(synset).lemmas()[0].name() for synset in only_synset_list}
+        
+        # To prevent unwanted bias, check if we need to consider a/an
+        if len(before) > 0 and before[-1] in ['a', 'an']:
+            a_synsets = []
+            an_synsets = []
+            for synset in only_synset_list:
+                if self.is_an_phrase(synset_to_repr_phrase[synset]):
+                    an_synsets.append(synset)
+                else:
+                    a_synsets.append(synset)
+            a_text = ' '.join(before[:-1] + ['a', mask_str] + after)
+            an_text = ' '.join(before[:-1] + ['an', mask_str] + after)
+            texts = [a_text, an_text]
+            text_synset_list = [a_synsets, an_synsets]
+            if metrics is not None:
+                metrics.count('lm_an_queries')
+        else:
+            text = ' '.join(before + [mask_str] + after)
+            texts = [text]
+            text_synset_list = [only_synset_list]
+
+        candidates = []
+        for text_ind, synsets in enumerate(text_synset_list):
+            for synset in synsets:
+                candidate_key = self.scorer.candidate_key(synset, synset_to_repr_phrase[synset])
+                if candidate_key is None:
+                    # For now, don't handle
+                    continue
+                candidates.append((text_ind, synset, candidate_key))
+
+        if metrics is not None:
+            metrics.count('lm_queries')
+        return {
+            'texts': texts,
+            'candidates': candidates,
+            'synset_to_dist_from_match': synset_to_dist_from_match,
+            'scores': None
+        }
+
+    @timed_stage('lm')
+    def score_lm_queries(self, lm_queries, selection_method='probs', batch_size=None):
+        # Score the candidates of all the queries together (batch_size texts per forward pass, self.lm_batch_size by
+        #  default). Scores of previous runs are taken from the LM cache
+        if batch_size is None:
+            batch_size = self.lm_batch_size
+        texts = []
+        text_to_candidate_keys = []
+        for query in lm_queries:
+            query_text_start = len(texts)
+            texts += query['texts']
+            text_to_candidate_keys += [[] for _ in query['texts']]
+            for text_ind, _, candidate_key in query['candidates']:
+                text_to_candidate_keys[query_text_start + text_ind].append(candidate_key)
+        # Texts without candidates don't need a forward pass
+        to_score = [i for i in range(len(texts)) if len(text_to_candidate_keys[i]) > 0]
+
+        text_scores = {}
+        use_cache = self.lm_cache is not None and self.scorer.cache_id is not None
+        if use_cache and len(to_score) > 0:
+            cache_keys = {
+                (i, candidate_key): self.get_lm_cache_key(texts[i], candidate_key, selection_method)
+                for i in to_score for candidate_key in text_to_candidate_keys[i]
+            }
+            cached_scores = self.lm_cache.get_many(list(set(cache_keys.values())))
+            not_cached = []
+            for i in to_score:
+                cur_keys = [cache_keys[(i, candidate_key)] for candidate_key in text_to_candidate_keys[i]]
+                if all([key in cached_scores for key in cur_keys]):
+                    text_scores[i] = [cached_scores[key] for key in cur_keys]
+                else:
+                    not_cached.append(i)
+            to_score = not_cached
+            if metrics is not None:
+                metrics.count('lm_cache_hits', len(text_scores))
+
+        if len(to_score) > 0:
+            if metrics is not None:
+                metrics.count('lm_calls')
+                metrics.count('lm_scored_texts', len(to_score))
+            lm_scores = self.scorer.score([texts[i] for i in to_score], [text_to_candidate_keys[i] for i in to_score], selection_method, batch_size)
+            for i, cur_scores in zip(to_score, lm_scores):
+                text_scores[i] = cur_scores
+            if use_cache:
+                self.lm_cache.put_many([
+                    (self.get_lm_cache_key(texts[i], candidate_key, selection_method), score)
+                    for i in to_score for candidate_key, score in zip(text_to_candidate_keys[i], text_scores[i])
+                ])
+
+        text_start = 0
+        for query in lm_queries:
+            # Candidates of each text are stored in order, so we can consume the text scores one by one
+            consumed = [0]*len(query['texts'])
+            query['scores'] = []
+            for text_ind, _, _ in query['candidates']:
+                query['scores'].append(text_scores[text_start + text_ind][consumed[text_ind]])
+                consumed[text_ind] += 1
+            text_start += len(query['texts'])
+
+    def get_lm_cache_key(self, text, candidate_key, selection_method):
+        return f'{self.scorer.cache_id}|{selection_method}|{candidate_key}|{text}'
+
+    def choose_synset_with_lm(self, sentence, start_ind, end_ind, synset_list, selection_method='probs'):
+        lm_query = self.build_lm_query(sentence, start_ind, end_ind, synset_list)
+        self.score_lm_queries([lm_query], selection_method)
+        return resolve_lm_query(lm_query)
+
+    def phrase_location_to_synset(self, sentence, start_ind, end_ind, lm_queries=None, sentence_rules=None):
+        phrase = sentence.phrase(start_ind, end_ind)
+        if sentence_rules is None:
+            sentence_rules = get_rule_engine().analyze(sentence)
+
+        if end_ind - start_ind == 1 and dependency_recorder is not None:
+            dependency_recorder.add(('word_senses', sentence.text[start_ind]))
+        if end_ind - start_ind == 1 and sentence_rules.has_word_senses(start_ind):
+            synsets = sentence_rules.word_senses(start_ind)
+
+        else:
+            synsets = self.find_phrase_synsets(phrase)
+
+        if len(synsets) > 1:
+            lm_query = self.build_lm_query(sentence, start_ind, end_ind, synsets)
+            if lm_queries is not None and None not in [x[1] for x in lm_query['candidates']]:
+                # Deferred LM: the query is returned in place of the synset and resolved once all the queries in the batch
+                #  were scored. Without a None candidate we already know whether a synset will be chosen
+                if len(lm_query['candidates']) == 0:
+                    synset, dist_from_match = None, 0
+                else:
+                    lm_queries.append(lm_query)
+                    synset, dist_from_match = lm_query, 0
+            else:
+                # The choice affects which phrases are identified next, so we need the result before we continue
+                synset, dist_from_match = yield lm_query
+        else:
+            synset, dist_from_match = synsets[0]
+
+        return synset, dist_from_match
+
+    def record_caption_dependencies(self, caption, phrase_identifier):
+        # Wraps an identify_phrases generator, so its lookups are recorded as the caption's whenever it runs
+        lm_result = None
+        while True:
+            set_dependency_caption(caption)
+            try:
+                lm_query = phrase_identifier.send(lm_result)
+            except StopIteration as e:
+                return e.value
+            lm_result = yield lm_query
+
+    def run_lm_rounds(self, phrase_identifiers, selection_method='probs'):
+        # Run self.identify_phrases generators side by side, scoring the LM queries they yield in each round together
+        results = [None]*len(phrase_identifiers)
+        to_send = {i: None for i in range(len(phrase_identifiers))}
+        while len(to_send) > 0:
+            lm_queries = {}
+            for i, lm_result in to_send.items():
+                try:
+                    lm_queries[i] = phrase_identifiers[i].send(lm_result)
+                except StopIteration as e:
+                    results[i] = e.value
+            self.score_lm_queries(list(lm_queries.values()), selection_method)
+            to_send = {i: resolve_lm_query(lm_query) for i, lm_query in lm_queries.items()}
+        return results
+
+    def find_synsets(self, caption):
+        caption = caption.lower()
+        caption_to_res = self.get_cached_results([caption])
+        if caption in caption_to_res:
+            self.dedup_count += 1
+            if metrics is not None:
+                metrics.count('result_cache_hits')
+            return copy_result(caption_to_res[caption])
+        res = self.compute_synsets(caption)
+        self.cache_results({caption: res})
+        return res
+
+    def find_synsets_batch(self, captions, batch_size=parse_batch_size, defer_lm=True):
+        # The result only depends on the lowercased caption, so identical captions are computed once, and results of
+        #  previous runs are taken from the result cache
+        captions = [caption.lower() for caption in captions]
+        unique_captions = list(dict.fromkeys(captions))
+        caption_to_res = self.get_cached_results(unique_captions)
+        to_compute = [caption for caption in unique_captions if caption not in caption_to_res]
+        if metrics is not None:
+            metrics.count('result_cache_hits', len(caption_to_res))
+            metrics.count('duplicate_captions', len(captions) - len(unique_captions))
+        computed = dict(zip(to_compute, self.compute_synsets_batch(to_compute, batch_size, defer_lm)))
+        self.cache_results(computed)
+        caption_to_res.update(computed)
+        self.dedup_count += len(captions) - len(to_compute)
+        return [copy_result(caption_to_res[caption]) for caption in captions]
+
+    def get_result_cache_key(self, caption):
+        return f'{self.fingerprint}|{hashlib.sha256(caption.encode("utf-8")).hexdigest()}'
+
+    def get_cached_results(self, captions):
+        if self.result_cache is None:
+            return {}
+        caption_to_key = {caption: self.get_result_cache_key(caption) for caption in captions}
+        key_to_res = self.result_cache.get_many(list(caption_to_key.values()))
+        return {caption: key_to_res[key] for caption, key in caption_to_key.items() if key in key_to_res}
+
+    def cache_results(self, caption_to_res):
+        if self.result_cache is not None and len(caption_to_res) > 0:
+            self.result_cache.put_many([(self.get_result_cache_key(caption), res) for caption, res in caption_to_res.items()])
+
+    # The pipeline stages: preprocess (phrase rewrites), parse, rules, phrase identification (WordNet lookups and LM
+    #  scoring) and postprocessing, timed separately when the metrics are enabled
+
+    @timed_stage('preprocess')
+    def preprocess(self, caption):
+        return get_phrase_rewriter().rewrite(caption)
+
+    @timed_stage('parse')
+    def parse(self, caption):
+        return self.doc_to_sentence(self.nlp(self.preprocess(caption)))
+
+    @timed_stage('rules')
+    def analyze_sentence(self, sentence):
+        if metrics is None:
+            return get_rule_engine().analyze(sentence)
+        # The rules are evaluated on demand, so evaluate them here to count their time in this stage
+        sentence_rules = get_rule_engine().analyze(sentence, metrics)
+        sentence_rules.evaluate()
+        return sentence_rules
+
+    @timed_stage('postprocessing')
+    def postprocess(self, sentence, synsets, sentence_rules):
+        return complete_synsets(sentence, synsets, sentence_rules)
+
+    @timed_stage('other')
+    def compute_synsets(self, caption):
+        if metrics is not None:
+            metrics.count('captions')
+        set_dependency_caption(caption)
+        with capture_metrics():
+            sentence = self.parse(caption)
+            if sentence is None:
+                return None
+            sentence_rules = self.analyze_sentence(sentence)
+            synsets = self.run_lm_rounds([self.identify_phrases(sentence, sentence_rules=sentence_rules)])[0]
+            return self.postprocess(sentence, synsets, sentence_rules)
+
+    @timed_stage('parse')
+    def parse_batch(self, captions):
+        # Parse (lowercased) captions in a single Stanza pass, after the phrase rewrites. Captions with more than one
+        #  sentence are None
+        from stanza import Document
+        docs = self.nlp.bulk_process([Document([], text=self.preprocess(caption)) for caption in captions])
+        return [self.doc_to_sentence(doc) for doc in docs]
+
+    def find_sentences_synsets(self, sentences, defer_lm=True, captions=None):
+        # Run the rules and WordNet stages on each parsed sentence (None sentences stay None). With defer_lm, the LM
+        #  queries of all the sentences are scored together. The dependencies of each sentence are recorded as those of
+        #  its caption, if given
+        lm_queries = [] if defer_lm else None
+        parsed_inds = [i for i in range(len(sentences)) if sentences[i] is not None]
+        sentence_rules = {i: self.analyze_sentence(sentences[i]) for i in parsed_inds}
+        phrase_identifiers = {i: self.identify_phrases(sentences[i], lm_queries if defer_lm else None, sentence_rules[i]) for i in parsed_inds}
+        if dependency_recorder is not None and captions is not None:
+            phrase_identifiers = {i: self.record_caption_dependencies(captions[i], phrase_identifier) for i, phrase_identifier in phrase_identifiers.items()}
+        if defer_lm:
+            parsed_synsets = self.run_lm_rounds([phrase_identifiers[i] for i in parsed_inds])
+            self.score_lm_queries(lm_queries)
+        else:
+            parsed_synsets = [self.run_lm_rounds([phrase_identifiers[i]])[0] for i in parsed_inds]
+        results = [None]*len(sentences)
+        for i, synsets in zip(parsed_inds, parsed_synsets):
+            if captions is not None:
+                set_dependency_caption(captions[i])
+            results[i] = self.postprocess(sentences[i], synsets, sentence_rules[i])
+        return results
+
+    @timed_stage('other')
+    def compute_synsets_batch(self, captions, batch_size=parse_batch_size, defer_lm=True):
+        if metrics is not None:
+            metrics.count('captions', len(captions))
+        results = []
+        for batch_start in range(0, len(captions), batch_size):
+            with capture_metrics():
+                batch_captions = captions[batch_start:batch_start+batch_size]
+                results += self.find_sentences_synsets(self.parse_batch(batch_captions), defer_lm, batch_captions)
+        return results
+
+default_extractor = None
+
+def get_default_extractor():
+    global default_extractor
+    if default_extractor is None:
+        lm_cache = None if lm_cache_path is None else SQLiteCache(lm_cache_path, 'lm_scores', lm_cache_max_entries)
+        result_cache = None if result_cache_path is None else SQLiteCache(result_cache_path, 'results', result_cache_max_entries)
+        default_extractor = SynsetExtractor(lm_cache=lm_cache, result_cache=result_cache, scorer=load_scorer(lm_scorer))
+    return default_extractor
+
+# Compatibility wrappers, using a shared default extractor
+
+def find_synsets(caption):
+    return get_default_extractor().find_synsets(caption)
+
+def find_synsets_batch(captions, batch_size=parse_batch_size, defer_lm=True):
+    return get_default_extractor().find_synsets_batch(captions, batch_size, defer_lm)
+
+def find_phrase_synsets(phrase):
+    return get_default_extractor().find_phrase_synsets(phrase)
+
+def choose_synset_with_lm(sentence, start_ind, end_ind, synset_list, selection_method='probs'):
+    return get_default_extractor().choose_synset_with_lm(sentence, start_ind, end_ind, synset_list, selection_method)
@@ -0,0 +1,154 @@
+import sys
+sys.path.append('.')
+import argparse
+import hashlib
+import json
+import os
+import time
+import find_synsets_in_captions
+from config import package_dir
+from utils import data_dir
+from regression import RegressionHandler
+from run_regression import get_pred, get_regression_extractor, get_sample_status, print_results
+from utils import get_ontology
+
+''' Incremental regression: for each sample we store its prediction and the data entries it depended on (the mapping
+keys it looked up, found or not, and the words it looked up in the word sense rules). On the next run the data files
+are compared to the stored snapshot entry by entry, and only samples that depended on a changed entry (or whose
+caption changed) are run again. Changes that may affect any sample (the code, the ontology, the implicit synsets, the
+noun rules, the phrase rewrites or the set of known synsets) cause a full run.
+'''
+
+regression_state_file = os.path.join(package_dir, 'reg_state.json')
+
+# Data files whose entries are tracked individually, by the source name used in dependency recording
+keyed_data_files = {
+    'phrase2synsets': os.path.join(data_dir, 'phrase2synsets.json'),
+    'phrase2hypernym': os.path.join(data_dir, 'phrase2hypernym.json'),
+    'non_synset_phrases': os.path.join(data_dir, 'non_synset_phrases.json'),
+    'identical_synsets_mapping': os.path.join(data_dir, 'identical_synsets_mapping.json'),
+    'phrase2replace_str': os.path.join(data_dir, 'phrase2replace_str.json')
+}
+token_rules_file = os.path.join(data_dir, 'token_rules.json')
+global_data_files = [os.path.join(data_dir, file_name) for file_name in ['synsets_c2p.json', 'implicit_synsets.json', 'phrase_rewrites.json']]
+
+def get_hash(data):
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()[:16]
+
+def get_global_hash():
+    global_hash = hashlib.sha256()
+    # The same code files as the result cache fingerprint
+    code_paths = [os.path.join(package_dir, file_name) for file_name in find_synsets_in_captions.code_files]
+    for file_path in code_paths + global_data_files:
+        with open(file_path, 'rb') as fp:
+            global_hash.update(fp.read())
+    with open(token_rules_file, 'r') as fp:
+        token_rules = json.load(fp)
+    global_hash.update(json.dumps([token_rules['noun_exceptions'], token_rules['non_noun_exceptions']]).encode('utf-8'))
+    global_hash.update(json.dumps(sorted(get_ontology().all_synsets)).encode('utf-8'))
+    return global_hash.hexdigest()
+
+def get_data_snapshot():
+    # Maps each source to a hash of each of its entries
+    snapshot = {}
+    for source, file_path in keyed_data_files.items():
+        with open(file_path, 'r') as fp:
+            data = json.load(fp)
+        if isinstance(data, list):
+            snapshot[source] = {key: '' for key in data}
+        else:
+            snapshot[source] = {key: get_hash(json.dumps(value)) for key, value in data.items()}
+    with open(token_rules_file, 'r') as fp:
+        token_rules = json.load(fp)
+    snapshot['word_senses'] = {}
+    for entry in token_rules['word_senses']:
+        entry_hash = get_hash(json.dumps(entry))
+        for word in entry['words']:
+            snapshot['word_senses'][word] = entry_hash
+    return snapshot
+
+def get_changed_entries(old_snapshot, new_snapshot):
+    changed = set()
+    for source in set(old_snapshot).union(new_snapshot):
+        old_entries = old_snapshot.get(source, {})
+        new_entries = new_snapshot.get(source, {})
+        for key in set(old_entries).union(new_entries):
+            if old_entries.get(key) != new_entries.get(key):
+                changed.add((source, key))
+    return changed
+
+def load_state(state_path):
+    if not os.path.isfile(state_path):
+        return None
+    with open(state_path, 'r') as fp:
+        return json.load(fp)
+
+def run_samples(extractor, captions, batch_size):
+    # The same batched path as the full regression (src/run_regression.py), so the predictions match it. Returns the
+    #  prediction and the dependencies of each caption
+    recorder = find_synsets_in_captions.DependencyRecorder()
+    find_synsets_in_captions.dependency_recorder = recorder
+    try:
+        res = []
+        for batch_start in range(0, len(captions), batch_size):
+            res += extractor.find_synsets_batch(captions[batch_start:batch_start+batch_size])
+    finally:
+        find_synsets_in_captions.dependency_recorder = None
+    return [(get_pred(cur_res), recorder.get_deps(caption.lower())) for caption, cur_res in zip(captions, res)]
+
+def run_incremental_regression(full=False, state_path=regression_state_file, batch_size=1000):
+    reg_obj = RegressionHandler()
+    t = time.time()
+    state = load_state(state_path)
+    global_hash = get_global_hash()
+    snapshot = get_data_snapshot()
+    if full or state is None or state['global_hash'] != global_hash:
+        to_run = list(range(len(reg_obj.reg)))
+        sample_states = {}
+        reason = 'full run' if full else ('no previous state' if state is None else 'global change')
+    else:
+        changed = get_changed_entries(state['snapshot'], snapshot)
+        sample_states = state['samples']
+        to_run = []
+        for i, (sample, _) in enumerate(reg_obj.reg):
+            sample_state = sample_states.get(str(i))
+            if sample_state is None or sample_state['caption'] != sample['caption'] or \
+                    any([tuple(dep) in changed for dep in sample_state['deps']]):
+                to_run.append(i)
+        reason = f'{len(changed)} changed data entries'
+    print(f'Running {len(to_run)} out of {len(reg_obj.reg)} samples ({reason})', flush=True)
+
+    # Without the caches, as in the full regression (cached results don't record their dependencies)
+    extractor = get_regression_extractor(use_cache=False)
+    captions = [reg_obj.reg[i][0]['caption'] for i in to_run]
+    for i, caption, (pred, deps) in zip(to_run, captions, run_samples(extractor, captions, batch_size)):
+        sample_states[str(i)] = {'caption': caption, 'pred': pred, 'deps': deps}
+    # Samples removed from the regression set
+    sample_states = {key: value for key, value in sample_states.items() if int(key) < len(reg_obj.reg)}
+
+    with open(state_path, 'w') as fp:
+        fp.write(json.dumps({'global_hash': global_hash, 'snapshot': snapshot, 'samples': sample_states}))
+
+    failed = []
+    waived_and_passed = []
+    waived_and_failed = []
+    for i, (_, gt) in enumerate(reg_obj.reg):
+        status = get_sample_status(i, gt, sample_states[str(i)]['pred'], reg_obj.waivers)
+        if status == 'failed':
+            failed.append(i)
+        elif status == 'waived_and_failed':
+            waived_and_failed.append(i)
+        elif status == 'waived_and_passed':
+            waived_and_passed.append(i)
+    print(f'Finished in {time.time() - t:.1f} seconds', flush=True)
+    print_results(len(reg_obj.reg), failed, waived_and_passed, waived_and_failed)
+    return {'ran': to_run, 'failed': failed, 'waived_and_passed': waived_and_passed, 'waived_and_failed': waived_and_failed}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--full', action='store_true', help='Run all the samples, ignoring the stored state')
+    parser.add_argument('--state', default=regression_state_file, help='Path of the stored predictions and dependencies')
+    parser.add_argument('--batch_size', type=int, default=1000, help='Captions per find_synsets_batch call, as in src/run_regression.py')
+    args = parser.parse_args()
+
+    run_incremental_regression(args.full, args.state, args.batch_size)
@@ -0,0 +1,81 @@
+import sys
+sys.path.append('.')
+import argparse
+import json
+import time
+from find_synsets_in_captions import SynsetExtractor
+from lm_scorers import lm_precisions
+from regression import RegressionHandler
+
+# Compare the synsets selected with a reduced precision LM to the ones selected with the fp32 LM on the regression set
+
+def get_mention_to_synset(res):
+    if res is None:
+        return {}
+    return {(x[0], x[1]): x[3] for x in res if x[3] is not None}
+
+def run_on_captions(extractor, captions):
+    # Load the models before starting the timer
+    extractor.nlp, extractor.lm, extractor.tokenizer
+    t = time.time()
+    res = extractor.find_synsets_batch(captions)
+    return res, time.time() - t
+
+def compare_precisions(captions, device_name, precision, num_threads):
+    ref_extractor = SynsetExtractor(device_name='cpu', precision='fp32', num_threads=num_threads)
+    ref_res, ref_time = run_on_captions(ref_extractor, captions)
+    # Share the parser and the tokenizer, only the LM differs
+    extractor = SynsetExtractor(
+        nlp=ref_extractor.nlp,
+        tokenizer=ref_extractor.tokenizer,
+        inflect_engine=ref_extractor.inflect_engine,
+        device_name=device_name,
+        precision=precision,
+        num_threads=num_threads
+    )
+    res, res_time = run_on_captions(extractor, captions)
+
+    diff_captions = []
+    diff_mention_num = 0
+    mention_num = 0
+    for i in range(len(captions)):
+        ref_mentions = get_mention_to_synset(ref_res[i])
+        mentions = get_mention_to_synset(res[i])
+        all_mentions = set(ref_mentions).union(mentions)
+        cur_diff_num = len([x for x in all_mentions if ref_mentions.get(x) != mentions.get(x)])
+        mention_num += len(all_mentions)
+        diff_mention_num += cur_diff_num
+        if cur_diff_num > 0:
+            diff_captions.append(i)
+
+    return {
+        'device': device_name,
+        'precision': precision,
+        'num_threads': num_threads,
+        'caption_num': len(captions),
+        'fp32_captions_per_sec': len(captions)/ref_time,
+        'captions_per_sec': len(captions)/res_time,
+        'mention_num': mention_num,
+        'diff_mention_num': diff_mention_num,
+        'diff_mention_rate': diff_mention_num/mention_num if mention_num > 0 else 0,
+        'diff_caption_num': len(diff_captions),
+        'diff_caption_rate': len(diff_captions)/len(captions) if len(captions) > 0 else 0,
+        'diff_captions': diff_captions,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('precision', choices=lm_precisions)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--output', default=None, help='Path of a json file to write the report to')
+    args = parser.parse_args()
+
+    reg_obj = RegressionHandler()
+    captions = [sample['caption'] for sample, _ in reg_obj.reg]
+    report = compare_precisions(captions, args.device, args.precision, args.num_threads)
+    print(f'{report["precision"]} on {report["device"]}: {report["captions_per_sec"]:.1f} captions/sec (fp32: {report["fp32_captions_per_sec"]:.1f})')
+    print(f'{report["diff_mention_num"]} out of {report["mention_num"]} mentions ({100*report["diff_mention_rate"]:.2f}%) differ from fp32, in {report["diff_caption_num"]} out of {report["caption_num"]} captions')
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            fp.write(json.dumps(report))
@@ -0,0 +1,112 @@
+import sys
+sys.path.append('.')
+import argparse
+import csv
+import json
+import os
+import multiprocessing
+import resource
+import time
+from find_synsets_in_captions import SynsetExtractor, load_scorer
+from lm_precision_report import get_mention_to_synset
+from regression import RegressionHandler
+from config import lm_name, parse_batch_size
+from utils import data_dir
+
+# Compare LM scorers (masked LMs of different sizes, and the prior-only scorer) on the regression set and the validation
+#  set: speed, peak memory and agreement with the reference LM's decisions. The captions are parsed once, and each
+#  scorer runs in a process of its own so its peak memory can be measured
+
+prior_scorer_name = 'prior'
+warmup_sentence_num = 10
+
+def get_benchmark_captions():
+    reg_obj = RegressionHandler()
+    captions = [sample['caption'] for sample, _ in reg_obj.reg]
+    with open(os.path.join(data_dir, 'validation.csv'), 'r') as fp:
+        captions += [row['caption'] for row in csv.DictReader(fp)]
+    return captions
+
+def parse_captions(captions):
+    extractor = SynsetExtractor()
+    sentences = []
+    for batch_start in range(0, len(captions), parse_batch_size):
+        batch = [caption.lower() for caption in captions[batch_start:batch_start+parse_batch_size]]
+        sentences += extractor.parse_batch(batch)
+    return sentences
+
+def run_scorer(scorer_spec, sentences, device_name, num_threads):
+    # Runs in a child process. scorer_spec is either 'prior' or the name of a HuggingFace masked LM
+    if scorer_spec == prior_scorer_name:
+        scorer = load_scorer('prior')
+    else:
+        scorer = load_scorer('masked_lm', lm_name=scorer_spec, device_name=device_name, num_threads=num_threads)
+        # Load the models before starting the timer
+        scorer.lm, scorer.tokenizer
+    extractor = SynsetExtractor(scorer=scorer)
+    extractor.find_sentences_synsets(sentences[:warmup_sentence_num])
+    t = time.time()
+    res = extractor.find_sentences_synsets(sentences)
+    elapsed = time.time() - t
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    return res, elapsed, peak_rss_mb
+
+def run_scorer_in_process(scorer_spec, sentences, device_name, num_threads):
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(run_scorer, (scorer_spec, sentences, device_name, num_threads))
+
+def get_agreement(ref_res, res):
+    mention_num = 0
+    agreed_mention_num = 0
+    agreed_caption_num = 0
+    for ref_caption_res, caption_res in zip(ref_res, res):
+        ref_mentions = get_mention_to_synset(ref_caption_res)
+        mentions = get_mention_to_synset(caption_res)
+        all_mentions = set(ref_mentions).union(mentions)
+        cur_agreed_num = len([x for x in all_mentions if ref_mentions.get(x) == mentions.get(x)])
+        mention_num += len(all_mentions)
+        agreed_mention_num += cur_agreed_num
+        if cur_agreed_num == len(all_mentions):
+            agreed_caption_num += 1
+    return {
+        'mention_num': mention_num,
+        'mention_agreement': agreed_mention_num/mention_num if mention_num > 0 else 1,
+        'caption_agreement': agreed_caption_num/len(ref_res) if len(ref_res) > 0 else 1
+    }
+
+def benchmark_scorers(scorer_specs, reference, device_name, num_threads):
+    captions = get_benchmark_captions()
+    sentences = parse_captions(captions)
+    reports = []
+    ref_res = None
+    for scorer_spec in [reference] + [x for x in scorer_specs if x != reference]:
+        res, elapsed, peak_rss_mb = run_scorer_in_process(scorer_spec, sentences, device_name, num_threads)
+        if ref_res is None:
+            ref_res = res
+        report = {
+            'scorer': scorer_spec,
+            'caption_num': len(captions),
+            'captions_per_sec': len(captions)/elapsed if elapsed > 0 else float('inf'),
+            'peak_rss_mb': peak_rss_mb
+        }
+        report.update(get_agreement(ref_res, res))
+        reports.append(report)
+    return reports
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scorers', nargs='+', help=f'HuggingFace masked LM names, or "{prior_scorer_name}" for the prior-only scorer')
+    parser.add_argument('--reference', default=lm_name, help='The scorer whose decisions the others are compared to')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--output', default=None, help='Path of a json file to write the report to')
+    args = parser.parse_args()
+
+    reports = benchmark_scorers(args.scorers, args.reference, args.device, args.num_threads)
+    for report in reports:
+        print(f'{report["scorer"]}: {report["captions_per_sec"]:.1f} captions/sec, peak RSS {report["peak_rss_mb"]:.0f} MB, ' +
+              f'agreement with {args.reference}: {100*report["mention_agreement"]:.2f}% of mentions, {100*report["caption_agreement"]:.2f}% of captions')
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            fp.write(json.dumps(reports))
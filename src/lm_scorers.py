@@ -0,0 +1,185 @@
+from contextlib import nullcontext
+
+''' Scorers choose between the candidate synsets of an ambiguous mention (see SynsetExtractor.build_lm_query).
+A scorer implements:
+    candidate_key(synset, repr_phrase): what the scorer scores for this candidate (e.g., the token id of its
+        representative phrase), or None if it can't score it
+    score(texts, candidate_keys_list, selection_method, batch_size): for each masked text, the scores of its candidates
+    cache_id: identifies the scorer's scores in the LM cache, or None if they shouldn't be cached
+'''
+
+mask_str = '[MASK]'
+lm_precisions = ['fp32', 'bf16', 'int8']
+
+def load_lm(model_name, device_name, precision, num_threads=None):
+    # fp32: full precision. bf16: bfloat16 autocast during inference. int8: dynamic int8 quantization of the linear
+    #  layers (CPU only)
+    import torch
+    from torch import nn
+    from transformers import AutoModelForMaskedLM
+    assert precision in lm_precisions, f'Unknown LM precision {precision}'
+    device = torch.device(device_name)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    model = AutoModelForMaskedLM.from_pretrained(model_name)
+    model = model.eval()
+    if precision == 'int8':
+        assert device.type == 'cpu', 'int8 quantization is only supported on CPU'
+        model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    model = model.to(device)
+    return model
+
+def load_tokenizer(model_name):
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(model_name)
+
+class MaskedLMScorer:
+    ''' Scores the candidates by the masked LM's prediction for the masked mention. Any HuggingFace masked LM can be
+    used. A candidate is scored only if its representative phrase is a single token in the LM's vocabulary.
+    The LM and the tokenizer are loaded on first use, or may be passed to the constructor.
+    '''
+    def __init__(self, lm_name, device_name='cpu', precision='fp32', num_threads=None, lm=None, tokenizer=None):
+        self.lm_name = lm_name
+        self.device_name = device_name
+        self.precision = precision
+        self.num_threads = num_threads
+        self._lm = lm
+        self._tokenizer = tokenizer
+        self._device = None
+
+    @property
+    def name(self):
+        return self.lm_name
+
+    @property
+    def cache_id(self):
+        # Scores depend on the model and on its precision, and not on the device
+        return f'{self.lm_name}|{self.precision}'
+
+    @property
+    def lm(self):
+        if self._lm is None:
+            self._lm = load_lm(self.lm_name, self.device_name, self.precision, self.num_threads)
+        return self._lm
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = load_tokenizer(self.lm_name)
+        return self._tokenizer
+
+    @property
+    def device(self):
+        if self._device is None:
+            import torch
+            self._device = torch.device(self.device_name)
+        return self._device
+
+    def configure(self, device_name, precision, num_threads):
+        # The LM is reloaded on its next use
+        self.device_name = device_name
+        self.precision = precision
+        self.num_threads = num_threads
+        self._lm = None
+        self._device = None
+
+    def autocast(self):
+        if self.precision == 'bf16':
+            import torch
+            return torch.autocast(self.device.type, dtype=torch.bfloat16)
+        return nullcontext()
+
+    def candidate_key(self, synset, repr_phrase):
+        vocab = self.tokenizer.vocab
+        if repr_phrase in vocab:
+            return vocab[repr_phrase]
+        # Byte level BPE vocabularies (e.g., RoBERTa) mark words that follow a space
+        if 'Ġ' + repr_phrase in vocab:
+            return vocab['Ġ' + repr_phrase]
+        return None
+
+    def to_model_text(self, text):
+        # Texts are built with mask_str, other LMs use a different mask token
+        if self.tokenizer.mask_token == mask_str:
+            return text
+        return text.replace(mask_str, self.tokenizer.mask_token)
+
+    def get_mask_scores(self, text, returned_vals):
+        # The scores of the entire vocabulary at the mask position
+        import torch
+        from torch import nn
+        input = self.tokenizer(self.to_model_text(text), return_tensors='pt', truncation='longest_first').to(self.device)
+        mask_id = self.tokenizer.mask_token_id
+        mask_ind = [i for i in range(input.input_ids.shape[1]) if input.input_ids[0, i] == mask_id][0]
+        with torch.inference_mode(), self.autocast():
+            output = self.lm(**input)
+        mask_logits = output.logits[0, mask_ind, :].float()
+        if returned_vals == 'logits':
+            return mask_logits
+        elif returned_vals == 'probs':
+            mask_probs = nn.functional.softmax(mask_logits, dim=0)
+            return mask_probs
+        else:
+            assert False
+
+    def score(self, texts, candidate_keys_list, selection_method='probs', batch_size=64):
+        # Tokenize all texts once, sort them by length so each batch needs little padding, and read only the candidate
+        #  token ids at each mask position. Scores of padded batches may differ slightly from scoring each text alone
+        #  (batch_size 1), which can change the choice between near tied candidates (measured by
+        #  python src/run_regression.py --check_lm_batching)
+        import torch
+        from torch import nn
+        encodings = self.tokenizer([self.to_model_text(text) for text in texts], truncation='longest_first')
+        order = sorted(range(len(texts)), key=lambda i: len(encodings['input_ids'][i]))
+        mask_id = self.tokenizer.mask_token_id
+        text_scores = [None]*len(texts)
+        with torch.inference_mode(), self.autocast():
+            for batch_start in range(0, len(order), batch_size):
+                batch_inds = order[batch_start:batch_start+batch_size]
+                input = self.tokenizer.pad(
+                    {key: [encodings[key][i] for i in batch_inds] for key in encodings.keys()},
+                    return_tensors='pt'
+                ).to(self.device)
+                is_mask = input.input_ids == mask_id
+                # Truncation may drop the mask, and argmax would then silently point at the first token
+                assert bool((is_mask.sum(dim=1) == 1).all()), \
+                    f'Expected exactly one mask token in each text, got {[texts[i] for i, x in zip(batch_inds, is_mask.sum(dim=1).tolist()) if x != 1]}'
+                mask_inds = is_mask.int().argmax(dim=1)
+                output = self.lm(**input)
+                mask_logits = output.logits[torch.arange(len(batch_inds), device=self.device), mask_inds, :].float()
+                if selection_method == 'logits':
+                    mask_scores = mask_logits
+                elif selection_method == 'probs':
+                    mask_scores = nn.functional.softmax(mask_logits, dim=1)
+                else:
+                    assert False
+                for row, i in enumerate(batch_inds):
+                    text_scores[i] = mask_scores[row, candidate_keys_list[i]].tolist()
+
+        return text_scores
+
+class PriorScorer:
+    ''' Ignores the context and prefers the most frequent synset, by the WordNet lemma counts (get_count maps a synset
+    name to its count). No model is needed. The None candidate (none of our synsets) is scored 0.
+    '''
+    name = 'prior'
+    cache_id = None
+
+    def __init__(self, get_count):
+        self.get_count = get_count
+        self.synset_to_count = {}
+
+    def candidate_key(self, synset, repr_phrase):
+        # The None candidate is kept (None would mean it can't be scored)
+        return '' if synset is None else synset
+
+    def get_synset_score(self, synset):
+        if synset == '':
+            return 0
+        if synset not in self.synset_to_count:
+            self.synset_to_count[synset] = self.get_count(synset)
+        return self.synset_to_count[synset]
+
+    def score(self, texts, candidate_keys_list, selection_method='probs', batch_size=None):
+        # The counts are comparable across texts (the a/an variants of a query), so they aren't normalized
+        return [[self.get_synset_score(synset) for synset in candidate_keys] for candidate_keys in candidate_keys_list]
@@ -0,0 +1,96 @@
+import cProfile
+import io
+import json
+import pstats
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+''' Opt-in instrumentation of the extraction pipeline. When find_synsets_in_captions.metrics is a Metrics object, the
+pipeline records in it:
+    stage_seconds: the time of each stage (see stages). Stage times are exclusive: while a nested stage runs, the
+        enclosing stage's clock is stopped
+    counters: LM queries and calls, a/an double queries, WordNet lookups, cache hits and the hits of each rule handler
+    optionally, a cProfile profile and the peak traced memory of the batches (capture)
+When it's None (the default), the instrumentation is a single check at each hook.
+'''
+
+stages = ['preprocess', 'parse', 'rules', 'wordnet', 'lm', 'postprocessing', 'other']
+
+class Metrics:
+    def __init__(self, profile=False, trace_memory=False):
+        self.stage_seconds = {stage: 0. for stage in stages}
+        self.counters = defaultdict(int)
+        self.stack = []
+        self.last = None
+        self.profiler = cProfile.Profile() if profile else None
+        self.trace_memory = trace_memory
+        self.peak_memory = 0
+
+    def count(self, name, num=1):
+        self.counters[name] += num
+
+    def start(self, stage):
+        now = time.perf_counter()
+        if len(self.stack) > 0:
+            self.stage_seconds[self.stack[-1]] += now - self.last
+        self.stack.append(stage)
+        self.last = now
+
+    def stop(self):
+        now = time.perf_counter()
+        self.stage_seconds[self.stack.pop()] += now - self.last
+        self.last = now
+
+    def timed(self, stage, func, *args, **kwargs):
+        self.start(stage)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.stop()
+
+    @contextmanager
+    def capture(self):
+        # Profile and trace the memory of a batch, if enabled
+        started_tracing = False
+        if self.trace_memory:
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+                started_tracing = True
+        if self.profiler is not None:
+            self.profiler.enable()
+        try:
+            yield
+        finally:
+            if self.profiler is not None:
+                self.profiler.disable()
+            if self.trace_memory:
+                self.peak_memory = max(self.peak_memory, tracemalloc.get_traced_memory()[1])
+                if started_tracing:
+                    tracemalloc.stop()
+
+    def get_profile_summary(self, function_num=30):
+        if self.profiler is None:
+            return None
+        stream = io.StringIO()
+        pstats.Stats(self.profiler, stream=stream).sort_stats('cumulative').print_stats(function_num)
+        return stream.getvalue()
+
+    def to_dict(self):
+        res = {
+            'stage_seconds': dict(self.stage_seconds),
+            'counters': dict(sorted(self.counters.items()))
+        }
+        if self.trace_memory:
+            res['peak_traced_memory_mb'] = self.peak_memory/2**20
+        return res
+
+    def save(self, path, profile_path=None):
+        # The profile is saved in the pstats format, e.g., for snakeviz
+        with open(path, 'w') as fp:
+            fp.write(json.dumps(self.to_dict(), indent=4))
+        if self.profiler is not None and profile_path is not None:
+            self.profiler.dump_stats(profile_path)
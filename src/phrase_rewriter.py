@@ -0,0 +1,66 @@
+import re
+
+# Words are runs of word characters, any other non-space character is a token of its own (roughly what the parser's
+#  tokenizer does)
+token_re = re.compile(r'\w+|[^\w\s]')
+# Key of the replacement string in the trie nodes (never a token)
+replacement_key = ''
+
+class PhraseRewriter:
+    ''' Rewrites phrases in a text before it is parsed, e.g., "lion fish" -> "lionfish".
+    The phrases are compiled into a trie over words, and the text is scanned once, taking at each position the longest
+    phrase that starts there. The cost per word is bounded by the length of the longest phrase, not by the number of
+    phrases.
+    '''
+    def __init__(self, phrase_to_replacement):
+        self.trie = {}
+        for phrase, replacement in phrase_to_replacement.items():
+            node = self.trie
+            for word in phrase.lower().split():
+                node = node.setdefault(word, {})
+            node[replacement_key] = replacement
+
+    @staticmethod
+    def is_attached(tokens, i, j):
+        # Hyphenated words (e.g., "olive-green") are a single word for the parser, so we don't match inside them
+        return tokens[i].end() == tokens[j].start() and '-' in (tokens[i].group(), tokens[j].group())
+
+    def match(self, tokens, start):
+        # The end (exclusive) and replacement of the longest phrase starting at tokens[start], or None
+        if start > 0 and self.is_attached(tokens, start - 1, start):
+            return None
+        res = None
+        node = self.trie
+        end = start
+        while end < len(tokens) and tokens[end].group() in node:
+            # Words of a phrase are separated by a single space, so a phrase never spans a line or sentence break
+            if end > start and tokens[end].string[tokens[end - 1].end():tokens[end].start()] != ' ':
+                break
+            node = node[tokens[end].group()]
+            end += 1
+            if replacement_key in node and not (end < len(tokens) and self.is_attached(tokens, end - 1, end)):
+                res = (end, node[replacement_key])
+        return res
+
+    def rewrite(self, text):
+        # text is expected to be lowercased
+        if len(self.trie) == 0:
+            return text
+        tokens = list(token_re.finditer(text))
+        pieces = []
+        prev_end = 0
+        i = 0
+        while i < len(tokens):
+            match = self.match(tokens, i)
+            if match is None:
+                i += 1
+                continue
+            end, replacement = match
+            pieces.append(text[prev_end:tokens[i].start()])
+            pieces.append(replacement)
+            prev_end = tokens[end - 1].end()
+            i = end
+        if len(pieces) == 0:
+            return text
+        pieces.append(text[prev_end:])
+        return ''.join(pieces)
@@ -0,0 +1,103 @@
+import sys
+sys.path.append('.')
+import argparse
+import multiprocessing
+import os
+from tqdm import tqdm
+from get_dataset import datasets, iter_orig_dataset
+from process_dataset import stream_process_samples, compact_jsonl_files, clear_stream_output, get_stream_paths
+from worker_utils import limit_worker_threads
+from columnar_dataset import get_json_path
+from config import datasets_dir
+
+''' Process several datasets with a pool of worker processes. Each dataset is split into shards of consecutive samples,
+each shard is processed in streaming mode (so an interrupted run resumes from the shard checkpoints) and the shards of
+each dataset are then merged into the usual datasets/<dataset>.json file.
+'''
+
+shards_dir = os.path.join(datasets_dir, 'shards')
+
+def get_shard_prefix(dataset, shard_ind):
+    return os.path.join(shards_dir, f'{dataset}.{shard_ind:05d}')
+
+# Worker state: every worker holds a single extractor
+worker_extractor = None
+
+def init_worker(num_threads):
+    global worker_extractor
+    limit_worker_threads(num_threads)
+    from find_synsets_in_captions import get_default_extractor
+    from lm_scorers import MaskedLMScorer
+    # Same configuration as the default extractor (including the LM cache), in this process
+    worker_extractor = get_default_extractor()
+    if isinstance(worker_extractor.scorer, MaskedLMScorer):
+        # Loading the LM shouldn't override the thread limit
+        worker_extractor.scorer.num_threads = num_threads
+
+def count_samples(dataset):
+    # Run in a worker, so the parent never reads the datasets. The source is read lazily, so counting doesn't keep the
+    #  samples in memory
+    return dataset, sum(1 for _ in iter_orig_dataset(dataset))
+
+def process_shard(shard):
+    # The worker reads only the samples of [start, end) from the lazy reader of the source dataset
+    dataset, shard_ind, start, end = shard
+    checkpoint = stream_process_samples(
+        dataset,
+        get_shard_prefix(dataset, shard_ind),
+        extractor=worker_extractor,
+        start=start,
+        end=end,
+        show_progress=False
+    )
+    return dataset, shard_ind, checkpoint['quarantined']
+
+def get_shards(dataset, sample_num, shard_size):
+    return [(dataset, i, start, min(start + shard_size, sample_num)) for i, start in enumerate(range(0, sample_num, shard_size))]
+
+def merge_shards(dataset, shard_num):
+    shard_prefixes = [get_shard_prefix(dataset, i) for i in range(shard_num)]
+    compact_jsonl_files([get_stream_paths(prefix)['output'] for prefix in shard_prefixes], get_json_path(dataset))
+
+def process_all_datasets(dataset_list, worker_num, shard_size, threads_per_worker=None, restart=False):
+    if threads_per_worker is None:
+        threads_per_worker = max(1, os.cpu_count() // worker_num)
+    os.makedirs(shards_dir, exist_ok=True)
+
+    # Spawn rather than fork: CUDA and the torch thread pools don't survive forking
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(worker_num, initializer=init_worker, initargs=(threads_per_worker,)) as pool:
+        dataset_to_sample_num = dict(pool.map(count_samples, dataset_list, chunksize=1))
+        dataset_to_shards = {dataset: get_shards(dataset, dataset_to_sample_num[dataset], shard_size) for dataset in dataset_list}
+        if restart:
+            for shards in dataset_to_shards.values():
+                for dataset, shard_ind, _, _ in shards:
+                    clear_stream_output(get_shard_prefix(dataset, shard_ind))
+        all_shards = [shard for shards in dataset_to_shards.values() for shard in shards]
+
+        dataset_to_remaining = {dataset: len(shards) for dataset, shards in dataset_to_shards.items()}
+        dataset_to_quarantined = {dataset: 0 for dataset in dataset_list}
+        for dataset, remaining in dataset_to_remaining.items():
+            if remaining == 0:
+                merge_shards(dataset, 0)
+        for dataset, shard_ind, quarantined in tqdm(pool.imap_unordered(process_shard, all_shards), total=len(all_shards), desc='shards'):
+            dataset_to_quarantined[dataset] += quarantined
+            dataset_to_remaining[dataset] -= 1
+            if dataset_to_remaining[dataset] == 0:
+                merge_shards(dataset, len(dataset_to_shards[dataset]))
+                print(f'{dataset}: {dataset_to_quarantined[dataset]} samples failed and are excluded from {get_json_path(dataset)}, see {os.path.join(shards_dir, dataset)}.*.quarantine.jsonl', flush=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('datasets', nargs='+', help='Dataset names, or "all" for all the CrossModal3600 datasets')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--shard_size', type=int, default=1000)
+    parser.add_argument('--threads_per_worker', type=int, default=None, help='Torch threads in each worker, by default the cores are split between the workers')
+    parser.add_argument('--restart', action='store_true', help='Ignore previous results of these datasets')
+    args = parser.parse_args()
+
+    if args.datasets == ['all']:
+        dataset_list = [x for x in datasets if x.startswith('xm3600_')]
+    else:
+        dataset_list = args.datasets
+    process_all_datasets(dataset_list, args.workers, args.shard_size, args.threads_per_worker, args.restart)
@@ -1,24 +1,210 @@
 import sys
 sys.path.append('.')
-from find_synsets_in_captions import find_synsets
+import find_synsets_in_captions
+from find_synsets_in_captions import find_synsets, find_synsets_batch, get_default_extractor
+import argparse
+import itertools
 import json
-from get_dataset import get_orig_dataset
+import os
+from get_dataset import get_orig_dataset, iter_orig_dataset
+from metrics import Metrics
+from config import parse_batch_size, datasets_dir
+from columnar_dataset import get_json_path
 from tqdm import tqdm
 
-dataset = sys.argv[1]
+def process_dataset(dataset):
+    data = get_orig_dataset(dataset)
+    with tqdm(total=len(data), desc=dataset) as pbar:
+        for batch_start in range(0, len(data), parse_batch_size):
+            batch_inds = range(batch_start, min(batch_start + parse_batch_size, len(data)))
+            try:
+                batch_res = find_synsets_batch([data[i]['caption'] for i in batch_inds])
+            except:
+                # Find the sample that failed
+                for i in batch_inds:
+                    try:
+                        find_synsets(data[i]['caption'])
+                    except:
+                        assert False, f'Failed in dataset {dataset} in sample {i}'
+                raise
+            for i, res in zip(batch_inds, batch_res):
+                if res is None:
+                    if '\n' in data[i]['caption']:
+                        data[i]['synsets'] = None
+                    else:
+                        assert False, f'Got None in dataset {dataset} in sample {i}'
+                else:
+                    data[i]['synsets'] = [x for x in res if x[3] is not None]
+            pbar.update(len(batch_inds))
+    with open(get_json_path(dataset), 'w') as fp:
+        fp.write(json.dumps(data))
 
-data = get_orig_dataset(dataset)
-for i in tqdm(range(len(data)), desc=dataset):
+''' Incremental mode (--stream): results are appended to <output_prefix>.jsonl, one sample per line. After each batch we
+record a checkpoint (the next sample and the output file offsets) in <output_prefix>.checkpoint.json, so a run that
+crashed or was preempted resumes from the last checkpoint. Samples that fail are written to
+<output_prefix>.quarantine.jsonl instead of aborting the run, and are not in the output: the json array that
+compact_jsonl_files writes once the run is done excludes them. The source dataset is also read lazily (see
+iter_orig_dataset), so memory doesn't grow with the dataset size.
+'''
+
+def get_stream_paths(output_prefix):
+    return {
+        'output': f'{output_prefix}.jsonl',
+        'checkpoint': f'{output_prefix}.checkpoint.json',
+        'quarantine': f'{output_prefix}.quarantine.jsonl'
+    }
+
+def write_checkpoint(checkpoint_path, checkpoint):
+    # Write to a temporary file and rename, so a crash never leaves a partial checkpoint
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        fp.write(json.dumps(checkpoint))
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, checkpoint_path)
+
+def clear_stream_output(output_prefix):
+    for path in get_stream_paths(output_prefix).values():
+        if os.path.isfile(path):
+            os.remove(path)
+
+def truncate_file(path, offset):
+    # Drop anything written after the last checkpoint
+    with open(path, 'ab') as fp:
+        fp.truncate(offset)
+
+def find_batch_synsets_with_errors(extractor, batch):
     try:
-        res = find_synsets(data[i]['caption'])
-    except:
-        assert False, f'Failed in dataset {dataset} in sample {i}'
-    if res is None:
-        if '\n' in data[i]['caption']:
-            data[i]['synsets'] = None
-        else:
-            assert False, f'Got None in dataset {dataset} in sample {i}'
+        batch_res = extractor.find_synsets_batch([sample['caption'] for sample in batch])
+        return batch_res, [None]*len(batch)
+    except Exception:
+        pass
+
+    # Some sample in the batch failed: run one by one to find it
+    batch_res = []
+    errors = []
+    for sample in batch:
+        try:
+            batch_res.append(extractor.find_synsets(sample['caption']))
+            errors.append(None)
+        except Exception as e:
+            batch_res.append(None)
+            errors.append(repr(e))
+    return batch_res, errors
+
+def stream_process_samples(dataset, output_prefix, extractor=None, start=0, end=None, batch_size=parse_batch_size, show_progress=True, samples=None):
+    # Process samples [start, end) of the dataset in streaming mode, resuming from the checkpoint if one exists.
+    #  samples may be given to avoid reading the dataset again (all the samples of the dataset, not only [start, end))
+    if extractor is None:
+        extractor = get_default_extractor()
+    paths = get_stream_paths(output_prefix)
+    if os.path.isfile(paths['checkpoint']):
+        with open(paths['checkpoint'], 'r') as fp:
+            checkpoint = json.load(fp)
+        assert checkpoint['dataset'] == dataset and checkpoint['start'] == start and checkpoint['end'] == end, \
+            f'Checkpoint {paths["checkpoint"]} is of a different run, remove it to restart'
     else:
-        data[i]['synsets'] = [x for x in res if x[3] is not None]
-with open(f'datasets/{dataset}.json', 'w') as fp:
-    fp.write(json.dumps(data))
+        checkpoint = {
+            'dataset': dataset,
+            'start': start,
+            'end': end,
+            'next_sample': start,
+            'output_offset': 0,
+            'quarantine_offset': 0,
+            'quarantined': 0,
+            'done': False
+        }
+    if checkpoint['done']:
+        return checkpoint
+    truncate_file(paths['output'], checkpoint['output_offset'])
+    truncate_file(paths['quarantine'], checkpoint['quarantine_offset'])
+
+    if samples is None:
+        samples = iter_orig_dataset(dataset)
+    samples = itertools.islice(samples, checkpoint['next_sample'], end)
+    with open(paths['output'], 'ab') as out_fp, open(paths['quarantine'], 'ab') as quarantine_fp, \
+            tqdm(desc=dataset, initial=checkpoint['next_sample'] - start, disable=not show_progress) as pbar:
+        while True:
+            batch = list(itertools.islice(samples, batch_size))
+            if len(batch) == 0:
+                break
+            batch_res, errors = find_batch_synsets_with_errors(extractor, batch)
+            for i, (sample, res, error) in enumerate(zip(batch, batch_res, errors)):
+                if error is None and res is None:
+                    if '\n' in sample['caption']:
+                        sample['synsets'] = None
+                    else:
+                        error = 'Got None'
+                elif error is None:
+                    sample['synsets'] = [x for x in res if x[3] is not None]
+
+                if error is None:
+                    out_fp.write((json.dumps(sample) + '\n').encode('utf-8'))
+                else:
+                    quarantine_record = {'index': checkpoint['next_sample'] + i, 'sample': sample, 'error': error}
+                    quarantine_fp.write((json.dumps(quarantine_record) + '\n').encode('utf-8'))
+                    checkpoint['quarantined'] += 1
+            for fp in [out_fp, quarantine_fp]:
+                fp.flush()
+                os.fsync(fp.fileno())
+            checkpoint['next_sample'] += len(batch)
+            checkpoint['output_offset'] = out_fp.tell()
+            checkpoint['quarantine_offset'] = quarantine_fp.tell()
+            write_checkpoint(paths['checkpoint'], checkpoint)
+            pbar.update(len(batch))
+
+    checkpoint['done'] = True
+    write_checkpoint(paths['checkpoint'], checkpoint)
+    return checkpoint
+
+def compact_jsonl_files(jsonl_paths, json_path):
+    # The lines are already json dumps of the samples, so we can concatenate them without parsing. The result is
+    #  identical to json.dumps of the list of samples
+    first = True
+    with open(json_path, 'w') as out_fp:
+        out_fp.write('[')
+        for jsonl_path in jsonl_paths:
+            with open(jsonl_path, 'r') as in_fp:
+                for line in in_fp:
+                    if not first:
+                        out_fp.write(', ')
+                    out_fp.write(line.rstrip('\n'))
+                    first = False
+        out_fp.write(']')
+
+def stream_process_dataset(dataset, restart=False, compact=True):
+    output_prefix = os.path.join(datasets_dir, dataset)
+    if restart:
+        clear_stream_output(output_prefix)
+    checkpoint = stream_process_samples(dataset, output_prefix)
+    print(f'{checkpoint["quarantined"]} samples failed and are excluded from the output, see {get_stream_paths(output_prefix)["quarantine"]}', flush=True)
+    if compact:
+        compact_jsonl_files([get_stream_paths(output_prefix)['output']], f'{output_prefix}.json')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dataset')
+    parser.add_argument('--stream', action='store_true', help='Write results incrementally and resume from the last checkpoint')
+    parser.add_argument('--restart', action='store_true', help='With --stream, ignore previous results of this dataset')
+    parser.add_argument('--no_compact', action='store_true', help='With --stream, don\'t write the json array file at the end')
+    parser.add_argument('--metrics', action='store_true', help='Record stage times and counters in datasets/<dataset name>.metrics.json')
+    parser.add_argument('--profile', action='store_true', help='With --metrics, also profile the batches into datasets/<dataset name>.prof')
+    parser.add_argument('--trace_memory', action='store_true', help='With --metrics, also record the peak traced memory of the batches')
+    args = parser.parse_args()
+
+    if args.metrics:
+        find_synsets_in_captions.metrics = Metrics(args.profile, args.trace_memory)
+
+    if args.stream:
+        stream_process_dataset(args.dataset, args.restart, not args.no_compact)
+    else:
+        process_dataset(args.dataset)
+
+    extractor = get_default_extractor()
+    if extractor.lm_cache is not None:
+        print(f'LM cache: {extractor.lm_cache.hits} hits, {extractor.lm_cache.misses} misses, {extractor.lm_cache.size} entries', flush=True)
+    print(f'Deduplicated {extractor.dedup_count} captions (identical captions and result cache hits)', flush=True)
+    if args.metrics:
+        metrics_path = os.path.join(datasets_dir, f'{args.dataset}.metrics.json')
+        find_synsets_in_captions.metrics.save(metrics_path, os.path.join(datasets_dir, f'{args.dataset}.prof'))
+        print(f'Saved the metrics to {metrics_path}', flush=True)
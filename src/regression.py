@@ -1,30 +1,207 @@
+import sys
+sys.path.append('.')
 import json
 import os
+import sqlite3
+from collections.abc import Mapping, Sequence
+from config import package_dir
 
-reg_file = 'reg3.json'
+# In the repository root, wherever the scripts are run from
+reg_file = os.path.join(package_dir, 'reg3.json')
+reg_db_file = os.path.join(package_dir, 'reg3.sqlite3')
 WAIVERS = ['parsing', 'multiple_class_lm', 'error_in_caption']
 
+''' The regression set is stored in an SQLite file: samples are appended without rewriting the rest, read by index or
+streamed in order, and waivers are updated in place. Each sample is a (sample dict, ground truth synsets) pair, indexed
+by its position in the set. Samples are indexed by language (from their source dataset), and waivers by reason.
+The first time the store is opened, the samples and waivers of reg3.json (if it exists) are imported. If neither file
+exists the store is empty, and it's only created on disk by writes (appending samples, waiving or importing another
+json regression file with python src/regression.py --migrate <json file>). Changes are written on save(), as before.
+'''
+
+# Languages of the sources that aren't CrossModal3600 datasets
+source_to_language = {'COCO': 'en', 'STAIR-captions': 'ja'}
+# Samples are read in chunks when streamed
+stream_chunk_size = 1000
+
+def get_sample_language(sample):
+    source = sample.get('source')
+    if source is None:
+        return None
+    if source.startswith('xm3600_'):
+        return source.split('xm3600_')[1]
+    return source_to_language.get(source)
+
+class RegSamplesView(Sequence):
+    ''' A read-only list-like view of the regression samples, read from the store on access. '''
+    def __init__(self, handler):
+        self.handler = handler
+
+    def __len__(self):
+        return self.handler.conn.execute('SELECT COUNT(*) FROM samples').fetchone()[0]
+
+    def __getitem__(self, ind):
+        if isinstance(ind, slice):
+            start, stop, step = ind.indices(len(self))
+            rows = self.handler.conn.execute('SELECT sample, gt FROM samples WHERE ind >= ? AND ind < ? ORDER BY ind', (start, stop)).fetchall()
+            return [[json.loads(sample), json.loads(gt)] for sample, gt in rows][::step]
+        if ind < 0:
+            ind += len(self)
+        row = self.handler.conn.execute('SELECT sample, gt FROM samples WHERE ind = ?', (ind,)).fetchone()
+        if row is None:
+            raise IndexError(f'Regression sample index {ind} out of range')
+        return [json.loads(row[0]), json.loads(row[1])]
+
+    def __iter__(self):
+        for _, sample, gt in self.handler.iter_samples():
+            yield [sample, gt]
+
+class WaiversView(Mapping):
+    ''' A read-only dict-like view of the waivers, from the sample index (as a string, like the json keys) to the
+    reason. Integer indices may also be used for lookups. '''
+    def __init__(self, handler):
+        self.handler = handler
+
+    def __getitem__(self, ind):
+        try:
+            ind = int(ind)
+        except (TypeError, ValueError):
+            raise KeyError(ind)
+        row = self.handler.conn.execute('SELECT reason FROM waivers WHERE ind = ?', (ind,)).fetchone()
+        if row is None:
+            raise KeyError(ind)
+        return row[0]
+
+    def __iter__(self):
+        for (ind,) in self.handler.conn.execute('SELECT ind FROM waivers ORDER BY ind').fetchall():
+            yield str(ind)
+
+    def __len__(self):
+        return self.handler.conn.execute('SELECT COUNT(*) FROM waivers').fetchone()[0]
+
 class RegressionHandler:
-    def __init__(self):
-        self.reg_file = reg_file
-        if os.path.isfile(self.reg_file):
-            with open(self.reg_file, 'r') as fp:
-                self.reg, self.waivers = json.load(fp)
-        else:
-            self.reg = []
-            self.waivers = {}
+    def __init__(self, db_file=reg_db_file, json_file=reg_file):
+        self.reg_file = db_file
+        self.json_file = json_file
+        self._conn = None
+        # True while reading a store that doesn't exist on disk (an empty in-memory one)
+        self._in_memory = False
+        self.reg = RegSamplesView(self)
+        self.waivers = WaiversView(self)
+
+    @property
+    def conn(self):
+        # Opened on first use. A missing store is imported from the json file if there is one, and is otherwise read as
+        #  an empty store without creating it
+        if self._conn is None:
+            if os.path.isfile(self.reg_file):
+                self.open()
+            elif self.json_file is not None and os.path.isfile(self.json_file):
+                self.import_json(self.json_file)
+                self.save()
+            else:
+                self._conn = self.connect(':memory:')
+                self._in_memory = True
+        return self._conn
+
+    @staticmethod
+    def connect(path):
+        conn = sqlite3.connect(path, timeout=60)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS samples (ind INTEGER PRIMARY KEY, language TEXT, sample TEXT, gt TEXT)')
+        conn.execute('CREATE INDEX IF NOT EXISTS samples_language ON samples (language)')
+        conn.execute('CREATE TABLE IF NOT EXISTS waivers (ind INTEGER PRIMARY KEY, reason TEXT)')
+        conn.execute('CREATE INDEX IF NOT EXISTS waivers_reason ON waivers (reason)')
+        conn.commit()
+        return conn
+
+    def open(self):
+        # Opens the store on disk for writing, creating it if it's missing
+        if self._conn is not None and not self._in_memory:
+            return
+        if self._in_memory:
+            # The in-memory store is empty, since any write would have opened the one on disk
+            self._conn.close()
+            self._in_memory = False
+        self._conn = self.connect(self.reg_file)
+
+    def import_json(self, json_file):
+        # Append the samples and the waivers of a json regression file ([samples, waivers], as written by the json
+        #  store). Waiver indices are relative to the json file's samples
+        with open(json_file, 'r') as fp:
+            samples, waivers = json.load(fp)
+        self.open()
+        first_ind = len(self.reg)
+        for sample in samples:
+            self.append(sample)
+        for ind, reason in waivers.items():
+            self.waive(first_ind + int(ind), reason)
 
     def save(self):
-        with open(self.reg_file, 'w') as fp:
-            fp.write(json.dumps([self.reg, self.waivers]))
+        if self._conn is not None:
+            self._conn.commit()
 
     def append(self, sample):
-        self.reg.append(sample)
+        # sample is a (sample dict, ground truth synsets) pair
+        self.open()
+        self.conn.execute(
+            'INSERT INTO samples (ind, language, sample, gt) VALUES ((SELECT COALESCE(MAX(ind), -1) + 1 FROM samples), ?, ?, ?)',
+            (get_sample_language(sample[0]), json.dumps(sample[0]), json.dumps(sample[1]))
+        )
 
     def waive(self, ind, reason):
         assert reason in WAIVERS
-        self.waivers[ind] = reason
+        self.open()
+        self.conn.execute('INSERT OR REPLACE INTO waivers (ind, reason) VALUES (?, ?)', (int(ind), reason))
 
     def remove_waiver(self, ind):
-        if str(ind) in self.waivers:
-            del self.waivers[ind]
+        self.conn.execute('DELETE FROM waivers WHERE ind = ?', (int(ind),))
+
+    def get_filter(self, language=None, waiver_reason=None):
+        conditions = []
+        args = []
+        if language is not None:
+            conditions.append('samples.language = ?')
+            args.append(language)
+        if waiver_reason is not None:
+            conditions.append('samples.ind IN (SELECT ind FROM waivers WHERE reason = ?)')
+            args.append(waiver_reason)
+        return ' AND '.join(conditions) if len(conditions) > 0 else '1', args
+
+    def count(self, language=None, waiver_reason=None):
+        condition, args = self.get_filter(language, waiver_reason)
+        return self.conn.execute(f'SELECT COUNT(*) FROM samples WHERE {condition}', args).fetchone()[0]
+
+    def iter_samples(self, language=None, waiver_reason=None):
+        # Stream (index, sample dict, ground truth) triplets in order, optionally only of the given language and/or
+        #  waiver reason. Samples are read in chunks, so the set is never loaded entirely
+        condition, args = self.get_filter(language, waiver_reason)
+        last_ind = -1
+        while True:
+            rows = self.conn.execute(
+                f'SELECT ind, sample, gt FROM samples WHERE {condition} AND ind > ? ORDER BY ind LIMIT ?',
+                args + [last_ind, stream_chunk_size]
+            ).fetchall()
+            if len(rows) == 0:
+                break
+            for ind, sample, gt in rows:
+                yield ind, json.loads(sample), json.loads(gt)
+            last_ind = rows[-1][0]
+
+    def languages(self):
+        return [language for (language,) in self.conn.execute('SELECT DISTINCT language FROM samples ORDER BY language').fetchall()]
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--migrate', default=None, metavar='JSON_FILE', help='Append the samples and waivers of a json regression file to the store')
+    args = parser.parse_args()
+
+    reg_obj = RegressionHandler()
+    if args.migrate is not None:
+        reg_obj.import_json(args.migrate)
+        reg_obj.save()
+    print(f'{len(reg_obj.reg)} samples, {len(reg_obj.waivers)} waivers')
+    for language in reg_obj.languages():
+        if language is not None:
+            print(f'\t{language}: {reg_obj.count(language=language)} samples')
@@ -0,0 +1,161 @@
+from collections import defaultdict
+
+''' Declarative token rules (data/token_rules.json), compiled into functions over a Sentence.
+A rule is {"if": [condition, ...], ...} and applies when all its conditions hold. A condition is a dict:
+    "offset": position relative to the current token (default 0). If there's no token there the condition fails
+    "of": "head": check the head of the token instead. As in the parser's output the head index is head - 1, so the
+        root's head is the last token
+    "text"/"lower_text"/"upos"/"xpos"/"deprel": lists of allowed values
+    "child"/"no_child": a condition that some/no direct child of the token satisfies
+    "not": a condition that should not hold
+Word sense rules ("word_senses") give the candidate synsets of single words based on their context: the "then" of the
+first rule that applies, or "default". A token tagged as NOUN is a noun unless one of the "noun_exceptions" applies, and
+other tokens aren't nouns unless one of the "non_noun_exceptions" applies.
+Rules are named by their position in the file (e.g., "noun_exceptions[2]", "word_senses.glass[0]" or
+"word_senses.glass.default"), and when a Metrics object (see metrics.py) is given the hits of each rule are counted.
+'''
+
+# Condition fields and the Sentence lists they are checked against
+value_fields = {'text': 'text', 'lower_text': 'lower', 'upos': 'upos', 'xpos': 'xpos', 'deprel': 'deprel'}
+
+def compile_condition(condition):
+    # Returns a function of (sentence, token index)
+    checks = []
+    for field, attr in value_fields.items():
+        if field in condition:
+            allowed = frozenset(condition[field])
+            checks.append(lambda sentence, ind, attr=attr, allowed=allowed: getattr(sentence, attr)[ind] in allowed)
+    if 'child' in condition:
+        child_check = compile_condition(condition['child'])
+        checks.append(lambda sentence, ind: any(child_check(sentence, x) for x in sentence.children[ind]))
+    if 'no_child' in condition:
+        no_child_check = compile_condition(condition['no_child'])
+        checks.append(lambda sentence, ind: not any(no_child_check(sentence, x) for x in sentence.children[ind]))
+    if 'not' in condition:
+        not_check = compile_condition(condition['not'])
+        checks.append(lambda sentence, ind: not not_check(sentence, ind))
+
+    offset = condition.get('offset', 0)
+    of_head = condition.get('of') == 'head'
+    assert condition.get('of') in [None, 'head'], f'Unknown token reference {condition["of"]}'
+    assert not (of_head and offset != 0), 'offset and "of" cannot be combined'
+
+    def check(sentence, ind):
+        if of_head:
+            ind = sentence.head[ind] - 1
+        elif offset != 0:
+            ind += offset
+            if ind < 0 or ind >= len(sentence):
+                return False
+        for cur_check in checks:
+            if not cur_check(sentence, ind):
+                return False
+        return True
+
+    return check
+
+def compile_rule(rule):
+    checks = [compile_condition(condition) for condition in rule['if']]
+    return lambda sentence, ind: all(check(sentence, ind) for check in checks)
+
+def get_own_texts(rule):
+    # The texts the token itself must have for the rule to apply, or None if the rule doesn't restrict it
+    for condition in rule['if']:
+        if 'text' in condition and 'offset' not in condition and 'of' not in condition:
+            return condition['text']
+    return None
+
+def to_synset_list(synsets):
+    return [tuple(x) for x in synsets]
+
+class RuleEngine:
+    def __init__(self, rules):
+        self.word_to_senses = {}
+        for entry in rules['word_senses']:
+            compiled = (
+                [(i, compile_rule(rule), to_synset_list(rule['then'])) for i, rule in enumerate(entry['rules'])],
+                to_synset_list(entry['default'])
+            )
+            for word in entry['words']:
+                assert word not in self.word_to_senses, f'Word {word} has more than one word sense entry'
+                self.word_to_senses[word] = compiled
+
+        # Within each exception list the rules have the same outcome, so their order doesn't matter and rules that
+        #  restrict the token's own text are only checked for these texts
+        self.noun_exceptions = self.compile_exceptions(rules['noun_exceptions'], 'noun_exceptions')
+        self.non_noun_exceptions = self.compile_exceptions(rules['non_noun_exceptions'], 'non_noun_exceptions')
+
+    @staticmethod
+    def compile_exceptions(rules, list_name):
+        # Compiled rules are (name, function) pairs
+        text_to_rules = defaultdict(list)
+        general_rules = []
+        for i, rule in enumerate(rules):
+            named_rule = (f'{list_name}[{i}]', compile_rule(rule))
+            own_texts = get_own_texts(rule)
+            if own_texts is None:
+                general_rules.append(named_rule)
+            else:
+                for text in own_texts:
+                    text_to_rules[text].append(named_rule)
+        return dict(text_to_rules), general_rules
+
+    def analyze(self, sentence, metrics=None):
+        return SentenceRules(self, sentence, metrics)
+
+class SentenceRules:
+    ''' The rule results of a single sentence. Each token's noun status and word senses are computed at most once. '''
+    def __init__(self, engine, sentence, metrics=None):
+        self.engine = engine
+        self.sentence = sentence
+        self.metrics = metrics
+        self.noun = [None]*len(sentence)
+        self.senses = {}
+
+    def is_noun(self, ind):
+        if self.noun[ind] is None:
+            if self.sentence.upos[ind] == 'NOUN':
+                self.noun[ind] = not self.any_applies(self.engine.noun_exceptions, ind)
+            else:
+                self.noun[ind] = self.any_applies(self.engine.non_noun_exceptions, ind)
+        return self.noun[ind]
+
+    def any_applies(self, exceptions, ind):
+        text_to_rules, general_rules = exceptions
+        for rule_name, rule in text_to_rules.get(self.sentence.text[ind], ()):
+            if rule(self.sentence, ind):
+                self.count_hit(rule_name)
+                return True
+        for rule_name, rule in general_rules:
+            if rule(self.sentence, ind):
+                self.count_hit(rule_name)
+                return True
+        return False
+
+    def count_hit(self, rule_name):
+        if self.metrics is not None:
+            self.metrics.count(f'rule.{rule_name}')
+
+    def has_word_senses(self, ind):
+        return self.sentence.text[ind] in self.engine.word_to_senses
+
+    def word_senses(self, ind):
+        # The candidate synsets of a single word token, as (synset, distance from match) pairs
+        if ind not in self.senses:
+            word = self.sentence.text[ind]
+            rules, default = self.engine.word_to_senses[word]
+            self.senses[ind] = default
+            rule_name = f'word_senses.{word}.default'
+            for i, rule, synsets in rules:
+                if rule(self.sentence, ind):
+                    self.senses[ind] = synsets
+                    rule_name = f'word_senses.{word}[{i}]'
+                    break
+            self.count_hit(rule_name)
+        return self.senses[ind]
+
+    def evaluate(self):
+        # Evaluate the rules of all the tokens now rather than on demand (e.g., to time the rules separately)
+        for i in range(len(self.sentence)):
+            if self.is_noun(i) and self.has_word_senses(i):
+                self.word_senses(i)
@@ -1,29 +1,32 @@
-from find_synsets_in_captions import find_synsets
-from regression import RegressionHandler
+import sys
+sys.path.append('.')
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+from find_synsets_in_captions import get_default_extractor
+from regression import RegressionHandler, WAIVERS
+from worker_utils import limit_worker_threads
 import time
 
-def run_regression():
-    reg_obj = RegressionHandler()
-    failed = []
-    waived_and_passed = []
-    waived_and_failed = []
-    print('Running regression', flush=True)
-    t = time.time()
-    for i in range(len(reg_obj.reg)):
-        if i % 1000 == 0:
-            print(f'\tStarting sample {i} out of {len(reg_obj.reg)}, time from prev {time.time() - t}', flush=True)
-            t = time.time()
-        sample, gt = reg_obj.reg[i]
-        res = find_synsets(sample['caption'])
-        pred = [x[3] for x in res if x[3] is not None]
-        if sorted(gt) != sorted(pred):
-            if str(i) in reg_obj.waivers:
-                waived_and_failed.append(i)
-            else:
-                failed.append(i)
-        elif str(i) in reg_obj.waivers:
-            waived_and_passed.append(i)
-    passed_count = len(reg_obj.reg) - len(failed) - len(waived_and_failed) - len(waived_and_passed)
+def get_pred(res):
+    # Captions with more than one sentence have no result
+    if res is None:
+        return []
+    return [x[3] for x in res if x[3] is not None]
+
+def get_sample_status(ind, gt, pred, waivers):
+    if sorted(gt) != sorted(pred):
+        if str(ind) in waivers:
+            return 'waived_and_failed'
+        return 'failed'
+    elif str(ind) in waivers:
+        return 'waived_and_passed'
+    return 'passed'
+
+def print_results(sample_num, failed, waived_and_passed, waived_and_failed):
+    passed_count = sample_num - len(failed) - len(waived_and_failed) - len(waived_and_passed)
     print('Finished regression, results:')
     print(f'{passed_count} succeeded, {len(failed)} failed, {len(waived_and_passed)} passed with waiver, {len(waived_and_failed)} failed with waiver')
     print('Fail list:')
@@ -32,3 +35,221 @@ def run_regression():
     print(waived_and_passed)
     print('Failed with waiver:')
     print(waived_and_failed)
+
+def get_regression_handler(reg_json=None):
+    # The regression store, or the samples of a json regression file (e.g., src/reg.json) read into an in-memory store
+    if reg_json is None:
+        return RegressionHandler()
+    return RegressionHandler(db_file=':memory:', json_file=reg_json)
+
+def get_regression_extractor(use_cache):
+    # Both modes run with the same caches, so their results and latencies are comparable. Without the caches the
+    #  whole pipeline runs for every sample
+    extractor = get_default_extractor()
+    if not use_cache:
+        extractor.lm_cache = None
+        extractor.result_cache = None
+    return extractor
+
+def run_regression(batch_size=1000, language=None, waiver_reason=None, use_cache=False, reg_json=None):
+    # Samples are streamed from the regression store, optionally only those of a language and/or a waiver reason
+    reg_obj = get_regression_handler(reg_json)
+    extractor = get_regression_extractor(use_cache)
+    sample_num = reg_obj.count(language, waiver_reason)
+    samples = reg_obj.iter_samples(language, waiver_reason)
+    failed = []
+    waived_and_passed = []
+    waived_and_failed = []
+    print('Running regression', flush=True)
+    t = time.time()
+    for batch_start in range(0, sample_num, batch_size):
+        print(f'\tStarting sample {batch_start} out of {sample_num}, time from prev {time.time() - t}', flush=True)
+        t = time.time()
+        batch = list(itertools.islice(samples, batch_size))
+        batch_res = extractor.find_synsets_batch([sample['caption'] for _, sample, _ in batch])
+        for (i, _, gt), res in zip(batch, batch_res):
+            status = get_sample_status(i, gt, get_pred(res), reg_obj.waivers)
+            if status == 'failed':
+                failed.append(i)
+            elif status == 'waived_and_failed':
+                waived_and_failed.append(i)
+            elif status == 'waived_and_passed':
+                waived_and_passed.append(i)
+    if extractor.lm_cache is not None:
+        print(f'LM cache: {extractor.lm_cache.hits} hits, {extractor.lm_cache.misses} misses, {extractor.lm_cache.size} entries', flush=True)
+    print(f'Deduplicated {extractor.dedup_count} captions (identical captions and result cache hits)', flush=True)
+    print_results(sample_num, failed, waived_and_passed, waived_and_failed)
+
+def check_batched(batch_size=1000, language=None, waiver_reason=None, reg_json=None):
+    # find_synsets_batch should return exactly what find_synsets returns for each caption. Compares the full results
+    #  (not only the synsets) of the two paths on the regression samples, without the caches. The LM scores each text in
+    #  a forward pass of its own in both paths, so differences are due to the batched pipeline and not to the
+    #  padding of LM batches
+    reg_obj = get_regression_handler(reg_json)
+    extractor = get_regression_extractor(use_cache=False)
+    extractor.lm_batch_size = 1
+    samples = [(i, sample['caption']) for i, sample, _ in reg_obj.iter_samples(language, waiver_reason)]
+    print(f'Comparing find_synsets and find_synsets_batch on {len(samples)} samples', flush=True)
+    single_res = [extractor.find_synsets(caption) for _, caption in samples]
+    batch_res = extractor.find_synsets_batch([caption for _, caption in samples], batch_size)
+    mismatches = [i for (i, _), res1, res2 in zip(samples, single_res, batch_res) if res1 != res2]
+    print(f'{len(samples) - len(mismatches)} of {len(samples)} samples have identical results, mismatches:')
+    print(mismatches)
+    return mismatches
+
+def check_lm_batching(batch_size=1000, language=None, waiver_reason=None, reg_json=None):
+    # Padded LM batches aren't numerically identical to scoring each text on its own: attention over the padding and
+    #  the different matmul shapes change the scores slightly, so near tied candidates may be chosen differently.
+    #  Measures how many regression samples get the same results with the configured LM batch size as with batches of
+    #  a single text, without the caches
+    reg_obj = get_regression_handler(reg_json)
+    extractor = get_regression_extractor(use_cache=False)
+    samples = [(i, sample['caption']) for i, sample, _ in reg_obj.iter_samples(language, waiver_reason)]
+    captions = [caption for _, caption in samples]
+    configured_lm_batch_size = extractor.lm_batch_size
+    print(f'Comparing LM batch sizes 1 and {configured_lm_batch_size} on {len(samples)} samples', flush=True)
+    extractor.lm_batch_size = 1
+    unbatched_res = extractor.find_synsets_batch(captions, batch_size)
+    extractor.lm_batch_size = configured_lm_batch_size
+    batched_res = extractor.find_synsets_batch(captions, batch_size)
+    mismatches = [i for (i, _), res1, res2 in zip(samples, unbatched_res, batched_res) if res1 != res2]
+    agreement = (len(samples) - len(mismatches))/len(samples) if len(samples) > 0 else None
+    print(f'{len(samples) - len(mismatches)} of {len(samples)} samples have identical results (agreement {agreement}), mismatches:')
+    print(mismatches)
+    return agreement, mismatches
+
+''' Parallel mode: the regression set (or only the samples of a language and/or a waiver reason) is split into shards of
+consecutive samples that are run by a pool of worker processes. With batch_size 1 each caption is run on its own, so the
+recorded latency is the caption's latency. With a larger batch_size captions are run in batches, and each caption is
+assigned the average latency of its batch.
+'''
+
+# Worker state
+worker_extractor = None
+# Run once by each worker before the timed samples, so model loading isn't counted in the first sample's latency
+warmup_caption = 'A dog sleeping on a bed next to a window'
+
+def init_regression_worker(num_threads, use_cache):
+    global worker_extractor
+    limit_worker_threads(num_threads)
+    worker_extractor = get_regression_extractor(use_cache)
+    worker_extractor.find_synsets(warmup_caption)
+
+def run_regression_shard(shard):
+    # The shard is a list of (sample index, caption) pairs. Returns (sample index, prediction, latency) triplets
+    shard_samples, batch_size = shard
+    res = []
+    for batch_start in range(0, len(shard_samples), batch_size):
+        batch_inds = [i for i, _ in shard_samples[batch_start:batch_start+batch_size]]
+        captions = [caption for _, caption in shard_samples[batch_start:batch_start+batch_size]]
+        t = time.time()
+        if batch_size == 1:
+            batch_res = [worker_extractor.find_synsets(captions[0])]
+        else:
+            batch_res = worker_extractor.find_synsets_batch(captions)
+        latency = (time.time() - t)/len(batch_inds)
+        res += [(i, get_pred(cur_res), latency) for i, cur_res in zip(batch_inds, batch_res)]
+    return res
+
+def get_percentile(sorted_vals, percentile):
+    if len(sorted_vals) == 0:
+        return None
+    return sorted_vals[min(len(sorted_vals) - 1, int(len(sorted_vals)*percentile/100))]
+
+def get_shards(reg_obj, shard_size, batch_size, language=None, waiver_reason=None):
+    # Shards of consecutive (filtered) samples, with only the captions the workers need. Built before the pool runs,
+    #  since the regression store's connection can't be used by the pool's task thread
+    samples = ((i, sample['caption']) for i, sample, _ in reg_obj.iter_samples(language, waiver_reason))
+    shards = []
+    while True:
+        shard_samples = list(itertools.islice(samples, shard_size))
+        if len(shard_samples) == 0:
+            break
+        shards.append((shard_samples, batch_size))
+    return shards
+
+def run_regression_parallel(worker_num, shard_size=100, threads_per_worker=None, batch_size=1, report_path=None, slowest_num=20, language=None, waiver_reason=None, use_cache=False, reg_json=None):
+    if threads_per_worker is None:
+        threads_per_worker = max(1, os.cpu_count() // worker_num)
+    reg_obj = get_regression_handler(reg_json)
+    sample_num = reg_obj.count(language, waiver_reason)
+    if sample_num == 0:
+        # Nothing to run or report (there are no latencies to summarize)
+        print(f'No regression samples match the filters (language {language}, waiver reason {waiver_reason})', flush=True)
+        return None
+    shards = get_shards(reg_obj, shard_size, batch_size, language, waiver_reason)
+    print(f'Running regression on {sample_num} samples with {worker_num} workers', flush=True)
+
+    t = time.time()
+    sample_res = []
+    # Spawn rather than fork: CUDA and the torch thread pools don't survive forking
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(worker_num, initializer=init_regression_worker, initargs=(threads_per_worker, use_cache)) as pool:
+        for shard_res in pool.imap_unordered(run_regression_shard, shards):
+            sample_res += shard_res
+    wall_time = time.time() - t
+    sample_res.sort(key=lambda x: x[0])
+
+    status_to_inds = {'passed': [], 'failed': [], 'waived_and_passed': [], 'waived_and_failed': []}
+    samples = []
+    for i, pred, latency in sample_res:
+        status = get_sample_status(i, reg_obj.reg[i][1], pred, reg_obj.waivers)
+        status_to_inds[status].append(i)
+        samples.append({'index': i, 'status': status, 'latency': latency})
+    print_results(sample_num, status_to_inds['failed'], status_to_inds['waived_and_passed'], status_to_inds['waived_and_failed'])
+
+    latencies = sorted([x['latency'] for x in samples])
+    slowest = sorted(samples, key=lambda x: x['latency'], reverse=True)[:slowest_num]
+    report = {
+        'sample_num': sample_num,
+        'language': language,
+        'waiver_reason': waiver_reason,
+        'use_cache': use_cache,
+        'worker_num': worker_num,
+        'threads_per_worker': threads_per_worker,
+        'batch_size': batch_size,
+        'wall_time': wall_time,
+        'captions_per_sec': sample_num/wall_time if wall_time > 0 else None,
+        'latency_mean': sum(latencies)/len(latencies) if len(latencies) > 0 else None,
+        'latency_p50': get_percentile(latencies, 50),
+        'latency_p99': get_percentile(latencies, 99),
+        'slowest': [dict(x, caption=reg_obj.reg[x['index']][0]['caption']) for x in slowest],
+        'failed': status_to_inds['failed'],
+        'waived_and_passed': status_to_inds['waived_and_passed'],
+        'waived_and_failed': status_to_inds['waived_and_failed'],
+        'samples': samples
+    }
+    print(f'{report["captions_per_sec"]:.1f} captions/sec, latency p50 {report["latency_p50"]:.4f}s, p99 {report["latency_p99"]:.4f}s', flush=True)
+    if report_path is not None:
+        with open(report_path, 'w') as fp:
+            fp.write(json.dumps(report))
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=None, help='Run in parallel with this many worker processes')
+    parser.add_argument('--shard_size', type=int, default=100)
+    parser.add_argument('--threads_per_worker', type=int, default=None, help='Torch threads in each worker, by default the cores are split between the workers')
+    parser.add_argument('--batch_size', type=int, default=None, help='Captions per find_synsets_batch call (in parallel mode the default is 1, so latencies are per caption)')
+    parser.add_argument('--report', default=None, help='In parallel mode, path of a json file to write the per-sample latencies and the results to')
+    parser.add_argument('--language', default=None, help='Run only the samples of this language (e.g., he)')
+    parser.add_argument('--waiver', default=None, choices=WAIVERS, help='Run only the samples waived for this reason')
+    parser.add_argument('--use_cache', action='store_true', help='Use the LM and result caches (in both modes, by default both are disabled)')
+    parser.add_argument('--reg_json', default=None, help='Run the samples of this json regression file (e.g., src/reg.json) instead of the regression store')
+    parser.add_argument('--check_batched', action='store_true', help='Check that find_synsets_batch returns the same results as find_synsets on each sample')
+    parser.add_argument('--check_lm_batching', action='store_true', help='Measure the agreement of the results with the configured LM batch size and with LM batches of a single text')
+    args = parser.parse_args()
+
+    if args.check_batched:
+        mismatches = check_batched(1000 if args.batch_size is None else args.batch_size, args.language, args.waiver, args.reg_json)
+        sys.exit(1 if len(mismatches) > 0 else 0)
+    elif args.check_lm_batching:
+        check_lm_batching(1000 if args.batch_size is None else args.batch_size, args.language, args.waiver, args.reg_json)
+    elif args.workers is None:
+        run_regression(1000 if args.batch_size is None else args.batch_size, args.language, args.waiver, args.use_cache, args.reg_json)
+    else:
+        run_regression_parallel(
+            args.workers, args.shard_size, args.threads_per_worker, 1 if args.batch_size is None else args.batch_size,
+            args.report, language=args.language, waiver_reason=args.waiver, use_cache=args.use_cache,
+            reg_json=args.reg_json
+        )
@@ -0,0 +1,47 @@
+class Sentence:
+    ''' A parsed sentence as parallel lists (one entry per token) of the fields we use, and the children of each token.
+    Heads are as in the parser's output: 1-based, with 0 for the root.
+    '''
+    __slots__ = ['text', 'lower', 'upos', 'xpos', 'deprel', 'head', 'children']
+
+    def __init__(self, text, upos, xpos, deprel, head):
+        self.text = text
+        self.lower = [x.lower() for x in text]
+        self.upos = upos
+        self.xpos = xpos
+        self.deprel = deprel
+        self.head = head
+        self.children = [[] for _ in range(len(text))]
+        for i, cur_head in enumerate(head):
+            if cur_head > 0:
+                self.children[cur_head - 1].append(i)
+
+    @classmethod
+    def from_stanza(cls, stanza_sentence):
+        # The fields are read from the first word of each token (we don't expect multi-word tokens in English captions)
+        tokens = stanza_sentence.tokens
+        words = [token.words[0] for token in tokens]
+        return cls(
+            [token.text for token in tokens],
+            [word.upos for word in words],
+            [word.xpos for word in words],
+            [word.deprel for word in words],
+            [word.head for word in words]
+        )
+
+    @classmethod
+    def from_token_list(cls, token_list):
+        # From the old representation: a list of the tokens' to_dict() outputs
+        return cls(
+            [x[0]['text'] for x in token_list],
+            [x[0].get('upos') for x in token_list],
+            [x[0].get('xpos') for x in token_list],
+            [x[0].get('deprel') for x in token_list],
+            [x[0]['head'] for x in token_list]
+        )
+
+    def __len__(self):
+        return len(self.text)
+
+    def phrase(self, start_ind, end_ind):
+        return ' '.join(self.text[start_ind:end_ind]).lower()
@@ -0,0 +1,94 @@
+import json
+import os
+import sqlite3
+import time
+
+# SQLite has a limit on the number of variables in a single statement
+query_chunk_size = 500
+
+class SQLiteCache:
+    ''' A persistent key-value cache in an SQLite table. Values are stored as json.
+    When max_entries is set and the table grows beyond it, the least recently used entries are evicted, down to 90% of
+    max_entries. Several processes may share the same file.
+    '''
+    def __init__(self, path, table, max_entries=None):
+        dir_name = os.path.dirname(path)
+        if dir_name != '':
+            os.makedirs(dir_name, exist_ok=True)
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT, last_access REAL)')
+        self.conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_last_access ON {table} (last_access)')
+        self.conn.commit()
+        self.size = self.count()
+
+    def count(self):
+        return self.conn.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def get_many(self, keys):
+        res = {}
+        for chunk_start in range(0, len(keys), query_chunk_size):
+            chunk = keys[chunk_start:chunk_start+query_chunk_size]
+            placeholders = ','.join(['?']*len(chunk))
+            rows = self.conn.execute(f'SELECT key, value FROM {self.table} WHERE key IN ({placeholders})', chunk)
+            for key, value in rows:
+                res[key] = json.loads(value)
+        if len(res) > 0:
+            now = time.time()
+            self.conn.executemany(f'UPDATE {self.table} SET last_access = ? WHERE key = ?', [(now, key) for key in res])
+            self.conn.commit()
+        self.hits += len(res)
+        self.misses += len(keys) - len(res)
+        return res
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def put_many(self, items):
+        now = time.time()
+        self.conn.executemany(
+            f'INSERT OR REPLACE INTO {self.table} (key, value, last_access) VALUES (?, ?, ?)',
+            [(key, json.dumps(value), now) for key, value in items]
+        )
+        self.conn.commit()
+        self.size += len(items)
+        if self.max_entries is not None and self.size > self.max_entries:
+            self.evict()
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def evict(self):
+        # Other processes may have written to the same file, so recount first
+        self.size = self.count()
+        if self.size <= self.max_entries:
+            return
+        to_evict = self.size - int(0.9*self.max_entries)
+        self.conn.execute(
+            f'DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} ORDER BY last_access LIMIT ?)',
+            (to_evict,)
+        )
+        self.conn.commit()
+        self.size = self.count()
+
+    def clear(self):
+        self.conn.execute(f'DELETE FROM {self.table}')
+        self.conn.commit()
+        self.size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits/lookups if lookups > 0 else 0,
+            'size': self.size
+        }
+
+    def close(self):
+        self.conn.close()
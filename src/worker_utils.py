@@ -0,0 +1,11 @@
+import os
+
+''' Helpers shared by the scripts that run the pipeline in a pool of worker processes. '''
+
+def limit_worker_threads(num_threads):
+    # Limit the threads of each worker before torch is imported, so the workers together don't oversubscribe the cores
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[var] = str(num_threads)
+    import torch
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
@@ -1,9 +1,10 @@
 import streamlit as st
 from streamlit_agraph import agraph, Node, Edge, Config
 import sys
-import json
 sys.path.append('.')
-from utils import all_synsets, child2parent, get_synset_to_image_prob, parent2children
+from utils import get_ontology
+from saliency_cube import get_saliency_cube
+from mention_index import get_mention_index
 import scipy.stats as stats
 from streamlit_app.app_utils import plot_clickable_images
 from collections import OrderedDict
@@ -21,7 +22,8 @@ lang_codes = [x.split('(')[1].split(')')[0] for x in lang_names_and_codes]
 lang_name2code = {lang_names[i]: lang_codes[i] for i in range(len(lang_names))}
 lang_code2name = {lang_codes[i]: lang_names[i] for i in range(len(lang_names))}
 
-root_synsets = set([x for x in all_synsets if x not in child2parent])
+ontology = get_ontology()
+root_synsets = set([x for x in ontology.all_synsets if x not in ontology.child2parent])
 
 # Each new time someone enters the app, the state is re initialized. So we need to reload the worksheet and data
 def initialize():
@@ -124,13 +126,13 @@ def concept_selection_page():
     if state.concept is None:
         concept_options = root_synsets
     else:
-        concept_options = parent2children[state.concept]
+        concept_options = ontology.parent2children.get(state.concept, ())
     st.selectbox(label='', key='concept_selection_box', options=concept_options)
     if state.languages is None:
         st.button('Select concept', key='concept_selection_button', on_click=to_language_selection_page)
     else:
         st.button('Select concept', key='concept_selection_button', on_click=to_language_by_concept_analysis_page)
-    if len(parent2children[state.concept_selection_box]) > 0:
+    if len(ontology.parent2children.get(state.concept_selection_box, ())) > 0:
         st.button('Select a sub concept', key='subconcept_selection_button', on_click=apply_concept_selection)
 
 def sub_concept_selection_page():
@@ -145,7 +147,7 @@ def sub_concept_selection_page():
         cur_concept = queue[0]
         nodes.append(Node(id=cur_concept, label=cur_concept, size=25, shape='rectangle'))
         queue = queue[1:]
-        children = parent2children[cur_concept]
+        children = ontology.parent2children.get(cur_concept, ())
         for child in children:
             queue.append(child)
             edges.append(Edge(source=cur_concept, target=child))
@@ -171,7 +173,7 @@ def by_language_concept_analysis_page():
 
 def by_single_language_concept_analysis_page():
     lang_code = lang_name2code[state.languages[0]]
-    synset_to_image_prob, _, _ = get_synset_to_image_prob(f'xm3600_{lang_code}')
+    synset_to_image_prob = {state.concept: get_saliency_cube().get_image_to_prob(lang_code, state.concept)}
     image_num = len([x for x in synset_to_image_prob[state.concept].values() if x > 0])
     st.subheader('Statistics')
     st.markdown(f'Out of the 3600 images in the datasets, {image_num} include captions mentioning {state.concept}')
@@ -189,10 +191,10 @@ def by_single_language_concept_analysis_page():
 
 def by_two_languages_concept_analysis_page():
     lang_code1 = lang_name2code[state.languages[0]]
-    synset_to_image_prob1, _, _ = get_synset_to_image_prob(f'xm3600_{lang_code1}')
+    synset_to_image_prob1 = {state.concept: get_saliency_cube().get_image_to_prob(lang_code1, state.concept)}
     image_num1 = len([x for x in synset_to_image_prob1[state.concept].values() if x > 0])
     lang_code2 = lang_name2code[state.languages[1]]
-    synset_to_image_prob2, _, _ = get_synset_to_image_prob(f'xm3600_{lang_code2}')
+    synset_to_image_prob2 = {state.concept: get_saliency_cube().get_image_to_prob(lang_code2, state.concept)}
     image_num2 = len([x for x in synset_to_image_prob2[state.concept].values() if x > 0])
     st.subheader('Statistics')
     st.markdown(f'Out of the 3600 images in the datasets, {image_num1} include captions in {state.languages[0]} and {image_num2} include captions in {state.languages[1]} mentioning {state.concept}')
@@ -213,9 +215,7 @@ def by_two_languages_concept_analysis_page():
     if prob_mean2:
         st.markdown(f'For {state.languages[1]}, in these {image_num2} images, the average fraction of annotators mentioning {state.concept} is {prob_mean2}')
 
-    with open(f'datasets/xm3600_{lang_code1}.json', 'r') as fp:
-        data1 = json.load(fp)
-    iids = list(set([x['image_id'] for x in data1]))
+    iids = get_saliency_cube().get_language_image_ids(lang_code1)
     pval1 = stats.wilcoxon([synset_to_image_prob1[state.concept][x] if x in synset_to_image_prob1[state.concept] else 0 for x in iids], [synset_to_image_prob2[state.concept][x] if x in synset_to_image_prob2[state.concept] else 0 for x in iids], alternative='greater', zero_method='zsplit').pvalue
     pval2 = stats.wilcoxon([synset_to_image_prob1[state.concept][x] if x in synset_to_image_prob1[state.concept] else 0 for x in iids], [synset_to_image_prob2[state.concept][x] if x in synset_to_image_prob2[state.concept] else 0 for x in iids], alternative='less', zero_method='zsplit').pvalue
     if pval1 < pval2:
@@ -252,11 +252,10 @@ def image_page():
     st.image(url)
 
     st.subheader('Captions')
+    mention_index = get_mention_index()
     for lang in state.languages:
         lang_code = lang_name2code[lang]
-        with open(f'datasets/xm3600_{lang_code}.json', 'r') as fp:
-            data = json.load(fp)
-        samples = [x for x in data if x['image_id'] == state.iid]
+        samples = [mention_index.get_sample(i) for i in mention_index.get_image_captions(lang_code, state.iid)]
         for sample in samples:
             with st.container(border=True):
                 if 'orig' in sample:
@@ -274,9 +273,8 @@ def concept_analysis_across_all_languages_page():
     for lang in lang_names:
         debug_print(lang)
         lang_code = lang_name2code[lang]
-        synset_to_image_prob, _, _ = get_synset_to_image_prob(f'xm3600_{lang_code}')
         # res[lang_code2name[lang]] = sum(synset_to_image_prob[state.concept].values())/3600
-        res[lang] = sum(synset_to_image_prob[state.concept].values())/3600
+        res[lang] = float(get_saliency_cube().get_saliency(lang_code, state.concept).sum())/3600
         # df[i] = [lang, sum(synset_to_image_prob[state.concept].values())/3600]
     st.bar_chart(res, y_label='Mean saliency')
     st.markdown(f'This plot presents the mean saliency of {state.concept} in each language.')
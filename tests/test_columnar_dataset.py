@@ -0,0 +1,65 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(package_dir)
+import columnar_dataset
+from columnar_dataset import export_dataset, has_columnar, load_samples
+from get_dataset import get_processed_dataset
+
+# Samples with a partial column (orig), samples without synsets, a sample without mentions, repeated synsets and
+#  non-ascii texts
+samples = [
+    {'image_id': 1, 'caption': 'A dog on a bed', 'orig': 'Un chien sur un lit', 'source': 'xm3600_fr',
+     'synsets': [[1, 2, 'dog', 'dog.n.01', 0], [4, 5, 'bed', 'bed.n.01', 0]]},
+    {'image_id': 18446744073709551615, 'caption': 'Two dogs', 'orig': 'Deux chiens ü', 'source': 'xm3600_fr',
+     'synsets': [[1, 2, 'dogs', 'dog.n.01', 1]]},
+    {'image_id': 3, 'caption': 'Multiple sentences. Here', 'source': 'xm3600_en', 'synsets': None},
+    {'image_id': 3, 'caption': 'Nothing to see', 'source': 'xm3600_en', 'synsets': []},
+    {'image_id': 4, 'caption': '', 'orig': '', 'source': 'xm3600_ja', 'synsets': [[0, 1, '猫', 'cat.n.01', 2]]}
+]
+dataset_name = 'test_dataset'
+
+class TestColumnarDataset(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        patches = [
+            mock.patch.object(columnar_dataset, 'datasets_dir', self.tmp_dir.name),
+            mock.patch.object(columnar_dataset, 'columnar_dir', os.path.join(self.tmp_dir.name, 'columnar'))
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(self.tmp_dir.cleanup)
+        with open(os.path.join(self.tmp_dir.name, f'{dataset_name}.json'), 'w') as fp:
+            fp.write(json.dumps(samples))
+
+    def test_round_trip(self):
+        self.assertFalse(has_columnar(dataset_name))
+        export_dataset(dataset_name)
+        self.assertTrue(has_columnar(dataset_name))
+        self.assertEqual(load_samples(dataset_name), samples)
+        self.assertEqual([list(sample.keys()) for sample in load_samples(dataset_name)], [list(sample.keys()) for sample in samples])
+
+    def test_same_as_json(self):
+        column_sets = [None, ['image_id', 'synsets'], ['caption'], ['orig'], ['synsets', 'orig'], ['missing'], []]
+        json_results = [get_processed_dataset(dataset_name, columns) for columns in column_sets]
+        export_dataset(dataset_name)
+        for columns, json_res in zip(column_sets, json_results):
+            columnar_res = get_processed_dataset(dataset_name, columns)
+            self.assertEqual(len(columnar_res), len(samples), str(columns))
+            self.assertEqual(columnar_res, json_res, str(columns))
+
+    def test_outdated_copy(self):
+        export_dataset(dataset_name)
+        with open(os.path.join(self.tmp_dir.name, f'{dataset_name}.json'), 'w') as fp:
+            fp.write(json.dumps(samples[:2]))
+        self.assertFalse(has_columnar(dataset_name))
+        self.assertEqual(get_processed_dataset(dataset_name), samples[:2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import os
+import sys
+import unittest
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(package_dir, 'src'))
+from phrase_rewriter import PhraseRewriter
+
+class TestPhraseRewriter(unittest.TestCase):
+    def setUp(self):
+        self.rewriter = PhraseRewriter({'lion fish': 'lionfish', 'ice cream cone': 'ice-cream cone', 'ice cream': 'ice-cream'})
+
+    def test_rewrite(self):
+        self.assertEqual(self.rewriter.rewrite('a lion fish and an ice cream cone'), 'a lionfish and an ice-cream cone')
+        # The longest phrase is taken
+        self.assertEqual(self.rewriter.rewrite('ice cream and an ice cream cone'), 'ice-cream and an ice-cream cone')
+        self.assertEqual(self.rewriter.rewrite('a lion fish.'), 'a lionfish.')
+        self.assertEqual(self.rewriter.rewrite('a lion and a fish'), 'a lion and a fish')
+
+    def test_empty(self):
+        self.assertEqual(PhraseRewriter({}).rewrite('a lion fish'), 'a lion fish')
+
+    def test_single_space(self):
+        # Words on different lines, or separated by other whitespace, are not a phrase
+        self.assertEqual(self.rewriter.rewrite('a lion\nfish in a tank'), 'a lion\nfish in a tank')
+        self.assertEqual(self.rewriter.rewrite('a lion\tfish, a lion  fish'), 'a lion\tfish, a lion  fish')
+        self.assertEqual(self.rewriter.rewrite('a lion.\nfish swim by the lion fish'), 'a lion.\nfish swim by the lionfish')
+        self.assertEqual(self.rewriter.rewrite('a lion. fish'), 'a lion. fish')
+
+    def test_hyphen_attachment(self):
+        # Hyphenated words are a single word for the parser, so phrases don't start, end or match inside them
+        self.assertEqual(self.rewriter.rewrite('a lion-fish'), 'a lion-fish')
+        self.assertEqual(self.rewriter.rewrite('a sea-lion fish'), 'a sea-lion fish')
+        self.assertEqual(self.rewriter.rewrite('a lion fish-tank'), 'a lion fish-tank')
+        self.assertEqual(self.rewriter.rewrite('an ice cream cone-shaped hat'), 'an ice-cream cone-shaped hat')
+        # A hyphen separated by spaces isn't attached
+        self.assertEqual(self.rewriter.rewrite('a lion fish - in a tank'), 'a lionfish - in a tank')
+
+if __name__ == '__main__':
+    unittest.main()
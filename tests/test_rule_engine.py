@@ -0,0 +1,272 @@
+import json
+import os
+import random
+import sys
+import unittest
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(package_dir)
+sys.path.append(os.path.join(package_dir, 'src'))
+from rule_engine import RuleEngine
+from sentence import Sentence
+
+''' data/token_rules.json replaced hand-written handlers: these tests run the compiled rule table and the original
+handlers (copied below, over the old token list representation) on the same sentences and expect the same results.
+'''
+
+# The original handlers. token_list[i][0] is the i-th token's dict, and heads are 1-based (0 for the root)
+
+def top_handling(token_list, start_ind):
+    if len([
+            x for x in token_list if x[0]['head'] == start_ind+1 and
+            x[0]['upos'] == 'DET' and
+            x[0]['text'].lower() in ['a', 'an']
+        ]) > 0 and \
+        len([
+            x for x in token_list if x[0]['head'] == start_ind+1 and
+            x[0]['deprel'] == 'compound'
+        ]) == 0:
+        return [('top.n.10', 0)]
+    return [(None, 0)]
+
+def water_handling(token_list, start_ind):
+    if start_ind > 0 and token_list[start_ind - 1][0]['text'] == 'the':
+        return [('body_of_water.n.01', 0)]
+    if start_ind > 1 and token_list[start_ind - 2][0]['text'] == 'body' and token_list[start_ind - 1][0]['text'] == 'of':
+        return [('body_of_water.n.01', 0)]
+    if start_ind > 1 and token_list[start_ind - 2][0]['text'] in ['pool', 'pools', 'pond', 'ponds'] and token_list[start_ind - 1][0]['text'] == 'of':
+        return [('body_of_water.n.01', 0)]
+    if start_ind > 1 and token_list[start_ind - 2][0]['text'] in ['bottle', 'bottles', 'glass', 'glasses'] and token_list[start_ind - 1][0]['text'] in ['of', 'with']:
+        return [('water.n.06', 0)]
+    if start_ind < len(token_list) - 1 and token_list[start_ind + 1][0]['text'] in ['bottle', 'glass', 'bottles', 'glasses', 'cup', 'cups', 'dispenser']:
+        return [('water.n.06', 0)]
+    if start_ind > 0 and token_list[start_ind - 1][0]['text'] in ['steaming', 'drinking', 'drinks', 'mineral']:
+        return [('water.n.06', 0)]
+    if start_ind < len(token_list) - 1 and token_list[start_ind + 1][0]['text'] in ['source', 'fountain', 'flowing', 'surface', 'channel', 'canal', 'channels', 'canals', 'stream']:
+        return [('body_of_water.n.01', 0)]
+    if start_ind > 0 and token_list[start_ind - 1][0]['text'] in ['clear', 'shallow', 'greenish', 'bluish', 'blue', 'sea', 'open', 'lake', 'green', 'river', 'ocean']:
+        return [('body_of_water.n.01', 0)]
+    if start_ind > 0 and token_list[start_ind - 1][0]['text'] == 'on':
+        return [('body_of_water.n.01', 0)]
+    if start_ind < len(token_list) - 1 and token_list[start_ind + 1][0]['text'] in ['slide']:
+        return [(None, 0)]
+    return [('water.n.06', 0), ('body_of_water.n.01', 0)]
+
+def mount_handling(token_list, start_ind):
+    if len([x for x in token_list if x[0]['head'] == start_ind + 1 and x[0]['upos'] == 'DET']) > 0:
+        return [(None, 0)]
+    return [('mountain.n.01', 0)]
+
+def lemon_handling(token_list, start_ind):
+    if (start_ind < len(token_list) - 1 and token_list[start_ind + 1][0]['text'] == 'yellow') or \
+        (start_ind < len(token_list) - 2 and token_list[start_ind + 1][0]['text'] == '-' and token_list[start_ind + 2][0]['text'] == 'yellow'):
+        return [(None, 0)]
+    return [('lemon.n.01', 0)]
+
+def knife_handling(token_list, start_ind):
+    if (start_ind > 1 and token_list[start_ind - 2][0]['text'] in ['fork', 'forks']) or \
+        (start_ind < len(token_list) - 2 and token_list[start_ind + 2][0]['text'] in ['fork', 'forks']):
+        return [('table_knife.n.01', 0)]
+    return [('knife.n.02', 0), ('table_knife.n.01', 0)]
+
+def mixer_handling(token_list, start_ind):
+    if start_ind > 0 and token_list[start_ind - 1][0]['text'] in ['cement', 'concrete']:
+        return [(None, 0)]
+    if start_ind < len(token_list) - 1 and token_list[start_ind + 1][0]['text'] in ['truck', 'trucks']:
+        return [(None, 0)]
+    if start_ind > 0 and token_list[start_ind - 1][0]['text'] in ['music', 'sound', 'dj', 'audio']:
+        return [('electronic_equipment.n.01', 1)]
+    return [('electronic_equipment.n.01', 1), ('kitchen_utensil.n.01', 1)]
+
+def preceding(preceding_words, synsets_if_applies, synsets_otherwise):
+    def handle(token_list, start_ind):
+        if start_ind > 0 and token_list[start_ind - 1][0]['text'] in preceding_words:
+            return synsets_if_applies
+        return synsets_otherwise
+    return handle
+
+def succeeding(succeeding_words, synsets_if_applies, synsets_otherwise):
+    def handle(token_list, start_ind):
+        if start_ind < len(token_list) - 1 and token_list[start_ind + 1][0]['text'] in succeeding_words:
+            return synsets_if_applies
+        return synsets_otherwise
+    return handle
+
+def preceding_succeeding(preceding_words, synsets_if_pro_applies, succeeding_words, synsets_if_succ_applies, synsets_otherwise):
+    def handle(token_list, start_ind):
+        if start_ind > 0 and token_list[start_ind - 1][0]['text'] in preceding_words:
+            return synsets_if_pro_applies
+        if start_ind < len(token_list) - 1 and token_list[start_ind + 1][0]['text'] in succeeding_words:
+            return synsets_if_succ_applies
+        return synsets_otherwise
+    return handle
+
+single_word_to_handling_func = {
+    'top': top_handling,
+    'tops': top_handling,
+    'mixer': mixer_handling,
+    'mixers': mixer_handling,
+    'couple': succeeding(['of'], [(None, 0)], [('couple.n.01', 0)]),
+    'couples': succeeding(['of'], [(None, 0)], [('couple.n.01', 0)]),
+    'pool': preceding(['swimming'], [(None, 0)], [('pond.n.01', 0), ('pool.n.06', 0)]),
+    'water': water_handling,
+    'bed': preceding(['flower', 'river'], [(None, 0)], [('bed.n.01', 0)]),
+    'beds': preceding(['flower', 'river'], [(None, 0)], [('bed.n.01', 0)]),
+    'mount': mount_handling,
+    'wrap': preceding(['plastic'], [(None, 0)], [('sandwich.n.01', 1)]),
+    'plate': preceding(['number', 'license'], [(None, 0)], [('plate.n.04', 0), (None, 0)]),
+    'plates': preceding(['number', 'license'], [(None, 0)], [('plate.n.04', 0)]),
+    'belt': preceding(['conveyor'], [(None, 0)], [('belt.n.02', 0)]),
+    'lemon': lemon_handling,
+    'fighter': succeeding(['jet', 'jets', 'plane', 'planes'], [('fighter.n.02', 0)], [('person.n.01', 1), ('fighter.n.02', 0)]),
+    'fighters': succeeding(['jet', 'jets', 'plane', 'planes'], [('fighter.n.02', 0)], [('person.n.01', 1), ('fighter.n.02', 0)]),
+    'mouse': preceding(['computer'], [(None, 0)], [('mouse.n.01', 0), (None, 0)]),
+    'processor': preceding(['food'], [(None, 0)], [('electronic_equipment.n.01', 1)]),
+    'processors': preceding(['food'], [(None, 0)], [('electronic_equipment.n.01', 1)]),
+    'player': preceding(['audio', 'music', 'record', 'media', 'digital'], [(None, 0)], [('player.n.01', 0)]),
+    'willow': succeeding(['house'], [(None, 0)], [('tree.n.01', 1)]),
+    'hand': preceding(['second'], [(None, 0)], [('hand.n.01', 0)]),
+    'plant': preceding(['power', 'industrial', 'treatment'], [('factory.n.01', 0)], [('plant.n.02', 0)]),
+    'plants': preceding(['power', 'industrial'], [('factory.n.01', 0)], [('plant.n.02', 0)]),
+    'slide': preceding_succeeding(['water'], [('plaything.n.01', 1)], ['projector'], [(None, 0)], [('plaything.n.01', 1), (None, 0)]),
+    'slides': preceding_succeeding(['water'], [('plaything.n.01', 1)], ['projector'], [(None, 0)], [('plaything.n.01', 1), (None, 0)]),
+    'jam': preceding(['traffic'], [(None, 0)], [('nutriment.n.01', 5)]),
+    'jams': preceding(['traffic'], [(None, 0)], [('nutriment.n.01', 5)]),
+    'hip': succeeding(['hop'], [(None, 0)], [('body_part.n.01', 1)]),
+    'knife': knife_handling,
+    'knives': knife_handling,
+    'leg': preceding(['wooden', 'metal', 'iron'], [(None, 0)], [('leg.n.01', 0)]),
+    'legs': preceding(['wooden', 'metal', 'iron'], [(None, 0)], [('leg.n.01', 0)]),
+    'palm': succeeding(['tree', 'trees', 'leaf', 'leaves', 'fruit', 'fruits', 'branch', 'branches'], [('palm.n.03', 2)], [('body_part.n.01', 0)]),
+    'head': preceding(['shower'], [(None, 0)], [('head.n.01', 0)]),
+}
+
+def is_noun(token_list, ind):
+    head_ind = token_list[ind][0]['head'] - 1
+
+    if token_list[ind][0]['upos'] == 'NOUN':
+        if token_list[head_ind][0]['xpos'] == 'VBN' and token_list[ind][0]['deprel'] == 'compound':
+            return False
+        if token_list[ind][0]['text'] == 'mini' and token_list[ind][0]['deprel'] == 'compound':
+            return False
+        if ind < len(token_list) - 1 and token_list[ind+1][0]['text'] == 'uniform':
+            return False
+        if token_list[ind][0]['text'] == 'glass' and ind < len(token_list) - 1 and token_list[ind+1][0]['upos'] == 'NOUN':
+            return False
+        if ind < len(token_list) - 1 and token_list[ind+1][0]['text'] in ['teeth', 'tooth']:
+            return False
+        return True
+
+    if token_list[ind][0]['text'].lower() == 'remote' and token_list[head_ind][0]['upos'] != 'NOUN':
+        return True
+    if token_list[ind][0]['text'] == 'baked' and ind < (len(token_list) - 1) and token_list[ind+1][0]['text'] == 'goods':
+        return True
+    if token_list[ind][0]['text'] == 'orange' and ind < (len(token_list) - 1) and token_list[ind+1][0]['text'] in ['slice', 'slices']:
+        return True
+    if token_list[ind][0]['text'] == 'german' and ind < (len(token_list) - 1) and token_list[ind+1][0]['text'] == 'shepherd':
+        return True
+    if token_list[ind][0]['text'] == 'pad' and ind < (len(token_list) - 1) and token_list[ind+1][0]['text'] == 'thai':
+        return True
+    if token_list[ind][0]['text'] == 'hot' and ind < (len(token_list) - 1) and token_list[ind+1][0]['text'] in ['dog', 'dogs']:
+        return True
+    if token_list[ind][0]['text'] == 'rolling' and ind < (len(token_list) - 1) and token_list[ind+1][0]['text'] in ['pin', 'pins']:
+        return True
+    return False
+
+def load_token_rules():
+    with open(os.path.join(package_dir, 'data', 'token_rules.json'), 'r') as fp:
+        return json.load(fp)
+
+def get_rule_texts(rules):
+    # All the texts the rules check, so random sentences hit the rules
+    texts = set()
+    if isinstance(rules, dict):
+        for key, value in rules.items():
+            if key in ['text', 'lower_text', 'words']:
+                texts.update(value)
+            else:
+                texts.update(get_rule_texts(value))
+    elif isinstance(rules, list):
+        for value in rules:
+            texts.update(get_rule_texts(value))
+    return texts
+
+def to_token_list(text, upos, xpos, deprel, head):
+    return [[{'text': x[0], 'upos': x[1], 'xpos': x[2], 'deprel': x[3], 'head': x[4]}] for x in zip(text, upos, xpos, deprel, head)]
+
+upos_values = ['NOUN', 'ADJ', 'VERB', 'DET', 'ADP', 'PROPN', 'PUNCT']
+xpos_values = ['NN', 'NNS', 'VBN', 'VBG', 'JJ', 'DT', 'IN']
+deprel_values = ['compound', 'det', 'amod', 'nsubj', 'root', 'obl', 'nmod']
+
+class TestRuleEngine(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.rules = load_token_rules()
+        cls.engine = RuleEngine(cls.rules)
+
+    def assert_same_as_handlers(self, token_list):
+        sentence_rules = self.engine.analyze(Sentence.from_token_list(token_list))
+        texts = [x[0]['text'] for x in token_list]
+        for i in range(len(token_list)):
+            self.assertEqual(sentence_rules.is_noun(i), is_noun(token_list, i), f'is_noun of token {i} in {texts}')
+            self.assertEqual(sentence_rules.has_word_senses(i), texts[i] in single_word_to_handling_func)
+            if texts[i] in single_word_to_handling_func:
+                self.assertEqual(
+                    sentence_rules.word_senses(i),
+                    single_word_to_handling_func[texts[i]](token_list, i),
+                    f'word senses of token {i} in {texts}'
+                )
+
+    def test_same_words(self):
+        self.assertEqual(set(self.engine.word_to_senses.keys()), set(single_word_to_handling_func.keys()))
+
+    def test_root_head_is_last_token(self):
+        # The root's head index is -1, so "of head" conditions check the last token: "remote" is a noun unless the
+        #  last token is a noun
+        token_list = to_token_list(['remote', 'on', 'table'], ['ADJ', 'ADP', 'NOUN'], ['JJ', 'IN', 'NN'], ['root', 'case', 'obl'], [0, 3, 1])
+        self.assertFalse(self.engine.analyze(Sentence.from_token_list(token_list)).is_noun(0))
+        token_list = to_token_list(['remote', 'on', 'it'], ['ADJ', 'ADP', 'PRON'], ['JJ', 'IN', 'PRP'], ['root', 'case', 'obl'], [0, 3, 1])
+        self.assertTrue(self.engine.analyze(Sentence.from_token_list(token_list)).is_noun(0))
+        # A noun compound whose head is the root: with a VBN last token it's not a noun
+        token_list = to_token_list(['flower', 'covered'], ['NOUN', 'VERB'], ['NN', 'VBN'], ['compound', 'root'], [0, 0])
+        self.assertFalse(self.engine.analyze(Sentence.from_token_list(token_list)).is_noun(0))
+        self.assert_same_as_handlers(token_list)
+
+    def test_preceding_and_succeeding_words(self):
+        cases = [
+            (['a', 'swimming', 'pool'], 2, [(None, 0)]),
+            (['a', 'pool'], 1, [('pond.n.01', 0), ('pool.n.06', 0)]),
+            (['a', 'flower', 'bed'], 2, [(None, 0)]),
+            (['in', 'the', 'water'], 2, [('body_of_water.n.01', 0)]),
+            (['bottle', 'of', 'water'], 2, [('water.n.06', 0)]),
+            (['water', 'slide'], 0, [(None, 0)]),
+            (['water', 'slide'], 1, [('plaything.n.01', 1)]),
+            (['a', 'power', 'plant'], 2, [('factory.n.01', 0)]),
+            (['a', 'treatment', 'plants'], 2, [('plant.n.02', 0)]),
+            (['lemon', '-', 'yellow'], 0, [(None, 0)]),
+            (['fork', 'and', 'knife'], 2, [('table_knife.n.01', 0)]),
+            (['knife', 'and', 'fork'], 0, [('table_knife.n.01', 0)]),
+        ]
+        for text, ind, expected in cases:
+            token_list = to_token_list(text, ['NOUN']*len(text), ['NN']*len(text), ['nmod']*len(text), [0]*len(text))
+            self.assertEqual(self.engine.analyze(Sentence.from_token_list(token_list)).word_senses(ind), expected, str(text))
+            self.assert_same_as_handlers(token_list)
+
+    def test_random_sentences(self):
+        # Random tags, dependencies and heads (not necessarily a tree) over the texts the rules check
+        vocabulary = sorted(get_rule_texts(self.rules) | set(single_word_to_handling_func.keys())) + \
+            ['Remote', 'A', 'dog', 'of', 'with', 'the', 'a']
+        random.seed(0)
+        for _ in range(5000):
+            length = random.randint(1, 6)
+            token_list = to_token_list(
+                [random.choice(vocabulary) for _ in range(length)],
+                [random.choice(upos_values) for _ in range(length)],
+                [random.choice(xpos_values) for _ in range(length)],
+                [random.choice(deprel_values) for _ in range(length)],
+                [random.randint(0, length) for _ in range(length)]
+            )
+            self.assert_same_as_handlers(token_list)
+
+if __name__ == '__main__':
+    unittest.main()
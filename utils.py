@@ -1,8 +1,13 @@
 from collections import defaultdict
-import csv
+from functools import cached_property
+from types import MappingProxyType
+import numpy as np
 import json
+import os
 from get_dataset import datasets, get_processed_dataset
-from config import use_low_resource_langs
+from config import use_low_resource_langs, xm3600_json_path, package_dir
+from ontology import OntologyIndex
+from image_metadata import ImageMetadata
 
 langs = [x.split('_')[1] for x in datasets if x.startswith('xm3600_')]
 low_resource_langs = ['bn', 'te', 'sw', 'quz', 'mi']
@@ -11,96 +16,201 @@ if not use_low_resource_langs:
 
 east_asian_langs = ['zh', 'ja', 'ko', 'th', 'vi', 'fil', 'id']
 
-# Root phrases:
-#   person, vehicle, furniture, animal, food, bag, clothing, tableware, plant, electronic_equipment, home_appliance,
-#   toy, building, mountain, kitchen_utensil, sky, sun, body_part, body_of_water, hand_tool, musical_instrument,
-#   writing_implement, jewelry, weapon, timepiece
-with open('data/phrase2synsets.json', 'r') as fp:
-    phrase2synsets = json.load(fp)
-
-with open('data/phrase2hypernym.json', 'r') as fp:
-    phrase2hypernym = json.load(fp)
-
-with open('data/synsets_c2p.json', 'r') as fp:
-    child2parent = json.load(fp)
-
-parent2children = defaultdict(list)
-for child, parent in child2parent.items():
-    parent2children[parent].append(child)
-
-with open('data/implicit_synsets.json', 'r') as fp:
-    implicit_synsets = json.load(fp)
-
-with open('data/phrase2replace_str.json', 'r') as fp:
-    phrase2replace_str = json.load(fp)
-    for x,y in phrase2replace_str.items():
-        if 'null' in y:
-            phrase2replace_str[x][None] = phrase2replace_str[x]['null']
-            del phrase2replace_str[x]['null']
-
-with open('data/non_synset_phrases.json', 'r') as fp:
-    non_synset_phrases = set(json.load(fp))
-
-with open('data/identical_synsets_mapping.json', 'r') as fp:
-    identical_synsets_mapping = json.load(fp)
+data_dir = os.path.join(package_dir, 'data')
 
 # Inflect don't handle some strings well, ignore these
 non_inflect_strs = [
     'dress', 'chess', 'lotus', 'cactus', 'asparagus', 'cross', 'gps'
 ]
 
-all_synsets = set([x for outer in phrase2synsets.values() for x in outer if x is not None]).union(implicit_synsets).union(child2parent)
+def freeze(value):
+    # A read-only copy of a json value: dicts become read-only views and lists tuples, at every level
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(x) for key, x in value.items()})
+    if isinstance(value, list):
+        return tuple([freeze(x) for x in value])
+    return value
+
+class Ontology:
+    ''' The ontology and the phrase lexicons of data/, each read on first access. Read-only: attributes can't be set,
+    and at every level mappings are read-only views, lists are tuples and sets are frozen. Pickling only records the
+    data directory, and unpickling gives the process's own Ontology of that directory, so passing it to worker processes
+    is cheap.
+    The attributes are also available as module attributes of utils (e.g. utils.all_synsets), loaded on first access.
+    '''
+    def __init__(self, data_dir=data_dir):
+        object.__setattr__(self, 'data_dir', data_dir)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('The ontology is read-only')
+
+    def __delattr__(self, name):
+        raise AttributeError('The ontology is read-only')
+
+    def __reduce__(self):
+        return get_ontology, (self.data_dir,)
+
+    def load_json(self, file_name):
+        with open(os.path.join(self.data_dir, file_name), 'r') as fp:
+            return freeze(json.load(fp))
+
+    # Root phrases:
+    #   person, vehicle, furniture, animal, food, bag, clothing, tableware, plant, electronic_equipment, home_appliance,
+    #   toy, building, mountain, kitchen_utensil, sky, sun, body_part, body_of_water, hand_tool, musical_instrument,
+    #   writing_implement, jewelry, weapon, timepiece
+    @cached_property
+    def phrase2synsets(self):
+        return self.load_json('phrase2synsets.json')
+
+    @cached_property
+    def phrase2hypernym(self):
+        return self.load_json('phrase2hypernym.json')
+
+    @cached_property
+    def child2parent(self):
+        return self.load_json('synsets_c2p.json')
+
+    @cached_property
+    def parent2children(self):
+        # Only synsets that have children are keys
+        parent2children = {}
+        for child, parent in self.child2parent.items():
+            parent2children.setdefault(parent, []).append(child)
+        return MappingProxyType({parent: tuple(children) for parent, children in parent2children.items()})
+
+    @cached_property
+    def implicit_synsets(self):
+        return self.load_json('implicit_synsets.json')
+
+    @cached_property
+    def phrase2replace_str(self):
+        phrase2replace_str = self.load_json('phrase2replace_str.json')
+        return MappingProxyType({
+            x: MappingProxyType({(None if synset == 'null' else synset): repr_phrase for synset, repr_phrase in y.items()})
+            for x, y in phrase2replace_str.items()
+        })
+
+    # Phrases replaced in the caption before parsing, to make the parser's job easier. E.g., in "olive green" olive is
+    #  considered a noun, and in "lion fish"/"car park" we would identify a lion/car
+    @cached_property
+    def phrase_rewrites(self):
+        return self.load_json('phrase_rewrites.json')
+
+    # Word sense and noun rules, see src/rule_engine.py
+    @cached_property
+    def token_rules(self):
+        return self.load_json('token_rules.json')
+
+    @cached_property
+    def non_synset_phrases(self):
+        return frozenset(self.load_json('non_synset_phrases.json'))
+
+    @cached_property
+    def identical_synsets_mapping(self):
+        return self.load_json('identical_synsets_mapping.json')
+
+    @cached_property
+    def all_synsets(self):
+        return frozenset([x for outer in self.phrase2synsets.values() for x in outer if x is not None]).union(self.implicit_synsets).union(self.child2parent)
+
+    @cached_property
+    def ontology_index(self):
+        return OntologyIndex(self.child2parent, self.all_synsets)
+
+ontology_attributes = [
+    'phrase2synsets', 'phrase2hypernym', 'child2parent', 'parent2children', 'implicit_synsets', 'phrase2replace_str',
+    'phrase_rewrites', 'token_rules', 'non_synset_phrases', 'identical_synsets_mapping', 'all_synsets', 'ontology_index'
+]
+# One Ontology per data directory in each process
+ontologies = {}
+
+def get_ontology(data_dir=data_dir):
+    if data_dir not in ontologies:
+        ontologies[data_dir] = Ontology(data_dir)
+    return ontologies[data_dir]
+
+def __getattr__(name):
+    # The ontology attributes are loaded on first access, so importing utils doesn't read the data files
+    if name in ontology_attributes:
+        value = getattr(get_ontology(), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 def is_hyponym_of(synset1, synset2):
-    if synset1 == synset2:
-        return True
-    if synset1 in child2parent:
-        return is_hyponym_of(child2parent[synset1], synset2)
-    return False
+    return get_ontology().ontology_index.is_hyponym_of(synset1, synset2)
+
+image_metadata = None
+
+def get_image_metadata():
+    # Built once per process (and cached on disk), see image_metadata.py
+    global image_metadata
+    if image_metadata is None:
+        image_metadata = ImageMetadata.load(
+            os.path.join(data_dir, 'xm3600_annotation.csv'), xm3600_json_path, os.path.join(data_dir, 'image_metadata.npz')
+        )
+        image_metadata.set_ontology(get_ontology().ontology_index)
+    return image_metadata
 
 def get_image_id_to_root_synsets():
-    csv_path = 'data/xm3600_annotation.csv'
-    iid2root_synset = {}
-    with open(csv_path, 'r') as fp:
-        my_reader = csv.reader(fp)
-        res = list(my_reader)
-
-    for sample in res[1:]:
-        file_name = sample[0]
-        iid = int(file_name, 16)
-        assert iid not in iid2root_synset
-        iid2root_synset[iid] = []
-        for ind in range(1, len(sample)):
-            if sample[ind] == '1':
-                iid2root_synset[iid].append(res[0][ind])
-
-    return iid2root_synset
+    return get_image_metadata().get_image_id_to_root_synsets()
 
 def verify_synset_in_image(synset, image_id, iid2root_synset):
     return image_id not in iid2root_synset or len([root_synset for root_synset in iid2root_synset[image_id] if is_hyponym_of(synset, root_synset)]) > 0
 
-def get_synset_to_image_prob(dataset):
-    iid2root_synset = get_image_id_to_root_synsets()
+def get_mention_in_image_masks(data):
+    # For each sample, whether each of its mentions' synset is in the image (as in verify_synset_in_image), as a bool
+    #  array. All the mentions of the dataset are checked together
+    image_metadata = get_image_metadata()
+    ontology_index = get_ontology().ontology_index
+    samples = [sample for sample in data if sample.get('synsets') is not None]
+    synset_ids = ontology_index.to_ids([x[3] for sample in samples for x in sample['synsets']])
+    image_inds = image_metadata.get_image_inds([sample['image_id'] for sample in samples for _ in sample['synsets']])
+    in_image = image_metadata.verify_synsets_in_images(synset_ids, image_inds)
+    masks = []
+    offset = 0
+    for sample in data:
+        mention_num = 0 if sample.get('synsets') is None else len(sample['synsets'])
+        masks.append(in_image[offset:offset+mention_num])
+        offset += mention_num
+    return masks
 
-    data = get_processed_dataset(dataset)
-    synset_to_image_count = {x: defaultdict(int) for x in all_synsets}
+def get_synset_to_image_prob(dataset):
+    # For each synset, the fraction of each image's captions that mention the synset or one of its hyponyms (only
+    #  synsets that are in the image, see verify_synset_in_image). Computed with sparse matrices: a (caption, synset)
+    #  mention matrix is expanded to the ancestors with the ontology's ancestor closure, summed per image and masked
+    #  with the image annotation
+    from scipy.sparse import csr_matrix
+    image_metadata = get_image_metadata()
+    ontology = get_ontology()
+    ontology_index = ontology.ontology_index
+
+    data = get_processed_dataset(dataset, ['image_id', 'synsets'], cached=True)
+    samples = [sample for sample in data if 'synsets' in sample and sample['synsets'] is not None]
+    # Images are interned in the order of their first caption
     image_count = defaultdict(int)
-    for sample in data:
-        if 'synsets' not in sample or sample['synsets'] is None:
-            continue
+    for sample in samples:
         image_count[sample['image_id']] += 1
-        identified_synsets = []
-        for synset in list(set([x[3] for x in sample['synsets']])):
-            identified_synsets.append(synset)
-            inner_synset = synset
-            while inner_synset in child2parent:
-                inner_synset = child2parent[inner_synset]
-                identified_synsets.append(inner_synset)
-        identified_synsets = list(set(identified_synsets))
-        if sample['image_id'] in iid2root_synset:
-            identified_synsets = [synset for synset in identified_synsets if verify_synset_in_image(synset, sample['image_id'], iid2root_synset)]
-        for id_synset in identified_synsets:
-            synset_to_image_count[id_synset][sample['image_id']] += 1
+    image_ids = list(image_count)
+    image_id_to_ind = {image_id: i for i, image_id in enumerate(image_ids)}
+
+    mention_synsets = ontology_index.to_ids([x[3] for sample in samples for x in sample['synsets']])
+    assert (mention_synsets >= 0).all(), f'Synsets of {dataset} are missing from the ontology'
+    mention_captions = np.repeat(np.arange(len(samples)), [len(sample['synsets']) for sample in samples])
+    synset_num = len(ontology_index)
+    mentions = csr_matrix((np.ones(len(mention_synsets), dtype=np.int64), (mention_captions, mention_synsets)), shape=(len(samples), synset_num))
+    # A caption identifies a synset if it mentions the synset or one of its hyponyms, and counts once per synset
+    identified = (mentions @ ontology_index.ancestor_closure()) > 0
+    caption_images = np.array([image_id_to_ind[sample['image_id']] for sample in samples], dtype=np.int64)
+    image_captions = csr_matrix((np.ones(len(samples), dtype=np.int64), (caption_images, np.arange(len(samples)))), shape=(len(image_ids), len(samples)))
+    counts = (image_captions @ identified.astype(np.int64)).tocoo()
+
+    in_image = image_metadata.verify_synsets_in_images(counts.col, image_metadata.get_image_inds([image_ids[i] for i in counts.row.tolist()]))
+    order = np.lexsort((counts.row, counts.col))
+    order = order[in_image[order]]
+    synset_to_image_count = {x: defaultdict(int) for x in ontology.all_synsets}
+    for synset_id, image_ind, count in zip(counts.col[order].tolist(), counts.row[order].tolist(), counts.data[order].tolist()):
+        synset_to_image_count[ontology_index.synsets[synset_id]][image_ids[image_ind]] = count
     synset_to_image_prob = {x[0]: {y[0]: y[1]/image_count[y[0]] for y in x[1].items()} for x in synset_to_image_count.items()}
 
     return synset_to_image_prob, synset_to_image_count, image_count